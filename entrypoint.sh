@@ -8,4 +8,8 @@ if [ "${FRONTEND_CONF_JSON}" != "" ]; then
   hug -f main.py -c load_frontend_config "${FRONTEND_CONF_JSON}" --for_real
 fi
 
-gunicorn --bind=0.0.0.0:8000 main:__hug_wsgi__
+if [ "${ASGI}" = "true" ]; then
+  uvicorn --host 0.0.0.0 --port 8000 asgi.asgi:app
+else
+  gunicorn --bind=0.0.0.0:8000 main:__hug_wsgi__
+fi
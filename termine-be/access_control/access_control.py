@@ -1,4 +1,11 @@
+import hashlib
+import hmac
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
 import jwt
 import hug
 import base64
@@ -10,19 +17,172 @@ from falcon import HTTPUnauthorized
 from db.directives import PeeweeContext, PeeweeSession
 from db.model import User
 from config import config
-from secret_token.secret_token import hash_pw
+from password_hash.password_hash import check_password, hash_password, needs_rehash
 
 log = logging.getLogger('auth')
 
 
-def token_verify(token, context: PeeweeContext):
+class UserCache:
+    """
+    Users resolved from tokens, by user name, for at most ttl_sec and never beyond the expiry of the token that
+    loaded them. Changes to a user made by this process invalidate its entry, changes made by other workers or the
+    cli show up after ttl_sec at the latest. Every lookup gets a fresh User instance, so requests can't see each
+    other's modifications.
+    """
+
+    def __init__(self, ttl_sec: int, max_size: int):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, user_name: str, load, expires_at: float = None):
+        user = self.cached(user_name)
+        if user is None:
+            user = load(user_name)
+            if user:
+                self.store(user, expires_at)
+        return user
+
+    def cached(self, user_name: str):
+        """a copy of the cached user, None if it has to be loaded"""
+        with self._lock:
+            entry = self._users.get(user_name)
+            if entry is not None and time.monotonic() < entry[1]:
+                self._users.move_to_end(user_name)
+                self.hits += 1
+                return User(**entry[0])
+            self.misses += 1
+            return None
+
+    def store(self, user: User, expires_at: float = None):
+        if self.ttl_sec <= 0:
+            return
+        now = time.monotonic()
+        valid_until = now + self.ttl_sec
+        if expires_at is not None:
+            valid_until = min(valid_until, now + expires_at - time.time())
+        with self._lock:
+            self._users[user.user_name] = (dict(user.__data__), valid_until)
+            self._users.move_to_end(user.user_name)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_name: str):
+        with self._lock:
+            self._users.pop(user_name, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "ttl_sec": self.ttl_sec,
+                "cached_users": len(self._users),
+            }
+
+
+user_cache = UserCache(config.Settings.user_cache_ttl_sec, config.Settings.user_cache_size)
+
+
+class CredentialCache:
+    """
+    Users whose Basic auth credentials were verified, for at most ttl_sec, so the back office, which sends them with
+    every request, skips the lookup and the hashing. Entries are keyed by an HMAC of the decoded Authorization header
+    under a key that never leaves the process: no password or plain hash of one is kept that guesses could be tested
+    against. Only successful verifications are cached. A password change drops the entries of the user, a
+    verification that ran while it happened isn't stored.
+    """
+
+    def __init__(self, ttl_sec: int, max_size: int):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+        self._generation = 0
+        # digest -> (normalized user name, user data, valid until)
+        self._credentials = OrderedDict()
+
+    def _digest(self, user_name: str, password: str) -> bytes:
+        return hmac.new(self._key, f"{user_name}:{password}".encode('utf8'), hashlib.sha256).digest()
+
+    def get(self, user_name: str, password: str, verify):
+        digest = self._digest(user_name, password)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._credentials.get(digest)
+            if entry is not None and now < entry[2]:
+                self._credentials.move_to_end(digest)
+                self.hits += 1
+                return User(**entry[1])
+            self.misses += 1
+            generation = self._generation
+        user = verify(user_name, password)
+        if user and self.ttl_sec > 0:
+            with self._lock:
+                if generation == self._generation:
+                    self._credentials[digest] = (user.user_name, dict(user.__data__), now + self.ttl_sec)
+                    self._credentials.move_to_end(digest)
+                    while len(self._credentials) > self.max_size:
+                        self._credentials.popitem(last=False)
+        return user
+
+    def invalidate(self, user_name: str):
+        with self._lock:
+            self._generation += 1
+            for digest in [digest for digest, entry in self._credentials.items() if entry[0] == user_name]:
+                del self._credentials[digest]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._credentials.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "ttl_sec": self.ttl_sec,
+                "cached_credentials": len(self._credentials),
+            }
+
+
+credential_cache = CredentialCache(config.Settings.credential_cache_ttl_sec, config.Settings.credential_cache_size)
+
+
+def decode_token(token):
+    """the user name and the expiry, if any, of a login token, None if it is invalid or expired"""
     secret = config.Settings.jwt_key
     try:
         user_object = jwt.decode(token, secret, algorithms=["HS256"])
-        return get_user(user_object['user'], context)
+        return user_object['user'], user_object.get('exp')
+    except jwt.ExpiredSignatureError as error:
+        log.warning("expired token {}".format(error))
+        return None
     except jwt.DecodeError as error:
         log.warning("decodeError {}".format(error))
+        return None
+
+
+def token_verify(token, context: PeeweeContext):
+    decoded = decode_token(token)
+    if decoded is None:
         return False
+    user_name, expires_at = decoded
+    return user_cache.get(user_name, lambda name: get_user(name, context), expires_at)
 
 
 token_key_authentication = hug.authentication.token(token_verify)
@@ -54,6 +214,12 @@ def get_user(user_name: str, context: PeeweeContext):
             return False
 
 
+def verify_user_cached(user_name, user_password, context: PeeweeContext):
+    """verify_user for credentials sent with every request, see CredentialCache"""
+    return credential_cache.get(user_name, user_password,
+                                lambda name, password: verify_user(name, password, context))
+
+
 def verify_user(user_name, user_password, context: PeeweeContext):
     name = normalize_user(user_name)
     with context.db.atomic():
@@ -61,9 +227,9 @@ def verify_user(user_name, user_password, context: PeeweeContext):
             user = User.get(User.user_name == name)
             if user.role == UserRoles.ANON:
                 return user
-            salt = user.salt
-            hashed = hash_pw(name, salt, user_password)
-            if hashed == user.password:
+            if check_password(name, user.salt, user_password, user.password):
+                if needs_rehash(user.password):
+                    rehash_password(user, user_password)
                 return user
             log.warning("invalid credentials for user: %s", user_name)
             return False
@@ -78,6 +244,17 @@ def verify_user(user_name, user_password, context: PeeweeContext):
             return False
 
 
+def rehash_password(user: User, user_password: str):
+    """stores the password of user, just checked, with the configured hasher, unless it was changed meanwhile"""
+    hashed = hash_password(user_password)
+    User.update(salt='', password=hashed) \
+        .where((User.id == user.id) & (User.password == user.password)) \
+        .execute()
+    user_cache.invalidate(user.user_name)
+    log.info("upgraded the password hash of %s", user.user_name)
+    user.salt, user.password = '', hashed
+
+
 def search_ldap_user(user_name: str, user_password: str, context: PeeweeContext):
     url = config.Ldap.url
     sys_user = config.Ldap.user_dn
@@ -179,12 +356,12 @@ def basic(request, response, own_verify_user, realm="simple", context=None, **kw
 
 @ basic
 def switchable_authentication(user_name, user_password, context: PeeweeContext):
-    return verify_user(user_name, user_password, context)
+    return verify_user_cached(user_name, user_password, context)
 
 
 @ hug.authentication.basic
 def authentication(user_name, user_password, context: PeeweeContext):
-    user = verify_user(user_name, user_password, context)
+    user = verify_user_cached(user_name, user_password, context)
     if user and user.role == UserRoles.ANON:
         return False
     return user
@@ -192,7 +369,7 @@ def authentication(user_name, user_password, context: PeeweeContext):
 
 @ hug.authentication.basic
 def admin_authentication(user_name, user_password, context: PeeweeContext):
-    user = verify_user(user_name, user_password, context)
+    user = verify_user_cached(user_name, user_password, context)
     if user and user.role == UserRoles.ADMIN:
         return user
     log.warning("missing admin role for: %s", user_name)
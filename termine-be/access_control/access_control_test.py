@@ -0,0 +1,85 @@
+import time
+
+import hug
+import jwt
+
+import main
+from access_control.access_control import user_cache, UserCache, credential_cache
+from conftest import get_user_login, get_admin_login, get_admin_auth_header, USER, ADMIN
+from db.model import User
+
+
+def test_token_users_are_cached(testing_db):
+    misses = user_cache.misses
+    hits = user_cache.hits
+    for _ in range(3):
+        response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+        assert response.status == hug.HTTP_200
+    assert user_cache.misses == misses + 1
+    assert user_cache.hits == hits + 2
+
+
+def test_patch_user_invalidates_cached_user(testing_db):
+    response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    coupons = response.data["coupons"]
+    response = hug.test.patch(main, "/admin_api/user", headers=get_admin_login(),
+                              body={"user_name": USER, "coupons": coupons + 5})
+    assert response.status == hug.HTTP_200
+    response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    assert response.data["coupons"] == coupons + 5
+
+    hug.test.cli("inc_coupon_count", user_name=USER, increment=-2, module="main")
+    response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    assert response.data["coupons"] == coupons + 3
+
+
+def test_cached_users_are_copies(testing_db):
+    cache = UserCache(ttl_sec=60, max_size=10)
+    first = cache.get(USER, lambda name: User.get(User.user_name == name))
+    first.coupons = -1
+    second = cache.get(USER, lambda name: User.get(User.user_name == name))
+    assert second.coupons != -1
+    assert second.id == first.id
+
+
+def test_cache_respects_token_expiry(testing_db):
+    cache = UserCache(ttl_sec=60, max_size=10)
+    cache.get(USER, lambda name: User.get(User.user_name == name), expires_at=time.time() - 1)
+    cache.get(USER, lambda name: User.get(User.user_name == name))
+    assert cache.misses == 2
+
+    expired = jwt.encode({"user": USER, "exp": int(time.time()) - 10}, "", algorithm="HS256")
+    response = hug.test.get(main, "/api/next_free_slots", headers={"Authorization": expired})
+    assert response.status == hug.HTTP_401
+
+
+def test_lru_eviction(testing_db):
+    cache = UserCache(ttl_sec=60, max_size=1)
+    cache.get(USER, lambda name: User.get(User.user_name == name))
+    cache.get("admin", lambda name: User.get(User.user_name == name))
+    assert cache.stats()["cached_users"] == 1
+    cache.get(USER, lambda name: User.get(User.user_name == name))
+    assert cache.misses == 3
+
+
+def test_admin_credentials_are_cached(testing_db):
+    misses = credential_cache.misses
+    hits = credential_cache.hits
+    for _ in range(3):
+        assert hug.test.get(main, "/admin_api/stats", headers=get_admin_login()).status == hug.HTTP_200
+    assert credential_cache.misses == misses + 1
+    assert credential_cache.hits == hits + 2
+    wrong = get_admin_auth_header(ADMIN, "wrong")
+    for _ in range(2):
+        assert hug.test.get(main, "/admin_api/stats", headers=wrong).status == hug.HTTP_401
+    assert credential_cache.misses == misses + 3
+    assert hug.test.get(main, "/admin_api/stats", headers=get_admin_auth_header(USER, USER)).status == \
+        hug.HTTP_401
+
+
+def test_password_change_invalidates_cached_credentials(testing_db):
+    assert hug.test.get(main, "/admin_api/stats", headers=get_admin_login()).status == hug.HTTP_200
+    hug.test.cli("change_user_pw", username=ADMIN, password="changed", for_real=True, module="main")
+    assert hug.test.get(main, "/admin_api/stats", headers=get_admin_login()).status == hug.HTTP_401
+    assert hug.test.get(main, "/admin_api/stats", headers=get_admin_auth_header(ADMIN, "changed")).status == \
+        hug.HTTP_200
@@ -1,42 +1,120 @@
 import hug
-from peewee import DoesNotExist, IntegrityError
+from peewee import DoesNotExist, IntegrityError, NodeList, SQL, Value
 
-from access_control.access_control import admin_authentication, UserRoles
-from db.directives import PeeweeSession
-from db.model import User, Booking
-from secret_token.secret_token import get_random_string, hash_pw
+from access_control.access_control import admin_authentication, UserRoles, user_cache, credential_cache
+from availability.availability import free_slot_cache, claim_reaper
+from coupons.coupons import set_coupons, query_coupon_state, having_num_bookings, count_bookings
+from db.directives import PeeweeSession, PeeweeContext
+from db.model import User
+from password_hash.password_hash import hash_password
+from slot_codes.slot_codes import slot_code_supply
+
+
+USER_FIELDS = ['user_name', 'is_admin', 'total_bookings', 'coupons']
+USER_SORT_KEYS = ['user_name', 'coupons', 'total_bookings']
+
+
+def _starts_with(column, prefix: str):
+    """column LIKE 'prefix%', which an index with text_pattern_ops serves in postgres"""
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return NodeList((column, SQL('LIKE'), Value(escaped + '%'), SQL("ESCAPE '\\'")))
+
+
+def _user_cursor(user, key: str) -> str:
+    if key == 'user_name':
+        return user.user_name
+    return f"{getattr(user, 'num_bookings' if key == 'total_bookings' else key)},{user.user_name}"
 
 
 @hug.get("/user", requires=admin_authentication)
-def get_users():
+def get_users(limit: hug.types.greater_than(0) = None, offset: hug.types.number = 0, sort: hug.types.text = None,
+              after: hug.types.text = None, search: hug.types.text = None,
+              role: hug.types.one_of([UserRoles.ADMIN, UserRoles.USER]) = None,
+              fields: hug.types.delimited_list(',') = None, response=None):
     """
-    SELECT u.user_name, u.coupons, COUNT(b.id)
+    SELECT u.user_name, u.role, u.coupons
     FROM "user" u
-    JOIN booking b ON b.booked_by = u.user_name
-    GROUP BY u.user_name, u.coupons
+    WHERE u.role != 'anonymous'
+      AND u.role = :role
+      AND u.user_name LIKE :search || '%'
+      AND (u.coupons, u.user_name) > (:after_coupons, :after_user_name)
+    ORDER BY :sort, u.user_name
+    LIMIT :limit + 1 OFFSET :offset
+
+    followed by count_bookings for the users of the page. Sorted by total_bookings or without a limit, the users are
+    read with their counts by query_coupon_state instead.
+
+    sort is one of USER_SORT_KEYS, descending with a leading '-'. Without it the users are ordered by role and name.
+    With limit set, the cursor for the next page is sent in the X-Next-Cursor header, pass it as `after`. On pages
+    without a cursor, the number of all matching users is sent in the X-Total-Count header.
     """
-    users = User.select().where(User.role != UserRoles.ANON).order_by(User.role.desc(), User.user_name)
-    return [{
-        "user_name": user.user_name,
-        "is_admin": user.role == UserRoles.ADMIN,
-        "total_bookings": len(Booking.select().where(
-            user.user_name == Booking.booked_by)),
-        "coupons": user.coupons
-    } for user in users]
+    fields = fields or USER_FIELDS
+    if offset < 0 or (sort and sort.lstrip('-') not in USER_SORT_KEYS) or \
+            any(field not in USER_FIELDS for field in fields):
+        raise hug.HTTPBadRequest
+    key = sort.lstrip('-') if sort else 'role'
+    descending = sort.startswith('-') if sort else True
+    # a page counts the bookings of its users, all users are better counted in one grouped query
+    with_counts = key == 'total_bookings' or (not limit and 'total_bookings' in fields)
+    if with_counts:
+        query, num_bookings = query_coupon_state()
+        column = num_bookings if key == 'total_bookings' else getattr(User, key)
+    else:
+        query = User.select(User.user_name, User.role, User.coupons)
+        column = getattr(User, key)
+    conditions = [User.role != UserRoles.ANON]
+    if role:
+        conditions.append(User.role == role)
+    if search:
+        # user names are stored in lower case
+        conditions.append(_starts_with(User.user_name, search.lower()))
+    query = query.where(*conditions)
+    if after:
+        if key == 'user_name':
+            query = query.where(User.user_name < after if descending else User.user_name > after)
+        else:
+            try:
+                after_value, after_user_name = after.split(',', 1)
+                after_value = after_value if key == 'role' else int(after_value)
+            except ValueError:
+                raise hug.HTTPBadRequest
+            # the leading range on column lets an index on (column, user_name) skip the pages before
+            condition = (column <= after_value if descending else column >= after_value) & \
+                        ((column < after_value if descending else column > after_value) |
+                         (User.user_name > after_user_name))
+            query = having_num_bookings(query, condition) if key == 'total_bookings' else query.where(condition)
+    query = query.order_by(column.desc() if descending else column, User.user_name)
+    if limit:
+        if not after:
+            response.set_header('X-Total-Count', str(User.select().where(*conditions).count()))
+        query = query.limit(limit + 1).offset(offset)
+    users = list(query)
+    if limit and len(users) > limit:
+        users = users[:limit]
+        response.set_header('X-Next-Cursor', _user_cursor(users[-1], key))
+    if not with_counts and 'total_bookings' in fields:
+        num_bookings = count_bookings([user.user_name for user in users])
+        for user in users:
+            user.num_bookings = num_bookings[user.user_name]
+    return [{field: value for field, value in [
+        ("user_name", user.user_name),
+        ("is_admin", user.role == UserRoles.ADMIN),
+        ("total_bookings", getattr(user, 'num_bookings', None)),
+        ("coupons", user.coupons),
+    ] if field in fields} for user in users]
 
 
 @hug.patch("/user", requires=admin_authentication)
 def patch_user(db: PeeweeSession, user_name: hug.types.text, coupons: hug.types.number):
     with db.atomic():
         try:
-            user = User.get(User.user_name == user_name)
             if coupons < 0:
                 coupons = 0
-            user.coupons = coupons
-            user.save()
+            if not set_coupons(user_name, coupons):
+                raise DoesNotExist(f"no user {user_name}")
             return {
-                "user_name": user.user_name,
-                "coupons": user.coupons
+                "user_name": user_name,
+                "coupons": coupons
             }
         except DoesNotExist as e:
             raise hug.HTTPBadRequest
@@ -54,13 +132,23 @@ def put_user(db: PeeweeSession, newUserName: hug.types.text, newUserPassword: hu
     with db.atomic():
         try:
             name = newUserName.lower()
-            salt = get_random_string(2)
-            secret_password = newUserPassword
-            hashed_password = hash_pw(name, salt, secret_password)
-            user = User.create(user_name=name, role=UserRoles.USER, salt=salt, password=hashed_password, coupons=10)
+            user = User.create(user_name=name, role=UserRoles.USER, salt='', password=hash_password(newUserPassword),
+                               coupons=10)
             user.save()
             return {
                 "username": user.user_name
             }
         except IntegrityError:
             raise hug.HTTPConflict('User already exists.')
+
+
+@hug.get("/stats", requires=admin_authentication)
+def get_stats():
+    return {
+        "db_pool": PeeweeContext.pool_stats(),
+        "free_slot_cache": free_slot_cache.stats(),
+        "claim_reaper": claim_reaper.stats(),
+        "user_cache": user_cache.stats(),
+        "credential_cache": credential_cache.stats(),
+        "slot_code_pool": slot_code_supply.stats()
+    }
@@ -1,6 +1,11 @@
+import sqlite3
+
 import hug
+import pytest
 
 import main
+from access_control.access_control import UserRoles
+from db.model import User, Booking
 from conftest import get_user_login, get_admin_login, get_create_user_pw_mismatch, USER, get_create_user, \
     get_admin_auth_header, get_valid_user_auth_header, get_invalid_login
 
@@ -20,6 +25,76 @@ def test_admin_is_authorized(testing_db):
     assert response.status == hug.HTTP_200
 
 
+def test_get_users_sorted_and_paged(testing_db):
+    User.insert_many([{"user_name": f"praxis-{i}", "salt": "", "password": "", "role": UserRoles.USER, "coupons": i}
+                      for i in range(5)]).execute()
+    response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), sort="-coupons", limit=3)
+    assert response.status == hug.HTTP_200
+    assert response.headers_dict["X-Total-Count"] == "7"
+    assert [user["coupons"] for user in response.data] == [10, 10, 4]
+    response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), sort="-coupons", limit=3,
+                            offset=3)
+    assert [user["user_name"] for user in response.data] == ["praxis-3", "praxis-2", "praxis-1"]
+    assert all(user["total_bookings"] == 0 for user in response.data)
+    response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), sort="password")
+    assert response.status == hug.HTTP_400
+
+
+def _pages(**params):
+    pages = []
+    after = None
+    while True:
+        response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), limit=2,
+                                **params, **({"after": after} if after else {}))
+        assert response.status == hug.HTTP_200
+        pages.append(response.data)
+        after = response.headers_dict.get("X-Next-Cursor")
+        if not after:
+            return pages
+
+
+def test_get_users_by_cursor(testing_db):
+    User.insert_many([{"user_name": name, "salt": "", "password": "", "role": UserRoles.USER, "coupons": 1}
+                      for name in ["ldap-a", "ldap-b", "ldap-c", "ldap_x", "praxis"]]).execute()
+    for i in range(3):
+        Booking.create(surname="Mustermann", first_name="Marianne", phone="0123456789", office="MusterOffice",
+                       secret=f"SECRET{i}", booked_by="ldap-b" if i else "praxis", appointment=0)
+
+    pages = _pages(search="LDAP-", fields="user_name")
+    assert pages == [[{"user_name": "ldap-a"}, {"user_name": "ldap-b"}], [{"user_name": "ldap-c"}]]
+    pages = _pages(sort="-total_bookings", role=UserRoles.USER)
+    assert [[user["user_name"] for user in page] for page in pages] == \
+           [["ldap-b", "praxis"], ["ldap-a", "ldap-c"], ["ldap_x", "user"]]
+    assert pages[0][0]["total_bookings"] == 2
+    pages = _pages(fields="user_name,total_bookings")
+    users = [user for page in pages for user in page]
+    assert [user["user_name"] for user in users] == ["ldap-a", "ldap-b", "ldap-c", "ldap_x", "praxis", "user",
+                                                     "admin"]
+    assert {user["user_name"]: user["total_bookings"] for user in users}["ldap-b"] == 2
+    response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), fields="password")
+    assert response.status == hug.HTTP_400
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "setlimit"), reason="needs python 3.11")
+def test_get_all_users_within_old_sqlite_parameter_limit(testing_db):
+    User.insert_many([{"user_name": f"praxis-{i:04}", "salt": "", "password": "", "role": UserRoles.USER,
+                       "coupons": 1} for i in range(1200)]).execute()
+    Booking.create(surname="Mustermann", first_name="Marianne", phone="0123456789", office="MusterOffice",
+                   secret="SECRET", booked_by="praxis-1100", appointment=0)
+    connection = testing_db.connection()
+    limit = connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        for params in [{}, {"limit": 2000}]:
+            response = hug.test.get(main, "/admin_api/user", headers=get_admin_login(), sort="user_name", **params)
+            assert response.status == hug.HTTP_200
+            users = {user["user_name"]: user["total_bookings"] for user in response.data}
+            assert len(users) == 1202
+            assert users["praxis-1100"] == 1
+            assert users["praxis-0001"] == 0
+    finally:
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+
+
 def test_create_user_password_no_match(testing_db):
     response = hug.test.put(main, "/admin_api/user", headers=get_admin_login(),
                             body=get_create_user_pw_mismatch(username="test"))
@@ -44,3 +119,10 @@ def ignore_test_create_user(testing_db):
     assert response.status == hug.HTTP_200
     response = hug.test.get(main, "/admin_api/user", headers=get_admin_auth_header(username, password))
     assert response.status == hug.HTTP_401
+
+
+def test_stats(testing_db):
+    response = hug.test.get(main, "/admin_api/stats", headers=get_admin_login())
+    assert response.status == hug.HTTP_200
+    assert response.data["db_pool"] == {"pooled": False}
+    assert "hit_rate" in response.data["user_cache"]
@@ -1,16 +1,23 @@
-import csv
-import io
 import logging
+import os
+import tempfile
 from datetime import datetime, timedelta, date
 import hug
-import xlsxwriter
-from peewee import fn, DoesNotExist, IntegrityError
+from peewee import DoesNotExist
 
-from access_control.access_control import UserRoles, token_key_authentication
+from access_control.access_control import UserRoles, token_key_authentication, user_cache, \
+    credential_cache
+from availability.availability import free_slot_cache, query_free_slots, query_claimable, claims_reaped, \
+    claim_counts_as_free, update_slot_counter
 from config import config
-from db.directives import PeeweeSession
-from db.model import TimeSlot, Appointment, Booking, SlotCode, User
-from secret_token.secret_token import get_random_string, get_secret_token, hash_pw
+from coupons.coupons import take_coupon, return_coupon, update_booking_stats
+from db.directives import PeeweeSession, PeeweeContext
+from db.model import TimeSlot, Appointment, Booking, User
+from export.export import create_job, queue_job, fail_stale_jobs, get_job, job_status, artifact_path, JobStatus, \
+    WRITERS, bookings_between, bookings_csv_query, csv_chunks, write_booking_list_xlsx
+from password_hash.password_hash import check_password, hash_password
+from secret_token.secret_token import get_random_string
+from slot_codes.slot_codes import slot_code_supply
 
 log = logging.getLogger('api')
 
@@ -20,67 +27,76 @@ def format_as_csv(data, request=None, response=None):
     return data
 
 
+class ChunkStream:
+    """file like wrapper around a generator of byte chunks, hug streams everything that can be read() to the client"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self._buffer = self._buffer + b''.join(self._chunks), b''
+            return data
+        # like a socket, hand out what is there as soon as there is something, instead of waiting for size bytes
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b''
+            self._buffer = chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._chunks.close()
+
+
+def free_slots_response(slots, user: User) -> dict:
+    return {
+        "slots": [{
+            "startDateTime": slot["start_date_time"],
+            "freeAppointments": slot["free_appointments"],
+            "timeSlotLength": slot["length_min"]
+        } for slot in slots
+        ],
+        "coupons": user.coupons
+    }
+
+
 @hug.get("/next_free_slots", requires=token_key_authentication)
 def next_free_slots(db: PeeweeSession, user: hug.directives.user, at_datetime: hug.types.text = None):
     """
-    SELECT t.start_date_time, count(a.time_slot_id)
-FROM appointment a
-         JOIN timeslot t ON a.time_slot_id = t.id
-WHERE a.booked IS false
-  AND a.claim_token ISNULL
-  AND t.start_date_time > NOW()
-GROUP BY t.start_date_time
-ORDER BY t.start_date_time
+    the free appointments per slot are served from the free_slot_cache, see availability.query_free_slots
     """
     with db.atomic():
-        # @formatter:off
         if at_datetime is not None:
             now = datetime.fromisoformat(at_datetime).replace(tzinfo=None)
+            slots = query_free_slots(now).limit(config.Settings.num_display_slots).dicts()
         else:
             now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
-        slots = TimeSlot \
-            .select(TimeSlot.start_date_time, TimeSlot.length_min,
-                    fn.count(Appointment.time_slot).alias("free_appointments")) \
-            .join(Appointment) \
-            .where(
-                (TimeSlot.start_date_time > now) &
-                (Appointment.claim_token.is_null() | (Appointment.claimed_at +
-                                                      timedelta(
-                                                          minutes=config.Settings.claim_timeout_min) < now)) &
-                (Appointment.booked == False)
-            ) \
-            .group_by(TimeSlot.start_date_time, TimeSlot.length_min) \
-            .order_by(TimeSlot.start_date_time) \
-            .limit(config.Settings.num_display_slots)
-        # @formatter:on
-        return {
-            "slots": [{
-                "startDateTime": slot.start_date_time,
-                "freeAppointments": slot.free_appointments,
-                "timeSlotLength": slot.length_min
-            } for slot in slots
-            ],
-            "coupons": user.coupons
-        }
+            slots = free_slot_cache.free_slots(now, config.Settings.num_display_slots)
+        return free_slots_response(slots, user)
 
 
 @hug.get("/claim_appointment", requires=token_key_authentication)
 def claim_appointment(db: PeeweeSession, start_date_time: hug.types.text, user: hug.directives.user):
     """
-    UPDATE appointment app
-    SET claim_token = 'claimed'
-    WHERE app.id
+    UPDATE appointment
+    SET claim_token = 'claimed', claimed_at = NOW()
+    WHERE appointment.id
           IN (
               SELECT a.id FROM appointment a
-                                 JOIN timeslot t on a.time_slot_id = t.id
-              WHERE t.start_date_time = '2020-03-25 08:30:00.000000'
+              WHERE a.time_slot_id IN (SELECT t.id FROM timeslot t WHERE t.start_date_time = '2020-03-25 08:30:00.000000')
                 AND a.claim_token isnull
                 AND NOT a.booked
               LIMIT 1
+              FOR UPDATE SKIP LOCKED
               )
-    RETURNING *
+
+    if no appointment is left unclaimed, the same again for one with an expired claim
+    (a.claim_token notnull AND a.claimed_at < NOW() - claim_timeout), unless a claim reaper clears those
     """
-    with db.atomic():
+    with free_slot_cache.adjusting() as adjust_free_slots, db.atomic():
         try:
             if user.role != UserRoles.ANON:
                 assert user.coupons > 0
@@ -88,22 +104,27 @@ def claim_appointment(db: PeeweeSession, start_date_time: hug.types.text, user:
             now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
             if start_date_time_object < now:
                 raise ValueError("Can't claim an appointment in the past")
-            time_slot = TimeSlot.get(
-                TimeSlot.start_date_time == start_date_time_object)
-            appointment = Appointment.select() \
-                .where(
-                (Appointment.time_slot == time_slot) &
-                (Appointment.booked == False) &
-                (Appointment.claim_token.is_null() | (Appointment.claimed_at +
-                                                      timedelta(
-                                                          minutes=config.Settings.claim_timeout_min) < now))
-            ) \
-                .order_by(Appointment.claim_token.desc()) \
-                .get()
-            appointment.claim_token = get_random_string(32)
-            appointment.claimed_at = now
-            appointment.save()
-            return appointment.claim_token
+            claim_token = get_random_string(32)
+            for expired_claims in [False] if claims_reaped() else [False, True]:
+                claimable = query_claimable(start_date_time_object, now, expired_claims, skip_locked=db.for_update)
+                claimed = Appointment.update(claim_token=claim_token, claimed_at=now) \
+                    .where(Appointment.id.in_(claimable)) \
+                    .execute()
+                if claimed:
+                    break
+            else:
+                raise DoesNotExist("no free appointment at {}".format(start_date_time))
+            if not expired_claims:
+                # taking over an expired claim leaves the number of claimed appointments as it is
+                # found through the index on (time_slot_id, booked, claim_token), among the appointments of the slot
+                claimed_slot = Appointment.select(Appointment.time_slot).where(
+                    (Appointment.time_slot.in_(
+                        TimeSlot.select(TimeSlot.id).where(TimeSlot.start_date_time == start_date_time_object))) &
+                    (Appointment.booked == False) &
+                    (Appointment.claim_token == claim_token))
+                update_slot_counter(claimed_slot, claimed=1)
+            adjust_free_slots(start_date_time_object, -1)
+            return claim_token
         except DoesNotExist as e:
             raise hug.HTTPGone
         except ValueError as e:
@@ -114,9 +135,14 @@ def claim_appointment(db: PeeweeSession, start_date_time: hug.types.text, user:
 
 @hug.post("/book_appointment", requires=token_key_authentication)
 def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directives.user):
-    with db.atomic():
+    with free_slot_cache.adjusting() as adjust_free_slots, db.atomic():
         try:
             if all(key in body for key in ('claim_token', 'start_date_time', 'first_name', 'name', 'phone', 'office')):
+                if user.role != UserRoles.ANON:
+                    # taken first, so a user without coupons is turned away before anything else is touched. Undone
+                    # with the rest of the transaction if the booking fails.
+                    if not take_coupon(user):
+                        raise hug.HTTPBadRequest
                 claim_token = body['claim_token']
                 start_date_time = body['start_date_time']
                 start_date_time_object = datetime.fromisoformat(
@@ -131,26 +157,22 @@ def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directiv
                     (Appointment.booked == False) &
                     (Appointment.claim_token == claim_token)
                 )
-                appointment.booked = True
-                appointment.claim_token = None
-                appointment.claimed_at = None
-                appointment.save()
-                success = False
+                # an expired claim already counts as free again, booking it takes it from the free slots
+                claim_expired = claim_counts_as_free(appointment.claimed_at, now)
+                booked = Appointment.update(booked=True, claim_token=None, claimed_at=None) \
+                    .where((Appointment.id == appointment.id) & (Appointment.claim_token == claim_token)) \
+                    .execute()
+                if not booked:
+                    # reaped or taken over since it was read
+                    raise DoesNotExist("claim {} is gone".format(claim_token))
+                update_slot_counter(appointment.time_slot_id, claimed=-1, booked=1)
                 street = body['street'] if 'street' in body else None
                 street_number = body['street_number'] if 'street_number' in body else None
                 post_code = body['post_code'] if 'post_code' in body else None
                 city = body['city'] if 'city' in body else None
                 birthday = body['birthday'] if 'birthday' in body else None
                 reason = body['reason'] if 'reason' in body else None
-                with db.atomic():
-                    while not success:
-                        secret = get_secret_token(6)
-                        try:
-                            SlotCode.create(
-                                date=time_slot.start_date_time.date(), secret=secret)
-                            success = True
-                        except IntegrityError as e:  # in the offchance that we had a collision with secret codes, retry
-                            pass
+                secret = slot_code_supply.take(db, time_slot.slot_date)
 
                 booking = Booking.create(appointment=appointment, first_name=body['first_name'], surname=body['name'],
                                          phone=body['phone'], street=street,
@@ -159,9 +181,9 @@ def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directiv
                                          reason=reason, office=body['office'], secret=secret,
                                          booked_by=user.user_name)
                 booking.save()
-                if user.role != UserRoles.ANON:
-                    user.coupons -= 1
-                    user.save()
+                update_booking_stats(user.user_name, 1)
+                if claim_expired:
+                    adjust_free_slots(time_slot.start_date_time, -1)
                 return {
                     "secret": booking.secret,
                     "time_slot": time_slot.start_date_time,
@@ -179,58 +201,52 @@ def book_appointment(db: PeeweeSession, body: hug.types.json, user: hug.directiv
 
 @hug.delete("/claim_token", requires=token_key_authentication)
 def delete_claim_token(db: PeeweeSession, claim_token: hug.types.text):
-    with db.atomic():
+    with free_slot_cache.adjusting() as adjust_free_slots, db.atomic():
         try:
-            appointment = Appointment.get(
+            appointment = Appointment.select(Appointment, TimeSlot).join(TimeSlot).where(
                 (Appointment.booked == False) &
                 (Appointment.claim_token == claim_token)
-            )
-            appointment.claim_token = None
-            appointment.claimed_at = None
-            appointment.save()
+            ).get()
+            now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+            claim_expired = claim_counts_as_free(appointment.claimed_at, now)
+            released = Appointment.update(claim_token=None, claimed_at=None) \
+                .where((Appointment.id == appointment.id) & (Appointment.claim_token == claim_token)) \
+                .execute()
+            if not released:
+                # reaped or taken over since it was read
+                return
+            update_slot_counter(appointment.time_slot_id, claimed=-1)
+            if not claim_expired:
+                adjust_free_slots(appointment.time_slot.start_date_time, 1)
         except DoesNotExist as e:
             pass
         except ValueError as e:
             pass
 
 
+def bookings_for_day_csv(db: PeeweeSession, user: User, requested_day_object: date):
+    """
+    yields the bookings of the given day as csv, chunk by chunk, while the rows are read through a streaming cursor.
+    Runs after the request handler returned, so it holds a connection of its own until the last chunk is sent.
+    """
+    try:
+        query = bookings_csv_query(user) \
+            .where(TimeSlot.slot_date == requested_day_object)
+        yield from csv_chunks(db, query)
+    finally:
+        PeeweeContext.release_connection()
+
+
 @hug.get("/list_for_day.csv", output=format_as_csv, requires=token_key_authentication)
 def list_for_day(db: PeeweeSession, user: hug.directives.user,
                  date_of_day: hug.types.text = None):
     if not date_of_day:
         date_of_day = (date.today() + timedelta(days=1)).isoformat()
-    user_name = user.user_name
-    with db.atomic():
-        try:
-            user_role = user.role
-            requested_day_object = date.fromisoformat(date_of_day)
-            result = io.StringIO()
-            writer = csv.DictWriter(result,
-                                    fieldnames=['start_date_time', 'first_name', 'surname', 'phone', 'office', 'secret',
-                                                'booked_by'])
-            writer.writeheader()
-            for timeslot in TimeSlot.select().where(
-                    (TimeSlot.start_date_time > requested_day_object - timedelta(days=1)) &
-                    (TimeSlot.start_date_time < requested_day_object + timedelta(days=1))):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(
-                            Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-
-                        writer.writerow({'start_date_time': timeslot.start_date_time, 'first_name': booking.first_name,
-                                         'surname': booking.surname, 'phone': booking.phone, 'office': booking.office,
-                                         'secret': booking.secret, 'booked_by': booking.booked_by})
-                    except DoesNotExist as e:
-                        pass
-            return result.getvalue().encode('utf8')
-        except DoesNotExist as e:
-            raise hug.HTTPGone
-        except ValueError as e:
-            raise hug.HTTPBadRequest
+    try:
+        requested_day_object = date.fromisoformat(date_of_day)
+    except ValueError as e:
+        raise hug.HTTPBadRequest
+    return ChunkStream(bookings_for_day_csv(db, user, requested_day_object))
 
 
 @hug.format.content_type('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -239,139 +255,148 @@ def format_as_xlsx(data, request=None, response=None):
 
 
 @hug.get("/booking_list.xlsx", output=format_as_xlsx, requires=token_key_authentication)
-def list_for_day(db: PeeweeSession,
+def booking_list(db: PeeweeSession,
                  user: hug.directives.user,
                  start_date: hug.types.text,
-                 end_date: hug.types.text):
-    user_name = user.user_name
+                 end_date: hug.types.text,
+                 response=None):
+    """
+    answers with 202 and the status of an export job instead of the file, if there are more than
+    config.Settings.export_sync_max_rows bookings in the range
+    """
+    try:
+        start_day_object = date.fromisoformat(start_date)
+        end_day_object = date.fromisoformat(end_date)
+    except ValueError as e:
+        raise hug.HTTPBadRequest
+    job = None
     with db.atomic():
-        try:
-            user_role = user.role
-            start_day_object = date.fromisoformat(start_date)
-            end_day_object = date.fromisoformat(end_date)
-            result = io.BytesIO()
-            workbook = xlsxwriter.Workbook(result)
-            worksheet = workbook.add_worksheet()
-            bold = workbook.add_format({'bold': 1})
-            date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
-            time_format = workbook.add_format({'num_format': 'hh:mm'})
-            worksheet.set_column('A:A', 15)
-            worksheet.set_column('B:B', 8)
-            worksheet.set_column('C:C', 18)
-            worksheet.set_column('D:D', 15)
-            worksheet.set_column('E:E', 18)
-            worksheet.set_column('F:F', 15)
-            worksheet.set_column('G:G', 15)
-            worksheet.set_column('H:H', 15)
-            worksheet.set_column('I:I', 15)
-            worksheet.set_column('J:J', 15)
-            worksheet.set_column('K:K', 15)
-            worksheet.set_column('L:L', 15)
-            worksheet.set_column('M:M', 15)
-            worksheet.set_column('N:N', 15)
-            worksheet.set_column('O:O', 15)
-            worksheet.write('A1', 'Termin', bold)
-            worksheet.write('B1', 'Uhrzeit', bold)
-            worksheet.write('C1', 'Vorname', bold)
-            worksheet.write('D1', 'Nachname', bold)
-            worksheet.write('E1', 'Telefon', bold)
-            worksheet.write('F1', 'Straße', bold)
-            worksheet.write('G1', 'Hausnummer', bold)
-            worksheet.write('H1', 'PLZ', bold)
-            worksheet.write('I1', 'Stadt', bold)
-            worksheet.write('J1', 'Geburtdatum', bold)
-            worksheet.write('K1', 'Risikokategorie 1', bold)
-            worksheet.write('L1', 'Berechtigungscode', bold)
-            worksheet.write('M1', 'Behörde', bold)
-            worksheet.write('N1', 'Gebucht von', bold)
-            worksheet.write('O1', 'Gebucht am', bold)
-            row = 1
-            col = 0
-            for timeslot in TimeSlot.select().where(
-                (TimeSlot.start_date_time >= start_day_object) &
-                (TimeSlot.start_date_time < end_day_object + timedelta(days=1))).order_by(
-                    TimeSlot.start_date_time.desc()):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(
-                            Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-
-                        worksheet.write_datetime(
-                            row, col, timeslot.start_date_time, date_format)
-                        worksheet.write_datetime(
-                            row, col + 1, timeslot.start_date_time, time_format)
-                        worksheet.write_string(
-                            row, col + 2, booking.first_name)
-                        worksheet.write_string(row, col + 3, booking.surname)
-                        worksheet.write_string(row, col + 4, booking.phone)
-                        worksheet.write_string(
-                            row, col + 5, booking.street if booking.street is not None else "")
-                        worksheet.write_string(
-                            row, col + 6, booking.street_number if booking.street_number is not None else "")
-                        worksheet.write_string(
-                            row, col + 7, booking.post_code if booking.post_code is not None else "")
-                        worksheet.write_string(
-                            row, col + 8, booking.city if booking.city is not None else "")
-                        if booking.birthday is None:
-                            worksheet.write_string(row, col + 9, "")
-                        else:
-                            worksheet.write_datetime(
-                                row, col + 9, booking.birthday, date_format)
-                        worksheet.write_string(
-                            row, col + 10, booking.reason if booking.reason is not None else "")
-                        worksheet.write_string(row, col + 11, booking.secret)
-                        worksheet.write_string(row, col + 12, booking.office)
-                        worksheet.write_string(
-                            row, col + 13, booking.booked_by)
-                        worksheet.write_datetime(
-                            row, col + 14, booking.booked_at, date_format)
-                        row += 1
-                    except DoesNotExist as e:
-                        pass
-            workbook.close()
-            result.flush()
-            return result.getvalue()
-        except DoesNotExist as e:
-            raise hug.HTTPGone
-        except ValueError as e:
-            raise hug.HTTPBadRequest
+        num_bookings = bookings_between(user, start_day_object, end_day_object).count()
+        if num_bookings > config.Settings.export_sync_max_rows:
+            job = create_job('booking_list.xlsx', user, start_day_object, end_day_object)
+    if job is not None:
+        queue_job(job)
+        response.status = hug.HTTP_202
+        response.content_type = 'application/json'
+        return hug.output_format.json(job_status(job))
+    result = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+    result.close()
+    try:
+        write_booking_list_xlsx(db, user, start_day_object, end_day_object, result.name)
+        response.content_length = os.path.getsize(result.name)
+        # the open handle keeps the file around until it is sent
+        return open(result.name, 'rb')
+    finally:
+        os.unlink(result.name)
+
+
+@hug.post("/export_job", requires=token_key_authentication)
+def create_export_job(db: PeeweeSession, user: hug.directives.user,
+                      kind: hug.types.one_of(sorted(WRITERS)),
+                      start_date: hug.types.text,
+                      end_date: hug.types.text,
+                      response=None):
+    try:
+        start_day_object = date.fromisoformat(start_date)
+        end_day_object = date.fromisoformat(end_date)
+    except ValueError as e:
+        raise hug.HTTPBadRequest
+    with db.atomic():
+        job = create_job(kind, user, start_day_object, end_day_object)
+    queue_job(job)
+    response.status = hug.HTTP_202
+    return job_status(job)
+
+
+@hug.get("/export_job", requires=token_key_authentication)
+def export_job(db: PeeweeSession, user: hug.directives.user, job_id: hug.types.text):
+    with db.atomic():
+        fail_stale_jobs()
+        job = get_job(job_id, user)
+        if job is None:
+            raise hug.HTTPNotFound()
+        return job_status(job)
+
+
+@hug.get("/export_job/download", output=hug.output_format.file, requires=token_key_authentication)
+def export_job_download(db: PeeweeSession, user: hug.directives.user, job_id: hug.types.text):
+    with db.atomic():
+        job = get_job(job_id, user)
+        if job is None or job.status != JobStatus.DONE:
+            raise hug.HTTPNotFound()
+        return artifact_path(job)
+
+
+BOOKED_FIELDS = {
+    'start_date_time': TimeSlot.start_date_time,
+    'first_name': Booking.first_name,
+    'surname': Booking.surname,
+    'phone': Booking.phone,
+    'office': Booking.office,
+    'secret': Booking.secret,
+    'booked_by': Booking.booked_by,
+    'booked_at': Booking.booked_at,
+    'booking_id': Booking.id,
+}
+
+
+def _booked_cursor(booking) -> str:
+    return f"{booking['start_date_time'].isoformat()},{booking['booking_id']}"
 
 
 @hug.get("/booked", requires=token_key_authentication)
 def booked(db: PeeweeSession, user: hug.directives.user, start_date: hug.types.text,
-           end_date: hug.types.text):
+           end_date: hug.types.text, limit: hug.types.greater_than(0) = None, after: hug.types.text = None,
+           fields: hug.types.delimited_list(',') = None, response=None):
+    """
+    SELECT t.start_date_time, b.*
+    FROM booking b
+             JOIN appointment a ON b.appointment_id = a.id
+             JOIN timeslot t ON a.time_slot_id = t.id
+    WHERE a.booked
+      AND (t.start_date_time, b.id) < (:after_start_date_time, :after_booking_id)
+      AND t.slot_date BETWEEN :start_date AND :end_date
+      AND b.booked_by = :user_name  -- everybody but admins
+    ORDER BY t.start_date_time DESC, b.id DESC
+    LIMIT :limit + 1
+
+    with limit set, the cursor for the next page is sent in the X-Next-Cursor header, pass it as `after`
+    """
     user_name = user.user_name
     with db.atomic():
         try:
             user_role = user.role
             start_day_object = date.fromisoformat(start_date)
             end_day_object = date.fromisoformat(end_date)
-            if user_role != UserRoles.ADMIN:
-                start_day_object = date.fromisoformat('2021-01-01') #FIXME: hack to show users all their bookings
-                end_day_object = date.fromisoformat('2022-12-31') #FIXME: hack to show users all their bookings
-            bookings = []
-            for timeslot in TimeSlot.select().where((TimeSlot.start_date_time >= start_day_object) &
-                                                    (TimeSlot.start_date_time < end_day_object + timedelta(days=1))) \
-                    .order_by(TimeSlot.start_date_time.desc()):
-                for appointment in Appointment.select().where(
-                        (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
-                    try:
-                        booking = Booking.get(
-                            Booking.appointment == appointment)
-                        if user_role != UserRoles.ADMIN:
-                            booking = Booking.select().where((Booking.appointment == appointment) &
-                                                             (Booking.booked_by == user_name)).get()
-                        bookings.append({'start_date_time': timeslot.start_date_time, 'first_name': booking.first_name,
-                                         'surname': booking.surname, 'phone': booking.phone, 'office': booking.office,
-                                         'secret': booking.secret, 'booked_by': booking.booked_by,
-                                         'booked_at': booking.booked_at, 'booking_id': booking.get_id()})
-                    except DoesNotExist as e:
-                        pass
-            return bookings
+            fields = fields or list(BOOKED_FIELDS.keys())
+            if any(field not in BOOKED_FIELDS for field in fields):
+                raise ValueError("unknown field requested")
+            # the cursor columns are always needed for ordering and paging
+            selected = set(fields) | {'start_date_time', 'booking_id'}
+            query = Booking.select(*[column.alias(name) for name, column in BOOKED_FIELDS.items() if name in selected]) \
+                .join(Appointment) \
+                .join(TimeSlot) \
+                .where(Appointment.booked == True)
+            if user_role == UserRoles.ADMIN:
+                query = query.where(TimeSlot.slot_date.between(start_day_object, end_day_object))
+            else:
+                # users get to see all of their own bookings
+                query = query.where(Booking.booked_by == user_name)
+            if after:
+                after_start_date_time, after_booking_id = after.rsplit(',', 1)
+                after_start_date_time = datetime.fromisoformat(after_start_date_time)
+                after_booking_id = int(after_booking_id)
+                query = query.where((TimeSlot.start_date_time < after_start_date_time) |
+                                    ((TimeSlot.start_date_time == after_start_date_time) &
+                                     (Booking.id < after_booking_id)))
+            query = query.order_by(TimeSlot.start_date_time.desc(), Booking.id.desc())
+            if limit:
+                query = query.limit(limit + 1)
+            bookings = list(query.dicts())
+            if limit and len(bookings) > limit:
+                bookings = bookings[:limit]
+                response.set_header('X-Next-Cursor', _booked_cursor(bookings[-1]))
+            return [{field: booking[field] for field in fields} for booking in bookings]
         except DoesNotExist as e:
             raise hug.HTTPGone
         except ValueError as e:
@@ -381,19 +406,22 @@ def booked(db: PeeweeSession, user: hug.directives.user, start_date: hug.types.t
 @hug.delete("/booking", requires=token_key_authentication)
 def delete_booking(db: PeeweeSession, user: hug.directives.user, booking_id: hug.types.text):
     if user.role != UserRoles.ANON:
-        with db.atomic():
+        with free_slot_cache.adjusting() as adjust_free_slots, db.atomic():
             try:
-                booking = Booking.get_by_id(booking_id)
+                booking = Booking.select(Booking, Appointment, TimeSlot).join(Appointment).join(TimeSlot) \
+                    .where(Booking.id == booking_id).get()
                 if user.role == UserRoles.USER and booking.booked_by != user.user_name:
                     return hug.HTTP_METHOD_NOT_ALLOWED
                 appointment = booking.appointment
                 appointment.booked = False
                 appointment.save()
                 booking.delete_instance()
+                update_slot_counter(appointment.time_slot_id, booked=-1)
+                update_booking_stats(booking.booked_by, -1)
+                return_coupon(user)
+                adjust_free_slots(appointment.time_slot.start_date_time, 1)
             except DoesNotExist as e:
                 raise hug.HTTP_NOT_FOUND
-        user.coupons += 1
-        user.save()
         return {"booking_id": booking_id, "deleted": "successful"}
     else:
         raise hug.HTTP_METHOD_NOT_ALLOWED
@@ -410,14 +438,12 @@ def patch_user(db: PeeweeSession,
         raise hug.HTTPBadRequest
     with db.atomic():
         try:
-            if user.password != hash_pw(user.user_name, user.salt, old_user_password):
+            if not check_password(user.user_name, user.salt, old_user_password, user.password):
                 raise hug.HTTPBadRequest
-            salt = get_random_string(2)
-            secret_password = new_user_password
-            hashed_password = hash_pw(user.user_name, salt, secret_password)
-            user.salt = salt
-            user.password = hashed_password
-            user.save()
+            # only the password, user may come from the user cache with coupons used up meanwhile
+            User.update(salt='', password=hash_password(new_user_password)).where(User.id == user.id).execute()
+            user_cache.invalidate(user.user_name)
+            credential_cache.invalidate(user.user_name)
             log.info(f"updated {user.user_name}'s pw.")
             return "updated"
         except DoesNotExist as e:
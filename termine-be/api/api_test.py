@@ -1,7 +1,32 @@
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
 import hug
+import pytest
+from peewee import SqliteDatabase
+from playhouse.postgres_ext import PostgresqlExtDatabase
 
 import main
-from conftest import get_user_login, get_change_pw_mismatch, get_change_pw_match
+from access_control.access_control import UserRoles
+from api import api
+from availability.availability import query_claimable
+from conftest import get_user_login, get_change_pw_mismatch, get_change_pw_match, get_valid_user_auth_header, USER, \
+    ADMIN
+from db import model
+from db.model import TimeSlot, Appointment, User, Booking
+from export import export
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    # the in-mem test db is bound to a single connection, concurrent claims need a db every thread can open
+    db = SqliteDatabase(str(tmp_path / "termine.db"), timeout=30)
+    with db.bind_ctx(model.tables):
+        db.create_tables(model.tables)
+        yield db
+    db.close()
 
 
 def test_change_user_password_no_match(testing_db):
@@ -14,3 +39,154 @@ def test_change_user_password(testing_db):
     response = hug.test.patch(
         main, "/api/user", headers=get_user_login(), body=get_change_pw_match())
     assert response.status == hug.HTTP_200
+
+
+def test_change_user_password_keeps_coupons(testing_db):
+    # the user of the request comes from the user cache, a booking elsewhere used a coupon since
+    hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    User.update(coupons=0).where(User.user_name == USER).execute()
+    response = hug.test.patch(
+        main, "/api/user", headers=get_user_login(), body=get_change_pw_match())
+    assert response.status == hug.HTTP_200
+    assert User.get(User.user_name == USER).coupons == 0
+
+
+def test_concurrent_claims_get_distinct_appointments(file_db):
+    NUM_APPOINTMENTS = 10
+    NUM_CLAIMS = 30
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for _ in range(NUM_APPOINTMENTS):
+        Appointment.create(booked=False, time_slot=slot)
+    user = User.create(user_name="claimer", salt="", password="", role=UserRoles.USER, coupons=1)
+
+    def claim(_):
+        try:
+            return api.claim_appointment(file_db, start.isoformat(), user)
+        except hug.HTTPGone:
+            return None
+        finally:
+            file_db.close()
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        tokens = [token for token in pool.map(claim, range(NUM_CLAIMS)) if token]
+
+    assert len(tokens) == NUM_APPOINTMENTS
+    claimed = Appointment.select().where(Appointment.claim_token.is_null(False))
+    assert sorted(a.claim_token for a in claimed) == sorted(tokens)
+
+
+def test_claims_skip_locked_rows_on_postgres():
+    # the concurrent claims above run on sqlite, which serialises its writers and has no FOR UPDATE
+    start = datetime(2030, 4, 20, 8)
+    for db, skip_locked in [(PostgresqlExtDatabase("termine"), True), (SqliteDatabase(":memory:"), False)]:
+        for expired_claims in [False, True]:
+            claimable = query_claimable(start, datetime.now(), expired_claims, skip_locked=db.for_update)
+            query = Appointment.update(claim_token="token").where(Appointment.id.in_(claimable))
+            sql, _ = db.get_sql_context().sql(query).query()
+            assert ("FOR UPDATE SKIP LOCKED" in sql) == skip_locked
+
+
+def test_parallel_bookings_take_each_coupon_once(file_db):
+    NUM_COUPONS = 5
+    NUM_BOOKINGS = 20
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for i in range(NUM_BOOKINGS):
+        Appointment.create(booked=False, time_slot=slot, claim_token=f"claim{i}", claimed_at=datetime.now())
+    user = User.create(user_name="office", salt="", password="", role=UserRoles.USER, coupons=NUM_COUPONS)
+
+    def book(i):
+        body = {"claim_token": f"claim{i}", "start_date_time": start.isoformat(), "first_name": "Marianne",
+                "name": "Mustermann", "phone": "0123456789", "office": "MusterOffice"}
+        try:
+            return api.book_appointment(file_db, body, user)
+        except hug.HTTPBadRequest:
+            return None
+        finally:
+            file_db.close()
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        booked = [booking for booking in pool.map(book, range(NUM_BOOKINGS)) if booking]
+
+    assert len(booked) == NUM_COUPONS
+    assert User.get_by_id(user.id).coupons == 0
+    assert Booking.select().count() == NUM_COUPONS
+    # the turned away bookings left their claims alone
+    assert Appointment.select().where(Appointment.claim_token.is_null(False)).count() == NUM_BOOKINGS - NUM_COUPONS
+
+
+def _create_bookings(start, booked_by, count):
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for i in range(count):
+        Booking.create(surname="Mustermann", first_name="Marianne", phone="0123456789", office="MusterOffice",
+                       secret=f"SECRET{i}", booked_by=booked_by,
+                       appointment=Appointment.create(booked=True, time_slot=slot))
+
+
+def test_booked_only_lists_own_bookings(testing_db):
+    _create_bookings(datetime(2020, 4, 20, 10), USER, 2)
+    _create_bookings(datetime(2020, 4, 20, 10), ADMIN, 1)
+    response = hug.test.get(main, "/api/booked", headers=get_user_login(),
+                            start_date="2020-04-20", end_date="2020-04-20")
+    assert response.status == hug.HTTP_200
+    assert len(response.data) == 2
+    assert all(booking["booked_by"] == USER for booking in response.data)
+    response = hug.test.get(main, "/api/booked", headers=get_valid_user_auth_header(ADMIN, ADMIN),
+                            start_date="2020-04-20", end_date="2020-04-20")
+    assert len(response.data) == 3
+    response = hug.test.get(main, "/api/booked", headers=get_valid_user_auth_header(ADMIN, ADMIN),
+                            start_date="2020-04-21", end_date="2020-04-21")
+    assert response.data == []
+
+
+def test_booked_pagination(testing_db):
+    for hour in range(8, 13):
+        _create_bookings(datetime(2020, 4, 20, hour), USER, 3)
+    pages = []
+    after = None
+    while True:
+        params = {"start_date": "2020-04-20", "end_date": "2020-04-20", "limit": 4,
+                  "fields": "booking_id,start_date_time"}
+        if after:
+            params["after"] = after
+        response = hug.test.get(main, "/api/booked", headers=get_user_login(), **params)
+        assert response.status == hug.HTTP_200
+        pages.append(response.data)
+        after = response.headers_dict.get("X-Next-Cursor")
+        if not after:
+            break
+    assert [len(page) for page in pages] == [4, 4, 4, 3]
+    bookings = [booking for page in pages for booking in page]
+    assert all(set(booking.keys()) == {"booking_id", "start_date_time"} for booking in bookings)
+    assert len({booking["booking_id"] for booking in bookings}) == 15
+    assert [booking["start_date_time"] for booking in bookings] == \
+           sorted((booking["start_date_time"] for booking in bookings), reverse=True)
+
+
+def test_booked_unknown_field(testing_db):
+    response = hug.test.get(main, "/api/booked", headers=get_user_login(),
+                            start_date="2020-04-20", end_date="2020-04-20", fields="password")
+    assert response.status == hug.HTTP_400
+
+
+def test_list_for_day_csv(testing_db, monkeypatch):
+    monkeypatch.setattr(export, "CSV_CHUNK_SIZE", 10)
+    _create_bookings(datetime(2020, 4, 20, 10), USER, 3)
+    _create_bookings(datetime(2020, 4, 20, 11), ADMIN, 2)
+    # the evening before and the morning after stay out of the list
+    _create_bookings(datetime(2020, 4, 19, 18), USER, 1)
+    _create_bookings(datetime(2020, 4, 21, 0), USER, 1)
+    response = hug.test.get(main, "/api/list_for_day.csv", headers=get_user_login(), date_of_day="2020-04-20")
+    assert response.status == hug.HTTP_200
+    rows = list(csv.DictReader(io.StringIO(response.data)))
+    assert [row["secret"] for row in rows] == ["SECRET0", "SECRET1", "SECRET2"]
+    assert rows[0]["start_date_time"] == "2020-04-20 10:00:00"
+    response = hug.test.get(main, "/api/list_for_day.csv", headers=get_valid_user_auth_header(ADMIN, ADMIN),
+                            date_of_day="2020-04-20")
+    assert len(list(csv.DictReader(io.StringIO(response.data)))) == 5
+
+
+def test_list_for_day_csv_invalid_day(testing_db):
+    response = hug.test.get(main, "/api/list_for_day.csv", headers=get_user_login(), date_of_day="20.04.2020")
+    assert response.status == hug.HTTP_400
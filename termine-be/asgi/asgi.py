@@ -0,0 +1,137 @@
+"""
+An asgi entry point next to main:__hug_wsgi__, for when many clients poll at once:
+
+    uvicorn asgi.asgi:app --host 0.0.0.0 --port 8000 --workers 4
+
+/api/next_free_slots and /healthcheck are answered on the event loop, the queries of availability run through an
+asyncpg pool. Every other route, the rest of /api and /admin_api, /login, /config.js and the frontends, is the hug app
+of main.py, run by ASGI_THREADS threads with the peewee connections of DB_POOL, so a slow query or export holds a
+thread instead of a worker process.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import hug
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+
+import main
+from access_control.access_control import decode_token, user_cache
+from api.api import free_slots_response
+from availability.availability import free_slot_cache, query_free_slots, query_oldest_claim, claim_expiry, \
+    claim_reaper
+from config import config
+from db.async_db import AsyncDatabase
+from db.model import User
+from slot_codes.slot_codes import slot_code_supply
+
+log = logging.getLogger('asgi')
+
+async_db = AsyncDatabase(config.Db.url, config.Db.async_pool_max_connections)
+# one request of a worker reloads the free slots, the others wait for it. Made on startup, in the loop of the server.
+_reload_lock = None
+
+
+def json_response(data, status_code: int = 200, headers: dict = None) -> Response:
+    # the json output of hug, so both entry points answer alike
+    return Response(hug.output_format.json(data), status_code=status_code, headers=headers,
+                    media_type='application/json; charset=utf-8')
+
+
+def unauthorized(title: str, description: str) -> Response:
+    return json_response({"errors": {title: description}}, 401, {"WWW-Authenticate": 'token realm="simple"'})
+
+
+async def authenticate(request):
+    """the user of the login token like token_key_authentication, and the response to send instead if there is none"""
+    token = request.headers.get('Authorization')
+    if not token:
+        return None, unauthorized("Authentication Required", "Please provide valid Token verification credentials")
+    decoded = decode_token(token)
+    user = None
+    if decoded is not None:
+        user_name, expires_at = decoded
+        user = user_cache.cached(user_name)
+        if user is None:
+            rows = await async_db.fetch(User.select().where(User.user_name == user_name))
+            if rows:
+                user = User(**dict(rows[0]))
+                user_cache.store(user, expires_at)
+    if user is None:
+        return None, unauthorized("Invalid Authentication", "Provided Token verification credentials were invalid")
+    return user, None
+
+
+async def free_slots(now: datetime, limit: int):
+    """free_slot_cache.free_slots, loaded through the asyncpg pool"""
+    slots = free_slot_cache.cached(now, limit)
+    if slots is not None:
+        return slots
+    async with _reload_lock:
+        # loaded meanwhile by the request this one waited for
+        slots = free_slot_cache.cached(now, limit)
+        if slots is not None:
+            return slots
+        generation = free_slot_cache.generation
+        rows = await async_db.fetch(query_free_slots(now))
+        oldest_claim = query_oldest_claim(now)
+        next_claim_expiry = claim_expiry(await async_db.fetchval(oldest_claim)) if oldest_claim is not None else None
+        return free_slot_cache.store(rows, now, next_claim_expiry, limit, generation)
+
+
+async def next_free_slots(request):
+    """api.next_free_slots"""
+    user, response = await authenticate(request)
+    if response is not None:
+        return response
+    at_datetime = request.query_params.get('at_datetime')
+    if at_datetime is not None:
+        now = datetime.fromisoformat(at_datetime).replace(tzinfo=None)
+        slots = await async_db.fetch(query_free_slots(now).limit(config.Settings.num_display_slots))
+    else:
+        now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+        slots = await free_slots(now, config.Settings.num_display_slots)
+    return json_response(free_slots_response(slots, user))
+
+
+async def health_check(request):
+    return json_response("healthy")
+
+
+async def startup():
+    global _reload_lock
+    _reload_lock = asyncio.Lock()
+    await async_db.connect()
+    # the hug app starts them with its first request, the polled routes may well come first
+    claim_reaper.ensure_started()
+    slot_code_supply.ensure_started()
+
+
+async def shutdown():
+    await async_db.close()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup()
+    yield
+    await shutdown()
+
+
+ASYNC_PATHS = {'/api/next_free_slots', '/healthcheck'}
+routes = Starlette(routes=[
+    Route('/api/next_free_slots', next_free_slots),
+    Route('/healthcheck', health_check),
+], lifespan=lifespan)
+wsgi = WSGIMiddleware(main.__hug_wsgi__, workers=config.Settings.asgi_threads)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] not in ASYNC_PATHS:
+        await wsgi(scope, receive, send)
+    else:
+        await routes(scope, receive, send)
@@ -0,0 +1,113 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import hug
+import pytest
+from peewee import SqliteDatabase
+
+pytest.importorskip("starlette")
+pytest.importorskip("a2wsgi")
+
+import main
+from access_control.access_control import UserRoles, user_cache
+from asgi import asgi
+from availability.availability import free_slot_cache
+from conftest import get_user_login, get_invalid_login, USER
+from db.directives import PeeweeContext
+from db.model import TimeSlot, Appointment, User, db_proxy, tables
+
+
+class SyncDatabase:
+    """stands in for the asyncpg pool, runs the queries on the database of the test"""
+
+    def __init__(self):
+        self.queries = 0
+
+    async def connect(self):
+        pass
+
+    async def fetch(self, query) -> list:
+        self.queries += 1
+        return list(query.dicts())
+
+    async def fetchval(self, query):
+        self.queries += 1
+        return query.scalar()
+
+
+@pytest.fixture
+def async_db(tmp_path, monkeypatch):
+    # the hug app runs in the threads of a2wsgi, each with a connection of its own
+    db = SqliteDatabase(str(tmp_path / "termine.db"))
+    db_proxy.initialize(db)
+    db.create_tables(tables)
+    User.create(user_name=USER, salt="", password="", role=UserRoles.USER, coupons=10)
+    monkeypatch.setattr(PeeweeContext, "_cls_db", db)
+    stub = SyncDatabase()
+    monkeypatch.setattr(asgi, "async_db", stub)
+    user_cache.clear()
+    free_slot_cache.clear()
+    yield stub
+    db.close()
+
+
+def request(path: str, headers: dict = None, query_string: str = ""):
+    """one GET through asgi.app after its startup, the status and the decoded json of the response"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await asgi.startup()
+        await asgi.app({
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+            "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query_string.encode(),
+            "headers": [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+            "server": ("testserver", 80), "client": ("127.0.0.1", 4711),
+        }, receive, send)
+
+    asyncio.run(run())
+    status = next(message["status"] for message in messages if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return status, json.loads(body)
+
+
+def test_free_slots_on_the_event_loop(async_db):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for _ in range(3):
+        Appointment.create(booked=False, time_slot=slot)
+
+    status, data = request("/api/next_free_slots", get_user_login())
+    assert status == 200
+    assert data == hug.test.get(main, "/api/next_free_slots", headers=get_user_login()).data
+    assert data["slots"][0]["freeAppointments"] == 3
+    # the user and the free slots, the next request finds both cached
+    queries = async_db.queries
+    assert request("/api/next_free_slots", get_user_login())[0] == 200
+    assert async_db.queries == queries
+
+
+def test_unauthorized_like_hug(async_db):
+    for headers in [None, get_invalid_login()]:
+        status, data = request("/api/next_free_slots", headers)
+        response = hug.test.get(main, "/api/next_free_slots", headers=headers)
+        assert (status, data) == (401, response.data)
+
+
+def test_other_routes_run_the_hug_app(async_db):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    Appointment.create(booked=False, time_slot=slot)
+
+    assert request("/healthcheck") == (200, "healthy")
+    status, claim_token = request("/api/claim_appointment", get_user_login(),
+                                  f"start_date_time={start.isoformat()}")
+    assert status == 200
+    assert Appointment.get(Appointment.time_slot == slot).claim_token == claim_token
+    assert async_db.queries == 0
@@ -0,0 +1,448 @@
+"""Keeps the free appointment count per time slot in memory, so polling clients don't aggregate on every request"""
+import logging
+import threading
+import time
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from peewee import fn, Case, JOIN
+
+from config import config
+from db.directives import PeeweeContext
+from db.model import TimeSlot, Appointment, SlotCounter
+
+log = logging.getLogger('availability')
+
+
+def claim_expired_before(now: datetime) -> datetime:
+    return now - timedelta(minutes=config.Settings.claim_timeout_min)
+
+
+def claims_reaped() -> bool:
+    """
+    whether a claim reaper clears expired claims. Queries then only look for appointments without claim, an expired
+    claim stays taken until it is reaped.
+    """
+    return config.Settings.claim_reaper_interval_sec > 0
+
+
+def claim_counts_as_free(claimed_at: datetime, now: datetime) -> bool:
+    return not claims_reaped() and claimed_at < claim_expired_before(now)
+
+
+def _unclaimed(now: datetime):
+    if claims_reaped():
+        return Appointment.claim_token.is_null()
+    return Appointment.claim_token.is_null() | (Appointment.claimed_at < claim_expired_before(now))
+
+
+def _slot_range(now: datetime, start: datetime = None, end: datetime = None):
+    in_range = (TimeSlot.start_date_time > now) if start is None else (TimeSlot.start_date_time >= start)
+    if end is not None:
+        in_range &= (TimeSlot.start_date_time <= end)
+    return in_range
+
+
+def query_free_slots(now: datetime, start: datetime = None, end: datetime = None):
+    """
+    SELECT t.start_date_time, t.length_min, count(a.id)
+    FROM timeslot t
+             JOIN appointment a ON a.time_slot_id = t.id
+    WHERE NOT a.booked
+      AND (a.claim_token ISNULL OR a.claimed_at < NOW() - claim_timeout)
+      AND t.start_date_time > NOW()
+    GROUP BY t.start_date_time, t.length_min
+    ORDER BY t.start_date_time
+
+    the slots starting after now, or from start to end if given. Read from the slot counters if they are enabled.
+    """
+    if config.Settings.slot_counters:
+        return query_free_slots_from_counters(now, start, end)
+    # @formatter:off
+    return TimeSlot \
+        .select(TimeSlot.start_date_time, TimeSlot.length_min,
+                fn.count(Appointment.id).alias("free_appointments")) \
+        .join(Appointment) \
+        .where(
+            _slot_range(now, start, end) &
+            _unclaimed(now) &
+            (Appointment.booked == False)
+        ) \
+        .group_by(TimeSlot.start_date_time, TimeSlot.length_min) \
+        .order_by(TimeSlot.start_date_time)
+    # @formatter:on
+
+
+def query_free_slots_from_counters(now: datetime, start: datetime = None, end: datetime = None):
+    """
+    SELECT t.start_date_time, t.length_min, c.capacity - c.booked - c.claimed + (
+               SELECT count(a.id) FROM appointment a
+               WHERE a.time_slot_id = t.id AND NOT a.booked
+                 AND a.claim_token NOTNULL AND a.claimed_at < NOW() - claim_timeout) AS free_appointments
+    FROM timeslot t
+             JOIN slotcounter c ON c.time_slot_id = t.id
+    WHERE t.start_date_time > NOW()
+      AND free_appointments > 0
+    ORDER BY t.start_date_time
+
+    one row per time slot, read along the index on start_date_time. Expired claims still count as claimed until
+    they are released, the few of them are looked up per time slot unless a claim reaper clears them.
+    """
+    if claims_reaped():
+        free = SlotCounter.capacity - SlotCounter.booked - SlotCounter.claimed
+        return TimeSlot \
+            .select(TimeSlot.start_date_time, TimeSlot.length_min, free.alias("free_appointments")) \
+            .join(SlotCounter) \
+            .where(_slot_range(now, start, end) & (free > 0)) \
+            .order_by(TimeSlot.start_date_time)
+    Expired = Appointment.alias()
+    num_expired = Expired \
+        .select(fn.count(Expired.id)) \
+        .where((Expired.time_slot == TimeSlot.id) &
+               (Expired.booked == False) &
+               Expired.claim_token.is_null(False) &
+               (Expired.claimed_at < claim_expired_before(now)))
+    free = SlotCounter.capacity - SlotCounter.booked - SlotCounter.claimed + num_expired
+    return TimeSlot \
+        .select(TimeSlot.start_date_time, TimeSlot.length_min, free.alias("free_appointments")) \
+        .join(SlotCounter) \
+        .where(_slot_range(now, start, end) & (free > 0)) \
+        .order_by(TimeSlot.start_date_time)
+
+
+def query_claimable(start_date_time: datetime, now: datetime, expired_claims: bool = False, skip_locked: bool = False):
+    """
+    the id of one unclaimed appointment of the time slot starting at start_date_time, or of one with an expired claim.
+    With skip_locked, on postgres, concurrent claimers each lock a different row instead of queueing up behind the
+    same one.
+    """
+    if expired_claims:
+        claimable = Appointment.claim_token.is_null(False) & (Appointment.claimed_at < claim_expired_before(now))
+    else:
+        claimable = Appointment.claim_token.is_null()
+    query = Appointment.select(Appointment.id) \
+        .where(
+        (Appointment.time_slot.in_(
+            TimeSlot.select(TimeSlot.id).where(TimeSlot.start_date_time == start_date_time))) &
+        (Appointment.booked == False) &
+        claimable
+    ) \
+        .limit(1)
+    return query.for_update('FOR UPDATE SKIP LOCKED') if skip_locked else query
+
+
+def add_slot_counters(time_slot_ids, capacity: int, batch_size: int = 200):
+    """batch_size counters of 4 parameters per INSERT, below the 999 older sqlite versions allow"""
+    if config.Settings.slot_counters:
+        time_slot_ids = list(time_slot_ids)
+        for i in range(0, len(time_slot_ids), batch_size):
+            SlotCounter.insert_many([{"time_slot": time_slot_id, "capacity": capacity}
+                                     for time_slot_id in time_slot_ids[i:i + batch_size]]).execute()
+
+
+def update_slot_counter(time_slot, claimed: int = 0, booked: int = 0):
+    """
+    UPDATE slotcounter SET claimed = claimed + ?, booked = booked + ? WHERE time_slot_id = ?
+
+    time_slot is an id or a query selecting it, has to run in the transaction of the change it counts
+    """
+    if not config.Settings.slot_counters:
+        return
+    query = SlotCounter.update(claimed=SlotCounter.claimed + claimed, booked=SlotCounter.booked + booked)
+    if isinstance(time_slot, int):
+        query = query.where(SlotCounter.time_slot == time_slot)
+    else:
+        query = query.where(SlotCounter.time_slot.in_(time_slot))
+    if not query.execute():
+        log.warning("no slot counter for time slot %s, run reconcile_slot_counters", time_slot)
+
+
+def query_actual_counts():
+    """the slot counters as counted from the appointments"""
+    return TimeSlot \
+        .select(TimeSlot.id,
+                fn.count(Appointment.id).alias("capacity"),
+                fn.coalesce(fn.sum(Case(None, [(Appointment.booked == True, 1)], 0)), 0).alias("booked"),
+                fn.coalesce(fn.sum(Case(None, [((Appointment.booked == False) & Appointment.claim_token.is_null(False),
+                                                1)], 0)), 0).alias("claimed")) \
+        .join(Appointment, JOIN.LEFT_OUTER) \
+        .group_by(TimeSlot.id) \
+        .order_by(TimeSlot.id)
+
+
+def check_slot_counters(repair: bool, batch_size: int = 1000):
+    """
+    compares the slot counters with the appointments, and with repair sets the differing and missing ones to what
+    the appointments say. Returns the differences, as (time slot id, stored counts or None, actual counts).
+    """
+    stored = {counter.time_slot_id: (counter.capacity, counter.booked, counter.claimed)
+              for counter in SlotCounter.select()}
+    differences = []
+    for slot in query_actual_counts().namedtuples():
+        actual = (slot.capacity, slot.booked, slot.claimed)
+        if stored.get(slot.id) != actual:
+            differences.append((slot.id, stored.get(slot.id), actual))
+    if repair:
+        for i in range(0, len(differences), batch_size):
+            batch = differences[i:i + batch_size]
+            SlotCounter.delete().where(SlotCounter.time_slot.in_([time_slot_id for time_slot_id, _, _ in batch])) \
+                .execute()
+            SlotCounter.insert_many([{"time_slot": time_slot_id, "capacity": capacity, "booked": booked,
+                                      "claimed": claimed}
+                                     for time_slot_id, _, (capacity, booked, claimed) in batch]).execute()
+    return differences
+
+
+def query_oldest_claim(now: datetime):
+    """
+    SELECT min(claimed_at) FROM appointment
+    WHERE claim_token NOTNULL AND claimed_at >= NOW() - claim_timeout AND NOT booked
+
+    None if a claim reaper frees the claims, they are free once it ran, not at a point in time known in advance
+    """
+    if claims_reaped():
+        return None
+    return Appointment \
+        .select(fn.min(Appointment.claimed_at)) \
+        .where(
+            Appointment.claim_token.is_null(False) &
+            (Appointment.claimed_at >= claim_expired_before(now)) &
+            (Appointment.booked == False)
+        )
+
+
+def claim_expiry(claimed_at: datetime):
+    return claimed_at + timedelta(minutes=config.Settings.claim_timeout_min) if claimed_at is not None else None
+
+
+def query_next_claim_expiry(now: datetime):
+    """the point in time when the oldest running claim runs out and its appointment becomes free again"""
+    oldest_claim = query_oldest_claim(now)
+    return claim_expiry(oldest_claim.scalar()) if oldest_claim is not None else None
+
+
+class FreeSlotCache:
+    """
+    Free appointment counts of all upcoming time slots, loaded with one aggregate query.
+    Claims, bookings and cancellations made by this process adjust the counts in place once committed, see adjusting.
+    Changes made by other workers show up once the entry expires, after ttl_sec or as soon as the oldest running claim
+    times out.
+    """
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        # counted up by every change, a load that overlapped one is not kept, it may or may not include the change
+        self.generation = 0
+        self._lock = threading.Lock()
+        # one thread loads, the others wait for it instead of running the same query, the counts stay readable
+        self._reload_lock = threading.Lock()
+        self._slots = None
+        self._expires_at = None
+
+    def free_slots(self, now: datetime, limit: int):
+        slots = self.cached(now, limit)
+        if slots is not None:
+            return slots
+        if self.ttl_sec <= 0:
+            return self._to_list(self._load(now), now, limit)
+        with self._reload_lock:
+            # loaded meanwhile by the thread this one waited for
+            with self._lock:
+                if self._current(now):
+                    return self._to_list(self._slots, now, limit)
+            generation = self.generation
+            return self.store(query_free_slots(now).dicts(), now, query_next_claim_expiry(now), limit, generation)
+
+    def cached(self, now: datetime, limit: int):
+        """the free slots if they are loaded and current, None if they have to be loaded, see store"""
+        with self._lock:
+            if self.ttl_sec <= 0 or not self._current(now):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._to_list(self._slots, now, limit)
+
+    def store(self, rows, now: datetime, next_claim_expiry: datetime, limit: int, generation: int):
+        """
+        keeps the rows of query_free_slots(now), loaded since self.generation was generation, e.g. by the asgi app,
+        and returns the free slots from them
+        """
+        slots = self._collect(rows)
+        with self._lock:
+            if self.ttl_sec > 0 and generation == self.generation:
+                self._store(slots, now, next_claim_expiry)
+        return self._to_list(slots, now, limit)
+
+    def _current(self, now: datetime) -> bool:
+        return self._slots is not None and now < self._expires_at
+
+    def _store(self, slots, now: datetime, next_claim_expiry: datetime):
+        log.debug("loaded %d free slots", len(slots))
+        self._slots = slots
+        self._expires_at = now + timedelta(seconds=self.ttl_sec)
+        if next_claim_expiry is not None and next_claim_expiry < self._expires_at:
+            self._expires_at = next_claim_expiry
+
+    @contextmanager
+    def adjusting(self):
+        """
+        with free_slot_cache.adjusting() as adjust, db.atomic():
+            ...
+            adjust(start_date_time, -1)
+
+        the adjustments are made once the transaction committed, a rollback or an error drops them
+        """
+        adjustments = []
+        yield lambda start_date_time, delta: adjustments.append((start_date_time, delta))
+        for start_date_time, delta in adjustments:
+            self.update_slot(start_date_time, delta)
+
+    def update_slot(self, start_date_time: datetime, delta: int):
+        with self._lock:
+            self.generation += 1
+            if self._slots is None:
+                return
+            slot = self._slots.get(start_date_time)
+            if slot is None:
+                if delta > 0:
+                    # the slot had no free appointment when loaded, we don't know its length, so reload
+                    self._slots = None
+                return
+            slot["free_appointments"] = max(slot["free_appointments"] + delta, 0)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._slots = None
+            self._expires_at = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "ttl_sec": self.ttl_sec,
+                "cached_slots": len(self._slots) if self._slots is not None else 0,
+                "expires_at": self._expires_at if self._slots is not None else None,
+            }
+
+    @classmethod
+    def _load(cls, now: datetime):
+        return cls._collect(query_free_slots(now).dicts())
+
+    @staticmethod
+    def _collect(rows):
+        slots = OrderedDict()
+        for slot in rows:
+            if slot["start_date_time"] in slots:
+                # the slot counters list time slots starting at the same time one by one
+                slots[slot["start_date_time"]]["free_appointments"] += slot["free_appointments"]
+                continue
+            slots[slot["start_date_time"]] = {
+                "start_date_time": slot["start_date_time"],
+                "length_min": slot["length_min"],
+                "free_appointments": slot["free_appointments"],
+            }
+        return slots
+
+    @staticmethod
+    def _to_list(slots, now: datetime, limit: int):
+        upcoming = [slot for slot in slots.values() if slot["start_date_time"] > now and slot["free_appointments"] > 0]
+        return upcoming[:limit]
+
+
+free_slot_cache = FreeSlotCache(config.Settings.free_slots_cache_ttl_sec)
+
+
+def reap_expired_claims(db, now: datetime, batch_size: int) -> int:
+    """
+    UPDATE appointment SET claim_token = NULL, claimed_at = NULL
+    WHERE id IN (SELECT id FROM appointment
+                 WHERE claimed_at < NOW() - claim_timeout AND claim_token NOTNULL AND NOT booked
+                 LIMIT batch_size
+                 FOR UPDATE SKIP LOCKED)
+
+    one transaction per batch, until no expired claim is left. Returns the number of claims cleared.
+    """
+    reaped = 0
+    while True:
+        with db.atomic():
+            expired = Appointment.select(Appointment.id, Appointment.time_slot) \
+                .where((Appointment.claimed_at < claim_expired_before(now)) &
+                       Appointment.claim_token.is_null(False) &
+                       (Appointment.booked == False)) \
+                .limit(batch_size)
+            if db.for_update:
+                # another reaper or a booking holding one of the rows gets to keep it
+                expired = expired.for_update('FOR UPDATE SKIP LOCKED')
+            batch = list(expired.tuples())
+            if not batch:
+                break
+            Appointment.update(claim_token=None, claimed_at=None) \
+                .where(Appointment.id.in_([appointment_id for appointment_id, _ in batch])) \
+                .execute()
+            for time_slot_id, num_claims in Counter(time_slot_id for _, time_slot_id in batch).items():
+                update_slot_counter(time_slot_id, claimed=-num_claims)
+        reaped += len(batch)
+        if len(batch) < batch_size:
+            break
+    if reaped and claims_reaped():
+        # the reaped claims counted as taken until now
+        free_slot_cache.clear()
+    return reaped
+
+
+class ClaimReaper:
+    """runs reap_expired_claims every config.Settings.claim_reaper_interval_sec in a daemon thread of this process"""
+
+    def __init__(self):
+        self.runs = 0
+        self.reaped = 0
+        self.last_reaped = None
+        self.last_run_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        if self._thread is not None or not claims_reaped() or not config.Settings.claim_reaper_thread:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='claim-reaper', daemon=True)
+                self._thread.start()
+
+    def run_once(self, db) -> int:
+        now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+        reaped = reap_expired_claims(db, now, config.Settings.claim_reaper_batch_size)
+        self.runs += 1
+        self.reaped += reaped
+        self.last_reaped = reaped
+        self.last_run_at = now
+        log.info("reclaimed %d expired claims", reaped)
+        return reaped
+
+    def _run(self):
+        while True:
+            time.sleep(config.Settings.claim_reaper_interval_sec)
+            try:
+                self.run_once(PeeweeContext().db)
+            except Exception:
+                log.exception("reaping expired claims failed")
+            finally:
+                PeeweeContext.release_connection()
+
+    def stats(self):
+        return {
+            "enabled": claims_reaped(),
+            "thread": self._thread is not None,
+            "runs": self.runs,
+            "reaped": self.reaped,
+            "last_reaped": self.last_reaped,
+            "last_run_at": self.last_run_at,
+        }
+
+
+claim_reaper = ClaimReaper()
@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta
+
+import hug
+import pytest
+
+import main
+from availability.availability import free_slot_cache, check_slot_counters, query_free_slots
+from conftest import get_user_login
+from config import config
+from db.model import TimeSlot, Appointment, Booking
+from schedule.schedule import create_slots
+
+
+def _create_slot(start, num_appointments):
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for _ in range(num_appointments):
+        Appointment.create(booked=False, time_slot=slot)
+    return slot
+
+
+def _free_appointments():
+    response = hug.test.get(main, "/api/next_free_slots", headers=get_user_login())
+    assert response.status == hug.HTTP_200
+    return [slot["freeAppointments"] for slot in response.data["slots"]]
+
+
+def test_free_slots_are_cached(testing_db):
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    _create_slot(start, 3)
+    _create_slot(start + timedelta(minutes=10), 2)
+    assert _free_appointments() == [3, 2]
+    misses = free_slot_cache.misses
+    hits = free_slot_cache.hits
+    assert _free_appointments() == [3, 2]
+    assert free_slot_cache.misses == misses
+    assert free_slot_cache.hits == hits + 1
+
+
+def test_claims_update_the_cache(testing_db):
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    _create_slot(start, 2)
+    assert _free_appointments() == [2]
+    response = hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                            start_date_time=start.isoformat())
+    assert response.status == hug.HTTP_200
+    assert _free_appointments() == [1]
+    response = hug.test.delete(main, "/api/claim_token", headers=get_user_login(), claim_token=response.data)
+    assert response.status == hug.HTTP_200
+    assert _free_appointments() == [2]
+
+
+def test_rolled_back_changes_leave_the_cache_alone(testing_db):
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    _create_slot(start, 2)
+    assert _free_appointments() == [2]
+    with pytest.raises(ValueError):
+        with free_slot_cache.adjusting() as adjust_free_slots, testing_db.atomic():
+            Appointment.update(claim_token="token", claimed_at=datetime.now()).execute()
+            adjust_free_slots(start, -1)
+            raise ValueError("rolled back")
+    assert _free_appointments() == [2]
+
+
+def test_load_overlapping_a_change_is_not_kept(testing_db):
+    now = datetime.now()
+    generation = free_slot_cache.generation
+    free_slot_cache.update_slot(now + timedelta(days=1), -1)
+    free_slot_cache.store([], now, None, 10, generation)
+    assert free_slot_cache.cached(now, 10) is None
+    free_slot_cache.store([], now, None, 10, free_slot_cache.generation)
+    assert free_slot_cache.cached(now, 10) == []
+
+
+def test_cache_expires_with_oldest_claim(testing_db):
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    slot = _create_slot(start, 1)
+    now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+    claimed_at = now - timedelta(minutes=config.Settings.claim_timeout_min) + timedelta(seconds=1)
+    Appointment.update(claim_token="token", claimed_at=claimed_at).where(Appointment.time_slot == slot).execute()
+    misses = free_slot_cache.misses
+    assert free_slot_cache.free_slots(now, 10) == []
+    assert free_slot_cache.free_slots(now + timedelta(seconds=2), 10)[0]["free_appointments"] == 1
+    assert free_slot_cache.misses == misses + 2
+
+
+def _free_slots_both_ways(monkeypatch):
+    now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+    from_counters = [(slot.start_date_time, slot.free_appointments) for slot in query_free_slots(now)]
+    monkeypatch.setattr(config.Settings, "slot_counters", False)
+    from_appointments = [(slot.start_date_time, slot.free_appointments) for slot in query_free_slots(now)]
+    monkeypatch.setattr(config.Settings, "slot_counters", True)
+    assert from_counters == from_appointments
+    return [free for _, free in from_counters]
+
+
+def test_slot_counters_follow_claims_and_bookings(testing_db, monkeypatch):
+    monkeypatch.setattr(config.Settings, "slot_counters", True)
+    monkeypatch.setattr(free_slot_cache, "ttl_sec", 0)
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    create_slots(testing_db, [start, start + timedelta(minutes=10)], 10, 3)
+    assert _free_slots_both_ways(monkeypatch) == [3, 3]
+
+    claims = [hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                           start_date_time=start.isoformat()).data for _ in range(3)]
+    assert _free_slots_both_ways(monkeypatch) == [3]
+    hug.test.delete(main, "/api/claim_token", headers=get_user_login(), claim_token=claims[0])
+    response = hug.test.post(main, "/api/book_appointment", headers=get_user_login(), body={
+        "claim_token": claims[1], "start_date_time": start.isoformat(), "first_name": "Marianne",
+        "name": "Mustermann", "phone": "0123456789", "office": "MusterOffice"})
+    assert response.status == hug.HTTP_200
+    assert _free_slots_both_ways(monkeypatch) == [1, 3]
+
+    # an expired claim is free again, and taking it over doesn't count it twice
+    expired = datetime.now() - timedelta(minutes=config.Settings.claim_timeout_min + 1)
+    Appointment.update(claimed_at=expired).where(Appointment.claim_token == claims[2]).execute()
+    assert _free_slots_both_ways(monkeypatch) == [2, 3]
+    for _ in range(2):
+        assert hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                            start_date_time=start.isoformat()).status == hug.HTTP_200
+    assert _free_slots_both_ways(monkeypatch) == [3]
+
+    booking = Booking.get()
+    response = hug.test.delete(main, "/api/booking", headers=get_user_login(), booking_id=booking.id)
+    assert response.status == hug.HTTP_200
+    assert _free_slots_both_ways(monkeypatch) == [1, 3]
+    assert check_slot_counters(repair=False) == []
+
+
+def test_reconcile_slot_counters(testing_db, monkeypatch, capsys):
+    monkeypatch.setattr(config.Settings, "slot_counters", True)
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    create_slots(testing_db, [start], 10, 3)
+    slot = _create_slot(start + timedelta(minutes=10), 2)
+    assert check_slot_counters(repair=False) == [(slot.id, None, (2, 0, 0))]
+
+    hug.test.cli("reconcile_slot_counters", module="main")
+    assert "1 slot counter(s) differ" in capsys.readouterr().out
+    hug.test.cli("reconcile_slot_counters", for_real=True, module="main")
+    assert "Repaired 1 slot counter(s)" in capsys.readouterr().out
+    assert check_slot_counters(repair=False) == []
+    assert _free_slots_both_ways(monkeypatch) == [3, 2]
+
+
+def test_reaper_clears_expired_claims(testing_db, monkeypatch, capsys):
+    monkeypatch.setattr(config.Settings, "claim_reaper_interval_sec", 60)
+    monkeypatch.setattr(config.Settings, "claim_reaper_thread", False)
+    monkeypatch.setattr(config.Settings, "slot_counters", True)
+    monkeypatch.setattr(free_slot_cache, "ttl_sec", 0)
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    create_slots(testing_db, [start], 10, 3)
+    claims = [hug.test.get(main, "/api/claim_appointment", headers=get_user_login(),
+                           start_date_time=start.isoformat()).data for _ in range(2)]
+    expired = datetime.now() - timedelta(minutes=config.Settings.claim_timeout_min + 1)
+    Appointment.update(claimed_at=expired).where(Appointment.claim_token == claims[0]).execute()
+    # until it is reaped, the expired claim stays taken
+    assert _free_appointments() == [1]
+
+    hug.test.cli("reap_claims", module="main")
+    assert "Reclaimed 1 expired claim(s)." in capsys.readouterr().out
+    assert _free_appointments() == [2]
+    assert check_slot_counters(repair=False) == []
+
+    response = hug.test.post(main, "/api/book_appointment", headers=get_user_login(), body={
+        "claim_token": claims[0], "start_date_time": start.isoformat(), "first_name": "Marianne",
+        "name": "Mustermann", "phone": "0123456789", "office": "MusterOffice"})
+    assert response.status == hug.HTTP_410
+    hug.test.cli("reap_claims", module="main")
+    assert "Reclaimed 0 expired claim(s)." in capsys.readouterr().out
@@ -0,0 +1,79 @@
+"""
+Database queries and latencies of back office page loads, with and without the cache of verified Basic auth
+credentials. A page load is the index, its config.js and the first page of users, each sent with the credentials
+as the browser does.
+
+    python -m benchmark.admin_pages --pages 200
+"""
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from base64 import b64encode
+from datetime import date, timedelta
+
+import hug
+from falcon.testing import TestClient
+
+import main
+from access_control.access_control import credential_cache
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, BENCH_ADMIN
+from benchmark.user_cache import QueryCounter
+from db.directives import PeeweeContext
+from db.model import User
+from frontend_config.frontend_config import frontend_config_cache, save_frontend_config
+from password_hash.password_hash import encode_password
+
+PASSWORD = 'bench'
+PAGE = ['/admin/', '/admin/config.js', '/admin_api/user?limit=50']
+
+
+def run(client: TestClient, ttl_sec: int, pages: int, queries: QueryCounter) -> dict:
+    credential_cache.ttl_sec = ttl_sec
+    credential_cache.clear()
+    credential_cache.hits = credential_cache.misses = 0
+    frontend_config_cache.clear()
+    auth = 'Basic ' + b64encode(f'{BENCH_ADMIN}:{PASSWORD}'.encode('utf-8')).decode('utf-8')
+    timings = []
+    queries.reset()
+    for _ in range(pages):
+        started = time.perf_counter()
+        for path in PAGE:
+            url, _, query_string = path.partition('?')
+            response = client.simulate_get(url, query_string=query_string, headers={'Authorization': auth})
+            assert response.status == hug.HTTP_200, (path, response.status)
+        timings.append(time.perf_counter() - started)
+    return {
+        'ttl_sec': ttl_sec,
+        'median_page_ms': round(statistics.median(timings) * 1000, 2),
+        'queries_per_page': queries.reset() / pages,
+        'credential_cache': credential_cache.stats(),
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument('--pages', type=int, default=200)
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    seed(db, date.today() + timedelta(days=1), args.days, args.slots_per_day, args.appointments_per_slot,
+         booked_ratio=args.booked_ratio, num_users=args.num_users)
+    User.update(salt='', password=encode_password(PASSWORD)).where(User.user_name == BENCH_ADMIN).execute()
+    save_frontend_config({})
+    PeeweeContext._cls_db = db
+    queries = QueryCounter(db)
+    with tempfile.TemporaryDirectory() as build:
+        with open(f'{build}/index.html', 'w') as f:
+            f.write('<html></html>')
+        main.admin_statics.directories = [build]
+        client = TestClient(hug.API(main).http.server())
+        results = [run(client, ttl_sec, args.pages, queries) for ttl_sec in (0, 10)]
+    print(json.dumps({'benchmark': 'admin_pages', 'requests_per_page': len(PAGE), 'runs': results}, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,88 @@
+"""
+Latencies and database queries of GET /admin_api/user with 100k users, for the whole list at once and for pages
+by offset, by cursor, by name prefix, by role and sorted by the number of bookings.
+
+    python -m benchmark.admin_users --num_users 100000
+"""
+import argparse
+import json
+import statistics
+import time
+from base64 import b64encode
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+import hug
+from falcon.testing import TestClient
+
+import main
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, BENCH_ADMIN
+from benchmark.user_cache import QueryCounter
+from db.directives import PeeweeContext
+from db.model import User
+from password_hash.password_hash import encode_password
+
+PASSWORD = 'bench'
+
+
+def requests(deep_offset: int):
+    deep_user = User.select(User.user_name, User.role).order_by(User.role.desc(), User.user_name) \
+        .offset(deep_offset - 1).limit(1)[0]
+    return {
+        'whole_list': {},
+        'first_page': {'limit': 50},
+        'deep_page_by_offset': {'limit': 50, 'offset': deep_offset},
+        'deep_page_by_cursor': {'limit': 50, 'after': f"{deep_user.role},{deep_user.user_name}"},
+        'prefix_search': {'limit': 50, 'search': 'bench-user-99'},
+        'role_filter': {'limit': 50, 'role': 'admin'},
+        'names_only': {'limit': 50, 'fields': 'user_name'},
+        'sorted_by_bookings': {'limit': 50, 'sort': '-total_bookings'},
+    }
+
+
+def measure(client: TestClient, params: dict, repeat: int, queries: QueryCounter) -> dict:
+    auth = 'Basic ' + b64encode(f'{BENCH_ADMIN}:{PASSWORD}'.encode('utf-8')).decode('utf-8')
+    timings = []
+    queries.reset()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        # encoded by urlencode, the test client would leave the commas of a cursor as they are
+        response = client.simulate_get('/admin_api/user', query_string=urlencode(params),
+                                       headers={'Authorization': auth})
+        timings.append(time.perf_counter() - started)
+        assert response.status == hug.HTTP_200, response.status
+    return {
+        'params': params,
+        'users': len(response.json),
+        'median_ms': round(statistics.median(timings) * 1000, 2),
+        'queries_per_request': queries.reset() / repeat,
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.set_defaults(num_users=100000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    started = time.perf_counter()
+    seed(db, date.today() + timedelta(days=1), args.days, args.slots_per_day, args.appointments_per_slot,
+         booked_ratio=args.booked_ratio, num_users=args.num_users)
+    User.update(salt='', password=encode_password(PASSWORD)).where(User.user_name == BENCH_ADMIN).execute()
+    seed_sec = time.perf_counter() - started
+    db.execute_sql('ANALYZE')
+    PeeweeContext._cls_db = db
+    queries = QueryCounter(db)
+    # the wsgi app is built once, hug.test would rebuild its router on every request
+    client = TestClient(hug.API(main).http.server())
+    results = {name: measure(client, params, 1 if name == 'whole_list' else args.repeat, queries)
+               for name, params in requests(args.num_users // 2).items()}
+    print(json.dumps({'benchmark': 'admin_users', 'users': User.select().count(), 'seed_sec': round(seed_sec, 1),
+                      'requests': results}, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,78 @@
+"""
+Load test of the booking flow in one process: seeds a calendar, then concurrent virtual users poll
+/api/next_free_slots and now and then claim and book an appointment through /api/claim_appointment and
+/api/book_appointment, see benchmark.load. Reports p50/p95/p99 latency, requests per second and database queries per
+request of each endpoint, as json to compare between versions:
+
+    python -m benchmark.booking_flow > before.json
+    python -m benchmark.booking_flow --users 100 --duration_sec 60 --db_url postgresql://... > after.json
+
+The app runs in the threads of the users, as with one worker of a threaded server without the http overhead, which
+benchmark.serving measures with real servers.
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+from datetime import date, timedelta
+
+import hug
+import jwt
+from falcon.testing import TestClient
+
+import main
+from benchmark.load import WsgiClient, run_load
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, user_names
+from benchmark.user_cache import QueryCounter
+from config import config
+from db.directives import PeeweeContext
+
+
+def commit() -> str:
+    """the git commit of the tree under test, if there is one"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument('--users', type=int, default=50, help='concurrent virtual users')
+    parser.add_argument('--duration_sec', type=float, default=20)
+    parser.add_argument('--think_ms', type=float, default=0, help='mean pause of a user between two polls')
+    parser.add_argument('--book_ratio', type=float, default=0.1, help='share of the polls followed by a booking')
+    args = parser.parse_args()
+    # main logs to stdout, which is left to the json
+    for handler in logging.getLogger().handlers:
+        handler.setStream(sys.stderr)
+    db = open_db(args.db_url, args.db_path)
+    seed(db, date.today() + timedelta(days=1), args.days, args.slots_per_day, args.appointments_per_slot,
+         booked_ratio=args.booked_ratio, num_users=args.num_users)
+    PeeweeContext._cls_db = db
+    queries = QueryCounter(db)
+    tokens = [jwt.encode({'user': name}, config.Settings.jwt_key, algorithm='HS256')
+              for name in user_names(args.num_users)]
+    # the wsgi app is built once, hug.test would rebuild its router on every request
+    client = TestClient(hug.API(main).http.server())
+    queries.reset()
+    result = run_load(lambda: WsgiClient(client), tokens, args.users, args.duration_sec, args.book_ratio,
+                      args.think_ms / 1000, thread_queries=queries.in_thread)
+    # including those of the background threads
+    result['queries'] = queries.reset()
+    print(json.dumps({
+        'benchmark': 'booking_flow', 'commit': commit(), 'database': type(db).__name__,
+        'calendar': {'days': args.days, 'slots_per_day': args.slots_per_day,
+                     'appointments_per_slot': args.appointments_per_slot, 'booked_ratio': args.booked_ratio,
+                     'users': len(tokens)},
+        'think_ms': args.think_ms, 'book_ratio': args.book_ratio, **result,
+    }, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,110 @@
+"""
+Compares the former, fully buffered /api/list_for_day.csv export with the streaming one. Each path runs in a
+subprocess of its own, so the peak RSS of one doesn't hide the other.
+
+    python -m benchmark.csv_export --days 1 --slots_per_day 200 --appointments_per_slot 100
+"""
+import argparse
+import csv
+import io
+import json
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from peewee import DoesNotExist
+
+from access_control.access_control import UserRoles
+from api.api import ChunkStream, bookings_for_day_csv
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, BENCH_ADMIN
+from db.model import TimeSlot, Appointment, Booking, User
+
+DAY = date(2021, 3, 1)
+
+
+def legacy_list_for_day(user, requested_day_object: date):
+    """the export as it was before it streamed, one query per time slot, appointment and booking"""
+    result = io.StringIO()
+    writer = csv.DictWriter(result,
+                            fieldnames=['start_date_time', 'first_name', 'surname', 'phone', 'office', 'secret',
+                                        'booked_by'])
+    writer.writeheader()
+    for timeslot in TimeSlot.select().where(
+            (TimeSlot.start_date_time > requested_day_object - timedelta(days=1)) &
+            (TimeSlot.start_date_time < requested_day_object + timedelta(days=1))):
+        for appointment in Appointment.select().where(
+                (Appointment.time_slot == timeslot) & (Appointment.booked == True)):
+            try:
+                booking = Booking.get(Booking.appointment == appointment)
+                if user.role != UserRoles.ADMIN:
+                    booking = Booking.select().where((Booking.appointment == appointment) &
+                                                     (Booking.booked_by == user.user_name)).get()
+                writer.writerow({'start_date_time': timeslot.start_date_time, 'first_name': booking.first_name,
+                                 'surname': booking.surname, 'phone': booking.phone, 'office': booking.office,
+                                 'secret': booking.secret, 'booked_by': booking.booked_by})
+            except DoesNotExist:
+                pass
+    return io.BytesIO(result.getvalue().encode('utf8'))
+
+
+def measure(path: str, db) -> dict:
+    user = User.get(User.user_name == BENCH_ADMIN)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    started = time.perf_counter()
+    if path == 'legacy':
+        stream = legacy_list_for_day(user, DAY)
+    else:
+        stream = ChunkStream(bookings_for_day_csv(db, user, DAY))
+    first_byte = None
+    size = 0
+    while True:
+        chunk = stream.read(8192)
+        if not chunk:
+            break
+        if first_byte is None:
+            first_byte = time.perf_counter()
+        size += len(chunk)
+    finished = time.perf_counter()
+    _, peak_heap = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'path': path,
+        'bytes': size,
+        'time_to_first_byte_ms': round((first_byte - started) * 1000, 2),
+        'total_ms': round((finished - started) * 1000, 2),
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_python_heap_kb': peak_heap // 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument('--path', choices=['legacy', 'streaming'], help='measure only this path in this process')
+    args = parser.parse_args()
+    if args.path:
+        db = open_db(args.db_url, args.db_path)
+        print(json.dumps(measure(args.path, db)))
+        return
+    db = open_db(args.db_url, args.db_path)
+    seed(db, DAY, args.days, args.slots_per_day, args.appointments_per_slot, booked_ratio=args.booked_ratio,
+         num_users=args.num_users)
+    db_args = ['--db_url', args.db_url] if args.db_url else ['--db_path', db.database]
+    results = []
+    for path in ['legacy', 'streaming']:
+        out = subprocess.run([sys.executable, '-m', 'benchmark.csv_export', '--path', path] + db_args,
+                             check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print(json.dumps({'benchmark': 'csv_export', 'bookings': Booking.select().count(), 'results': results},
+                     indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main()
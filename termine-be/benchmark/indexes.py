@@ -0,0 +1,103 @@
+"""
+Query plans and latencies of the hot queries without and with the indexes of migration level 7, on a database of a
+few million appointments. The default takes a while to seed, pass fewer --days for a quick look.
+
+    python -m benchmark.indexes --days 365 --slots_per_day 36 --appointments_per_slot 200
+"""
+import argparse
+import json
+import statistics
+import time
+from datetime import date, datetime, timedelta
+
+from peewee import SqliteDatabase
+
+from access_control.access_control import UserRoles
+from availability.availability import query_free_slots, query_claimable
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, BENCH_USER
+from db.migration import level_7
+from db.model import TimeSlot, Appointment, Booking, User, Migration
+from export.export import bookings_csv_query
+
+START_DAY = date(2021, 1, 1)
+# created by level 7, the indexes of the foreign keys existed before
+LEVEL_7_INDEXES = ['timeslot_start_date_time', 'appointment_time_slot_id_booked_claim_token', 'appointment_free',
+                   'booking_booked_by', 'booking_booked_at']
+
+
+def hot_queries(days: int):
+    now = datetime.combine(START_DAY + timedelta(days=days // 2), datetime.min.time()) + timedelta(hours=12)
+    day = now.date()
+    user = User(user_name=BENCH_USER, role=UserRoles.USER)
+    admin = User(user_name='admin', role=UserRoles.ADMIN)
+    return {
+        'next_free_slots': query_free_slots(now).limit(150),
+        'claim_appointment': query_claimable(now + timedelta(hours=1), now),
+        'list_for_day': bookings_csv_query(admin).where(
+            (TimeSlot.start_date_time > day - timedelta(days=1)) & (TimeSlot.start_date_time < day + timedelta(days=1))),
+        'booked_by_user': bookings_csv_query(user).where(
+            (TimeSlot.start_date_time >= day) & (TimeSlot.start_date_time < day + timedelta(days=1))),
+        'bookings_created_at': Booking.select().where(
+            Booking.booked_at.between(now - timedelta(days=1), now)),
+    }
+
+
+def explain(db, query) -> list:
+    sql, params = query.sql()
+    prefix = 'EXPLAIN QUERY PLAN ' if isinstance(db, SqliteDatabase) else 'EXPLAIN '
+    return [' '.join(str(column) for column in row) for row in db.execute_sql(prefix + sql, params).fetchall()]
+
+
+def measure(db, queries, repeat: int) -> dict:
+    results = {}
+    for name, query in queries.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            rows = len(list(query.clone().tuples()))
+            timings.append(time.perf_counter() - started)
+        results[name] = {
+            'rows': rows,
+            'median_ms': round(statistics.median(timings) * 1000, 3),
+            'plan': explain(db, query),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.set_defaults(days=365, slots_per_day=36, appointments_per_slot=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    started = time.perf_counter()
+    seed(db, START_DAY, args.days, args.slots_per_day, args.appointments_per_slot, booked_ratio=args.booked_ratio,
+         num_users=args.num_users)
+    seed_sec = time.perf_counter() - started
+    for index in LEVEL_7_INDEXES:
+        db.execute_sql(f'DROP INDEX IF EXISTS "{index}"')
+    db.execute_sql('ANALYZE')
+    queries = hot_queries(args.days)
+    before = measure(db, queries, args.repeat)
+
+    started = time.perf_counter()
+    level_7(db, Migration.create(version=6))
+    index_sec = time.perf_counter() - started
+    db.execute_sql('ANALYZE')
+    after = measure(db, queries, args.repeat)
+
+    print(json.dumps({
+        'benchmark': 'indexes',
+        'appointments': Appointment.select().count(),
+        'bookings': Booking.select().count(),
+        'seed_sec': round(seed_sec, 1),
+        'create_indexes_sec': round(index_sec, 1),
+        'queries': {name: {'before': before[name], 'after': after[name]} for name in queries},
+    }, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main()
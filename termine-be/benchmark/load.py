@@ -0,0 +1,152 @@
+"""
+Virtual users for the load tests. Each one polls the free slots like the frontend does, and now and then claims an
+appointment of a slot with free ones and books it, until the time is up. Latencies are recorded per operation, and
+the database queries a request ran when it is served in the thread of the user, see WsgiClient.
+"""
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import quote
+
+BOOKING = {'first_name': 'Marianne', 'name': 'Mustermann', 'phone': '0123456789', 'office': 'Musterbehörde'}
+
+
+class HttpClient:
+    """requests to a running server over a keep-alive connection of its own, reopened when the server closed it"""
+
+    def __init__(self, host: str, port: int, timeout: float = 30):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def __call__(self, method: str, path: str, body: dict = None, headers: dict = None):
+        """the status and the decoded json of the response"""
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body=data, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (http.client.HTTPException, ConnectionError):
+            self.connection.close()
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+        return response.status, json.loads(content) if content else None
+
+    def close(self):
+        self.connection.close()
+
+
+class WsgiClient:
+    """requests to the hug app in the calling thread, through a falcon TestClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, method: str, path: str, body: dict = None, headers: dict = None):
+        path, _, query_string = path.partition('?')
+        response = self.client.simulate_request(method, path, query_string=query_string, headers=headers, json=body)
+        return response.status_code, response.json if response.content else None
+
+
+class Recorder:
+    """latencies and statuses per operation, and with thread_queries, the queries of the calling thread so far, the
+    queries per request"""
+
+    def __init__(self, thread_queries=None):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._statuses = defaultdict(Counter)
+        self._queries = Counter()
+        self.thread_queries = thread_queries
+
+    def timed(self, operation: str, request):
+        queries = self.thread_queries() if self.thread_queries else 0
+        started = time.perf_counter()
+        try:
+            status, data = request()
+        except (http.client.HTTPException, OSError):
+            status, data = 'failed', None
+        latency = time.perf_counter() - started
+        if self.thread_queries:
+            queries = self.thread_queries() - queries
+        with self._lock:
+            self._latencies[operation].append(latency)
+            self._statuses[operation][str(status)] += 1
+            self._queries[operation] += queries
+        return status, data
+
+    def report(self, elapsed: float) -> dict:
+        with self._lock:
+            operations = {operation: {
+                'requests': len(latencies),
+                'per_sec': round(len(latencies) / elapsed, 1),
+                'statuses': dict(self._statuses[operation]),
+                **percentiles(latencies),
+            } for operation, latencies in self._latencies.items()}
+            if self.thread_queries:
+                for operation, report in operations.items():
+                    report['queries_per_request'] = round(self._queries[operation] / report['requests'], 2)
+        requests = sum(operation['requests'] for operation in operations.values())
+        return {'requests': requests, 'requests_per_sec': round(requests / elapsed, 1), 'operations': operations}
+
+
+def percentiles(latencies) -> dict:
+    ordered = sorted(latencies)
+    return {f'p{p}_ms': round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000, 2)
+            for p in (50, 95, 99)} if ordered else {}
+
+
+def virtual_user(client, token: str, deadline: float, book_ratio: float, think_sec: float, rnd: random.Random,
+                 recorder: Recorder):
+    auth = {'Authorization': token}
+    while time.monotonic() < deadline:
+        if think_sec:
+            # spread out, so the users don't poll in lockstep
+            time.sleep(rnd.uniform(0.5, 1.5) * think_sec)
+        status, free_slots = recorder.timed('next_free_slots', lambda: client('GET', '/api/next_free_slots',
+                                                                              headers=auth))
+        if status != 200 or rnd.random() >= book_ratio:
+            continue
+        slots = [slot for slot in free_slots['slots'] if slot['freeAppointments'] > 0]
+        if not slots:
+            continue
+        start_date_time = rnd.choice(slots)['startDateTime']
+        status, claim_token = recorder.timed('claim_appointment', lambda: client(
+            'GET', f'/api/claim_appointment?start_date_time={quote(start_date_time)}', headers=auth))
+        if status != 200:
+            continue
+        recorder.timed('book_appointment', lambda: client(
+            'POST', '/api/book_appointment', headers=auth,
+            body={'claim_token': claim_token, 'start_date_time': start_date_time, **BOOKING}))
+
+
+def run_load(make_client, tokens, num_users: int, duration_sec: float, book_ratio: float, think_sec: float,
+             seed: int = 4711, thread_queries=None) -> dict:
+    """num_users virtual users with clients of make_client and the login tokens taken in turn from tokens"""
+    recorder = Recorder(thread_queries)
+    deadline = time.monotonic() + duration_sec
+
+    def run(i):
+        client = make_client()
+        try:
+            virtual_user(client, tokens[i % len(tokens)], deadline, book_ratio, think_sec, random.Random(seed + i),
+                         recorder)
+        finally:
+            close = getattr(client, 'close', None)
+            if close:
+                close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(num_users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'virtual_users': num_users, 'duration_sec': round(time.perf_counter() - started, 1),
+            **recorder.report(time.perf_counter() - started)}
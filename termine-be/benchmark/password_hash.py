@@ -0,0 +1,57 @@
+"""
+Milliseconds per password check and checks per second of a worker for a range of PBKDF2 iterations and scrypt
+costs, to pick PASSWORD_HASHER and its cost for the hardware at hand: the most expensive setting that stays below
+--target_ms per login is suggested.
+
+    python -m benchmark.password_hash --target_ms 100 --threads 2
+"""
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from password_hash.password_hash import Pbkdf2Hasher, ScryptHasher, encode_password, password_matches
+
+PASSWORD = 'correct horse battery staple'
+CANDIDATES = [Pbkdf2Hasher(i=iterations) for iterations in (50000, 100000, 200000, 400000, 600000)] + \
+             [ScryptHasher(n=n, r=8, p=1) for n in (2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16)]
+
+
+def measure(hasher, repeat: int, threads: int) -> dict:
+    hashed = encode_password(PASSWORD, hasher)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        assert password_matches('bench', '', PASSWORD, hashed)
+        timings.append(time.perf_counter() - started)
+    # as many checks at once as the hashing pool of a worker runs
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        started = time.perf_counter()
+        assert all(pool.map(lambda _: password_matches('bench', '', PASSWORD, hashed), range(repeat * threads)))
+        elapsed = time.perf_counter() - started
+    return {
+        'hasher': hasher.scheme,
+        'parameters': hasher.parameters,
+        'median_ms': round(statistics.median(timings) * 1000, 1),
+        'checks_per_sec': round(repeat * threads / elapsed, 1),
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target_ms', type=float, default=100)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    results = [measure(hasher, args.repeat, args.threads) for hasher in CANDIDATES]
+    suggested = {}
+    for result in results:
+        if result['median_ms'] <= args.target_ms:
+            suggested[result['hasher']] = result['parameters']
+    print(json.dumps({'benchmark': 'password_hash', 'target_ms': args.target_ms, 'threads': args.threads,
+                      'results': results, 'suggested': suggested}, indent=2))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,90 @@
+"""Seeds a database with a test center calendar for the benchmarks"""
+import argparse
+import os
+import random
+import tempfile
+from datetime import date, datetime, timedelta
+
+from peewee import SqliteDatabase
+from playhouse.db_url import parse
+from playhouse.postgres_ext import PostgresqlExtDatabase
+
+from access_control.access_control import UserRoles
+from db.model import db_proxy, tables, TimeSlot, Appointment, Booking, User
+
+BENCH_ADMIN = 'bench-admin'
+BENCH_USER = 'bench-user'
+
+
+def add_db_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--db_url', help='postgres url to seed into, an empty database is expected '
+                                         '(default: a new sqlite file)')
+    parser.add_argument('--db_path', help='existing sqlite file, used by the benchmark subprocesses')
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--slots_per_day', type=int, default=26)
+    parser.add_argument('--appointments_per_slot', type=int, default=8)
+    parser.add_argument('--booked_ratio', type=float, default=0.8)
+    parser.add_argument('--num_users', type=int, default=50)
+
+
+def open_db(db_url: str = None, db_path: str = None):
+    """binds the models to the postgres database at db_url, to the sqlite file at db_path or to a new sqlite file"""
+    if db_url:
+        db = PostgresqlExtDatabase(**parse(db_url))
+    else:
+        if not db_path:
+            handle, db_path = tempfile.mkstemp(prefix='termine-bench-', suffix='.db')
+            os.close(handle)
+        db = SqliteDatabase(db_path, timeout=30, pragmas={'journal_mode': 'wal', 'synchronous': 'off'})
+    db_proxy.initialize(db)
+    return db
+
+
+def discard_db(db):
+    """removes a sqlite file created by open_db, postgres databases are left alone"""
+    db.close()
+    if isinstance(db, SqliteDatabase):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(db.database + suffix):
+                os.remove(db.database + suffix)
+
+
+def user_names(num_users: int):
+    return [BENCH_ADMIN, BENCH_USER] + [f'bench-user-{i}' for i in range(num_users)]
+
+
+def seed(db, start_day: date, days: int, slots_per_day: int = 26, appointments_per_slot: int = 8,
+         slot_duration_min: int = 20, booked_ratio: float = 0.8, num_users: int = 50, batch_size: int = 500):
+    """creates the tables and fills them with days of time slots, appointments and bookings, reproducibly"""
+    rnd = random.Random(4711)
+    names = user_names(num_users)
+    db.create_tables(tables)
+    with db.atomic():
+        for i in range(0, len(names), batch_size):
+            User.insert_many([{
+                'user_name': name, 'salt': '', 'password': '', 'coupons': 1000,
+                'role': UserRoles.ADMIN if name == BENCH_ADMIN else UserRoles.USER,
+            } for name in names[i:i + batch_size]]).execute()
+    for day in range(days):
+        day_start = datetime.combine(start_day + timedelta(days=day), datetime.min.time()) + timedelta(hours=8)
+        with db.atomic():
+            TimeSlot.insert_many([{
+                'start_date_time': day_start + timedelta(minutes=slot * slot_duration_min),
+                'length_min': slot_duration_min,
+            } for slot in range(slots_per_day)]).execute()
+            slot_ids = [slot.id for slot in TimeSlot.select(TimeSlot.id).where(TimeSlot.slot_date == day_start.date())]
+            appointments = [{'time_slot': slot_id, 'booked': rnd.random() < booked_ratio}
+                            for slot_id in slot_ids for _ in range(appointments_per_slot)]
+            for i in range(0, len(appointments), batch_size):
+                Appointment.insert_many(appointments[i:i + batch_size]).execute()
+            booked = Appointment.select(Appointment.id).where(
+                Appointment.time_slot.in_(slot_ids) & (Appointment.booked == True))
+            bookings = [{
+                'appointment': appointment.id, 'surname': f'Surname {appointment.id}', 'first_name': 'Firstname',
+                'phone': '0123456789', 'street': 'Musterstraße', 'street_number': '1', 'post_code': '80331',
+                'city': 'München', 'birthday': date(1970, 1, 1) + timedelta(days=rnd.randrange(15000)),
+                'reason': 'Kontaktperson', 'office': 'Musterbehörde', 'secret': f'A-{appointment.id:05}',
+                'booked_by': rnd.choice(names), 'booked_at': day_start - timedelta(days=1),
+            } for appointment in booked]
+            for i in range(0, len(bookings), batch_size):
+                Booking.insert_many(bookings[i:i + batch_size]).execute()
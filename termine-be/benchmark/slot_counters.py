@@ -0,0 +1,77 @@
+"""
+Reads the free slots once by counting appointment rows and once from the slot counters, on a calendar of 10k+ time
+slots with some running and some expired claims.
+
+    python -m benchmark.slot_counters --days 400 --slots_per_day 26
+"""
+import argparse
+import json
+import statistics
+import time
+from datetime import date, datetime, timedelta
+
+from availability.availability import query_free_slots, check_slot_counters
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db
+from config import config
+from db.model import TimeSlot, Appointment
+
+START_DAY = date(2021, 1, 1)
+
+
+def add_claims(now: datetime, every: int):
+    """claims every nth free appointment, half of the claims expired"""
+    expired_at = now - timedelta(minutes=config.Settings.claim_timeout_min + 1)
+    free = [appointment.id for appointment in Appointment.select(Appointment.id).where(Appointment.booked == False)]
+    running = free[::every * 2]
+    expired = free[every::every * 2]
+    Appointment.update(claim_token='running', claimed_at=now).where(Appointment.id.in_(running)).execute()
+    Appointment.update(claim_token='expired', claimed_at=expired_at).where(Appointment.id.in_(expired)).execute()
+
+
+def measure(now: datetime, limit: int, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        slots = list(query_free_slots(now).limit(limit).tuples())
+        timings.append(time.perf_counter() - started)
+    return slots, round(statistics.median(timings) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.set_defaults(days=400, slots_per_day=26)
+    parser.add_argument('--claim_every', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    seed(db, START_DAY, args.days, args.slots_per_day, args.appointments_per_slot, booked_ratio=args.booked_ratio,
+         num_users=args.num_users)
+    now = datetime.combine(START_DAY, datetime.min.time())
+    with db.atomic():
+        add_claims(now, args.claim_every)
+        check_slot_counters(repair=True)
+    db.execute_sql('ANALYZE')
+
+    results = []
+    for limit in [config.Settings.num_display_slots, args.days * args.slots_per_day]:
+        result = {'limit': limit}
+        for read_path, enabled in [('appointments', False), ('slot_counters', True)]:
+            config.Settings.slot_counters = enabled
+            slots, result[read_path + '_median_ms'] = measure(now, limit, args.repeat)
+            result.setdefault('slots', len(slots))
+            assert result.setdefault('result', slots) == slots, 'the read paths disagree'
+        del result['result']
+        results.append(result)
+    print(json.dumps({
+        'benchmark': 'slot_counters',
+        'time_slots': TimeSlot.select().count(),
+        'appointments': Appointment.select().count(),
+        'results': results,
+    }, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main()
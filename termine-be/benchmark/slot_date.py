@@ -0,0 +1,77 @@
+"""
+Day-scoped queries on a multi-year calendar, as range scans on timeslot.start_date_time and as lookups on the
+slot_date column of migration level 9. The old list_for_day window reached back into the day before, compare the rows.
+
+    python -m benchmark.slot_date --days 1095
+"""
+import argparse
+import json
+import time
+from datetime import date, datetime, timedelta
+
+from access_control.access_control import UserRoles
+from benchmark.indexes import measure
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db
+from db.model import TimeSlot, Appointment, User
+from export.export import bookings_csv_query
+
+START_DAY = date(2020, 1, 1)
+
+
+def day_queries(days: int):
+    day = START_DAY + timedelta(days=days // 2)
+    midnight = datetime.combine(day, datetime.min.time())
+    noon = midnight + timedelta(hours=12)
+    month_end = day + timedelta(days=30)
+    admin = User(user_name='admin', role=UserRoles.ADMIN)
+    return {
+        'list_for_day': (
+            bookings_csv_query(admin).where((TimeSlot.start_date_time > day - timedelta(days=1)) &
+                                            (TimeSlot.start_date_time < day + timedelta(days=1))),
+            bookings_csv_query(admin).where(TimeSlot.slot_date == day),
+        ),
+        'export_month': (
+            bookings_csv_query(admin).where((TimeSlot.start_date_time >= day) &
+                                            (TimeSlot.start_date_time < month_end + timedelta(days=1))),
+            bookings_csv_query(admin).where(TimeSlot.slot_date.between(day, month_end)),
+        ),
+        'delete_timeslots': (
+            TimeSlot.select().where((TimeSlot.start_date_time >= noon) &
+                                    (TimeSlot.start_date_time < midnight + timedelta(days=1)))
+            .order_by(TimeSlot.start_date_time).limit(10),
+            TimeSlot.select().where((TimeSlot.slot_date == day) & (TimeSlot.start_date_time >= noon))
+            .order_by(TimeSlot.start_date_time).limit(10),
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.set_defaults(days=1095)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    started = time.perf_counter()
+    seed(db, START_DAY, args.days, args.slots_per_day, args.appointments_per_slot, booked_ratio=args.booked_ratio,
+         num_users=args.num_users)
+    seed_sec = time.perf_counter() - started
+    db.execute_sql('ANALYZE')
+    queries = day_queries(args.days)
+    by_range = measure(db, {name: pair[0] for name, pair in queries.items()}, args.repeat)
+    by_slot_date = measure(db, {name: pair[1] for name, pair in queries.items()}, args.repeat)
+
+    print(json.dumps({
+        'benchmark': 'slot_date',
+        'time_slots': TimeSlot.select().count(),
+        'appointments': Appointment.select().count(),
+        'seed_sec': round(seed_sec, 1),
+        'queries': {name: {'start_date_time_range': by_range[name], 'slot_date': by_slot_date[name]}
+                    for name in queries},
+    }, indent=2))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Tokens per second of the former random.choice generators and of the secrets based ones, one at a time and in
+batches, for claim tokens, booking codes, salts and passwords.
+
+    python -m benchmark.tokens --tokens 100000
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+from secret_token.secret_token import TokenGenerator, SecretTokenGenerator, SECRET_TOKEN_LETTERS
+
+
+def random_choice_string(length: int) -> str:
+    return ''.join([random.choice(string.ascii_letters) for _ in range(length)])
+
+
+def random_choice_secret_token(length: int) -> str:
+    return random.choice(SECRET_TOKEN_LETTERS) + '-' + ''.join([random.choice(string.digits)
+                                                                for _ in range(length - 1)])
+
+
+def throughput(generate, num_tokens: int, batch_size: int = 1) -> int:
+    started = time.perf_counter()
+    for _ in range(num_tokens // batch_size):
+        generate()
+    return int(num_tokens / (time.perf_counter() - started))
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--batch_size', type=int, default=500)
+    args = parser.parse_args()
+    results = {}
+    for name, length, old, generator in [
+        ('claim_token', 32, random_choice_string, TokenGenerator(32)),
+        ('booking_code', 6, random_choice_secret_token, SecretTokenGenerator(6)),
+        ('salt', 2, random_choice_string, TokenGenerator(2)),
+        ('password', 12, random_choice_string, TokenGenerator(12)),
+    ]:
+        results[name] = {
+            'random_choice_per_sec': throughput(lambda: old(length), args.tokens),
+            'single_per_sec': throughput(generator.generate, args.tokens),
+            'batched_per_sec': throughput(lambda: generator.generate_many(args.batch_size), args.tokens,
+                                          args.batch_size),
+        }
+    print(json.dumps({'benchmark': 'tokens', 'tokens': args.tokens, 'batch_size': args.batch_size,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main_()
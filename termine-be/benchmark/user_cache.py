@@ -0,0 +1,110 @@
+"""
+Counts the database queries per /api/next_free_slots request with and without the cache of users resolved from
+tokens, while concurrent clients poll with the tokens of different users.
+
+    python -m benchmark.user_cache --requests 2000 --concurrency 8
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import hug
+import jwt
+from falcon.testing import TestClient
+
+import main
+from access_control.access_control import user_cache
+from availability.availability import free_slot_cache
+from benchmark.seed import add_db_arguments, open_db, seed, discard_db, user_names
+from config import config
+from db.directives import PeeweeContext
+
+
+class QueryCounter:
+    """counts the statements run through db.execute_sql, from all threads and by each thread"""
+
+    def __init__(self, db):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        execute_sql = db.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            self._local.count = self.in_thread() + 1
+            return execute_sql(*args, **kwargs)
+
+        db.execute_sql = counting_execute_sql
+
+    def reset(self):
+        with self._lock:
+            queries, self.count = self.count, 0
+            return queries
+
+    def in_thread(self):
+        """the statements run by the calling thread so far, never reset"""
+        return getattr(self._local, 'count', 0)
+
+
+def run(client: TestClient, ttl_sec: int, tokens, num_requests: int, concurrency: int,
+        queries: QueryCounter) -> dict:
+    user_cache.ttl_sec = ttl_sec
+    user_cache.clear()
+    user_cache.hits = user_cache.misses = 0
+    free_slot_cache.clear()
+    queries.reset()
+    latencies = []
+
+    def request(i):
+        started = time.perf_counter()
+        response = client.simulate_get("/api/next_free_slots", headers={"Authorization": tokens[i % len(tokens)]})
+        assert response.status == hug.HTTP_200, response.status
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(request, range(num_requests)))
+    elapsed = time.perf_counter() - started
+    num_queries = queries.reset()
+    latencies.sort()
+    return {
+        'user_cache_ttl_sec': ttl_sec,
+        'requests': num_requests,
+        'queries': num_queries,
+        'queries_per_request': round(num_queries / num_requests, 3),
+        'requests_per_sec': round(num_requests / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+        'user_cache': user_cache.stats(),
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_db_arguments(parser)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--ttl_sec', type=int, default=30, help='user cache ttl of the cached run')
+    args = parser.parse_args()
+    db = open_db(args.db_url, args.db_path)
+    seed(db, date.today() + timedelta(days=1), args.days, args.slots_per_day, args.appointments_per_slot,
+         booked_ratio=args.booked_ratio, num_users=args.num_users)
+    PeeweeContext._cls_db = db
+    queries = QueryCounter(db)
+    tokens = [jwt.encode({'user': name}, config.Settings.jwt_key, algorithm='HS256')
+              for name in user_names(args.num_users)]
+    # the wsgi app is built once, hug.test would rebuild its router on every request
+    client = TestClient(hug.API(main).http.server())
+    results = [run(client, ttl_sec, tokens, args.requests, args.concurrency, queries) for ttl_sec in [0, args.ttl_sec]]
+    print(json.dumps({'benchmark': 'user_cache', 'users': len(tokens), 'concurrency': args.concurrency,
+                      'results': results}, indent=2, default=str))
+    if not args.db_url and not args.db_path:
+        discard_db(db)
+
+
+if __name__ == '__main__':
+    main_()
@@ -3,18 +3,29 @@ import io
 import json
 import logging
 import sys
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, time, timedelta
+from time import perf_counter
 
 import hug
-from peewee import fn, DatabaseError
+from peewee import DatabaseError
 
 from api import api
-from access_control.access_control import UserRoles, get_or_create_auto_user
+from access_control.access_control import UserRoles, get_or_create_auto_user, user_cache, \
+    credential_cache
+from availability.availability import query_free_slots, check_slot_counters, update_slot_counter, claim_reaper
 from config import config
+from coupons.coupons import add_coupons, set_coupons, query_coupon_state, update_booking_stats, refresh_booking_stats
 from db import directives
 from db.migration import migrate_db, init_database
-from db.model import TimeSlot, Appointment, User, Booking, Migration, FrontendConfig
-from secret_token.secret_token import get_random_string, hash_pw
+from db.model import TimeSlot, Appointment, User, Booking, Migration, SlotCounter
+from export.export import cleanup_expired_jobs
+from frontend_config.frontend_config import save_frontend_config
+from schedule.schedule import create_slots, slot_starts
+from static_files.static_files import StaticFiles
+from password_hash.password_hash import hash_password
+from secret_token.secret_token import get_random_string
+from slot_codes.slot_codes import slot_code_supply
+from user_import.user_import import import_users
 
 log = logging.getLogger('cli')
 
@@ -44,15 +55,36 @@ def create_appointments(
     [--day] <number> [--month] <number> [--year <number=date.today().year>] [--start_hour <number=8>] [--start_min <number=30>] [--num_slots <number=13>] [--num_appointment_per_slot <number=8>] [--slot_duration_min <number=30>]
     creates timeslots and their corresponsing appointments
     """
-    with db.atomic():
-        for i in range(num_slots):
-            ts = TimeSlot.create(
-                start_date_time=datetime(year, month, day, start_hour, start_min, tzinfo=None) + timedelta(
-                    minutes=i * slot_duration_min),
-                length_min=slot_duration_min)
-            for _ in range(num_appointment_per_slot):
-                Appointment.create(booked=False, time_slot=ts)
-            ts.save()
+    first_start = datetime(year, month, day, start_hour, start_min, tzinfo=None)
+    starts = [first_start + timedelta(minutes=i * slot_duration_min) for i in range(num_slots)]
+    create_slots(db, starts, slot_duration_min, num_appointment_per_slot, batch_size=max(num_slots, 1))
+
+
+@hug.cli()
+def create_appointment_calendar(
+        db: directives.PeeweeSession,
+        start_date: hug.types.text,
+        end_date: hug.types.text,
+        open_from: hug.types.text = "08:00",
+        open_until: hug.types.text = "18:00",
+        excluded_days: hug.types.text = "sun",
+        num_appointment_per_slot: hug.types.number = 8,
+        slot_duration_min: hug.types.number = 30,
+        batch_size: hug.types.number = 500
+):
+    """
+    [--start_date] <ISO date> [--end_date] <ISO date> [--open_from <hh:mm="08:00">] [--open_until <hh:mm="18:00">] [--excluded_days <string="sun">] [--num_appointment_per_slot <number=8>] [--slot_duration_min <number=30>] [--batch_size <number=500>]
+    creates timeslots and their appointments for every day from start_date to end_date, except for the excluded
+    days, a comma separated list of weekdays (mon, tue, ...) and ISO dates. Writes batch_size timeslots per transaction
+    """
+    starts = slot_starts(date.fromisoformat(start_date), date.fromisoformat(end_date), time.fromisoformat(open_from),
+                         time.fromisoformat(open_until), slot_duration_min, excluded_days)
+    started = perf_counter()
+    num_slots, num_appointments = create_slots(db, starts, slot_duration_min, num_appointment_per_slot, batch_size)
+    elapsed = perf_counter() - started
+    rows = num_slots + num_appointments
+    print(f"Created {num_slots} timeslots and {num_appointments} appointments in {elapsed:.1f}s "
+          f"({rows / elapsed if elapsed else rows:.0f} rows/s).")
 
 
 @hug.cli()
@@ -72,9 +104,8 @@ def delete_timeslots(
     """
     with db.atomic():
         dto = datetime(year, month, day, start_hour, start_min, tzinfo=None)
-        tomorrow = datetime(year, month, day, tzinfo=None) + timedelta(days=1)
         ts = TimeSlot.select().where(
-            (TimeSlot.start_date_time >= dto) & (TimeSlot.start_date_time < tomorrow)).order_by(
+            (TimeSlot.slot_date == dto.date()) & (TimeSlot.start_date_time >= dto)).order_by(
             TimeSlot.start_date_time).limit(num_slots)
         if not for_real:
             log.info(
@@ -104,6 +135,7 @@ def delete_timeslots(
                     Appointment.id.in_([a.id for a in apts_to_delete]))
                 tq = TimeSlot.delete().where(TimeSlot.id.in_(tsids_to_delete))
                 aq.execute()
+                SlotCounter.delete().where(SlotCounter.time_slot.in_(tsids_to_delete)).execute()
                 tq.execute()
                 log.info("Done!")
         else:
@@ -117,12 +149,9 @@ def _add_one_user(db: directives.PeeweeSession, username: hug.types.text, passwo
                   coupons: hug.types.number = 10):
     with db.atomic():
         name = username.lower()
-        salt = get_random_string(2)
         secret_password = password or get_random_string(12)
-        hashed_password = hash_pw(name, salt, secret_password)
-        user = User.create(user_name=name, role=role, salt=salt,
-                           password=hashed_password, coupons=coupons)
-        user.save()
+        user = User.create(user_name=name, role=role, salt='',
+                           password=hash_password(secret_password), coupons=coupons)
         return {"name": user.user_name, "password": secret_password}
 
 
@@ -146,12 +175,14 @@ def get_user_roles():
 
 @hug.cli()
 def add_users(db: directives.PeeweeSession, filename: hug.types.text,
-              role: hug.types.one_of(UserRoles.user_roles()) = UserRoles.USER):
+              role: hug.types.one_of(UserRoles.user_roles()) = UserRoles.USER,
+              coupons: hug.types.number = 10, output: hug.types.text = None,
+              batch_size: hug.types.number = 500, workers: hug.types.number = None):
     """
-    [--filename] <string> [--role <one_of(UserRoles.user_roles()) = UserRoles.USER>]; imports usernames from the file, one user per line, with a default of 10 coupons
+    [--filename] <string> [--role <one_of(UserRoles.user_roles()) = UserRoles.USER>] [--coupons <number=10>] [--output <string>] [--batch_size <number=500>] [--workers <number>]; imports the users from a .csv or .jsonl file with name, role, coupons and password, or one user name per line from any other file. Users that exist already keep their password unless the file has one for them, so it is safe to run again. The credentials are written to output as csv, or printed without it.
     """
-    with open(filename) as f:
-        return [_add_one_user(db, line.strip(), role=role) for line in f]
+    return import_users(db, filename, output, default_role=role, default_coupons=coupons, batch_size=batch_size,
+                        workers=workers)
 
 
 @hug.cli()
@@ -164,14 +195,12 @@ def change_user_pw(db: directives.PeeweeSession, username: hug.types.text, passw
             f"this would change {username}'s pw to {password}. Run with --for_real if you're sure.")
         sys.exit(1)
     with db.atomic():
-        name = username.lower()
-        salt = get_random_string(2)
-        secret_password = password
-        hashed_password = hash_pw(name, salt, secret_password)
-        user = User.get(User.user_name == username)
-        user.salt = salt
-        user.password = hashed_password
-        user.save()
+        user = User.get(User.user_name == username.lower())
+        User.update(salt='', password=hash_password(password)).where(User.id == user.id).execute()
+        # only the caches of this process, the web workers keep theirs for USER_CACHE_TTL_SEC and
+        # CREDENTIAL_CACHE_TTL_SEC at the most
+        user_cache.invalidate(user.user_name)
+        credential_cache.invalidate(user.user_name)
         print(f"{user.user_name}'s pw successfully changed.")
 
 
@@ -210,21 +239,83 @@ def run_migrations(for_real: hug.types.smart_boolean = False):
         print('Done.')
 
 
+@hug.cli()
+def reconcile_slot_counters(db: directives.PeeweeSession, for_real: hug.types.smart_boolean = False):
+    """
+    [--for_real]; compares the slot counters with the appointments, with --for_real repairs the ones that differ
+    """
+    with db.atomic():
+        differences = check_slot_counters(repair=for_real)
+        for time_slot_id, stored, actual in differences:
+            print(f"time slot {time_slot_id}: (capacity, booked, claimed) counted {stored}, actually {actual}")
+        if not differences:
+            print("All slot counters match the appointments.")
+        elif for_real:
+            print(f"Repaired {len(differences)} slot counter(s).")
+        else:
+            print(f"{len(differences)} slot counter(s) differ, run with --for_real to repair them.")
+
+
+@hug.cli()
+def precompress_static():
+    """
+    writes .gz siblings, and .br siblings with brotli installed, of the compressible files of both frontend builds
+    """
+    written = sum(StaticFiles([directory]).precompress()
+                  for directory in [config.Settings.fe_statics_dir, config.Settings.bo_statics_dir])
+    print(f"Precompressed {written} file(s).")
+
+
+@hug.cli()
+def reap_claims(db: directives.PeeweeSession):
+    """
+    clears expired claims in batches of CLAIM_REAPER_BATCH_SIZE, safe to run from cron next to running workers
+    """
+    reaped = claim_reaper.run_once(db)
+    print(f'Reclaimed {reaped} expired claim(s).')
+
+
+@hug.cli()
+def fill_slot_code_pool(db: directives.PeeweeSession):
+    """
+    tops up the booking codes kept ahead for every upcoming day, up to SLOT_CODE_POOL_SIZE, safe to run from cron
+    next to running workers
+    """
+    added = slot_code_supply.run_once(db)
+    print(f'Added {added} slot code(s).')
+    return slot_code_supply.stats()['levels']
+
+
+@hug.cli()
+def cleanup_exports(db: directives.PeeweeSession):
+    """
+    removes the files of background exports older than EXPORT_TTL_HOURS, safe to run from cron
+    """
+    with db.atomic():
+        removed = cleanup_expired_jobs()
+    print(f'Removed {removed} expired export(s).')
+
+
 @hug.cli()
 def get_coupon_state():
     """
     get a list of all users and their bookings and remaining coupons
     """
-    ret = []
-    for user in User.select():
-        bookings = Booking.select().where(
-            user.user_name == Booking.booked_by)
-        ret.append({
-            "name": user.user_name,
-            "num_bookings": len(bookings),
-            "coupons": user.coupons
-        })
-    return ret
+    query, _ = query_coupon_state()
+    return [{
+        "name": user.user_name,
+        "num_bookings": user.num_bookings,
+        "coupons": user.coupons
+    } for user in query.order_by(User.user_name)]
+
+
+@hug.cli()
+def reconcile_booking_stats(db: directives.PeeweeSession):
+    """
+    counts the bookings of every user into the booking stats from scratch, run it after turning on BOOKING_STATS
+    """
+    with db.atomic():
+        print(f"Counted the bookings of {refresh_booking_stats()} user(s).")
 
 
 @hug.cli()
@@ -233,9 +324,8 @@ def set_coupon_count(db: directives.PeeweeSession, user_name: hug.types.text, va
     [--user_name] <string> [--value] <number>; set the user coupon_count to <value>
     """
     with db.atomic():
-        user = User.get(User.user_name == user_name)
-        user.coupons = value
-        user.save()
+        if not set_coupons(user_name, value):
+            raise User.DoesNotExist(f"no user {user_name}")
 
 
 @hug.cli()
@@ -244,9 +334,8 @@ def inc_coupon_count(db: directives.PeeweeSession, user_name: hug.types.text, in
     [--user_name] <string> [--increment] <number>; increment the user coupon_count, to decrement give a negative number
     """
     with db.atomic():
-        user = User.get(User.user_name == user_name)
-        user.coupons += increment
-        user.save()
+        if not add_coupons(user_name, increment):
+            raise User.DoesNotExist(f"no user {user_name}")
 
 
 @hug.cli()
@@ -272,6 +361,8 @@ def cancel_booking(db: directives.PeeweeSession, secret: hug.types.text, start_d
             booking.appointment.save()
             q = Booking.delete().where(Booking.id == booking.id)
             q.execute()
+            update_slot_counter(booking.appointment.time_slot_id, booked=-1)
+            update_booking_stats(booking.booked_by, -1)
             print("Done.")
 
 
@@ -305,13 +396,7 @@ def set_frontend_config(db: directives.PeeweeSession, instance_name: hug.types.t
         else:
             print(
                 f"Updating the config with '{json.dumps(template, indent=2)}'.")
-            try:
-                config = FrontendConfig.get()
-                config.config = template
-            except FrontendConfig.DoesNotExist:
-                config = FrontendConfig.create(config=template)
-
-            config.save()
+            save_frontend_config(template)
             print("Done.")
 
 
@@ -347,13 +432,7 @@ def load_frontend_config(db: directives.PeeweeSession, frontend_config_file: hug
             else:
                 print(
                     f"Updating the config with '{json.dumps(new_config, indent=2)}'.")
-                try:
-                    config = FrontendConfig.get()
-                    config.config = new_config
-                except FrontendConfig.DoesNotExist:
-                    config = FrontendConfig.create(config=new_config)
-
-                config.save()
+                save_frontend_config(new_config)
                 print("Done.")
 
 
@@ -391,20 +470,7 @@ def get_bookings_created_at(db: directives.PeeweeSession, booked_at: hug.types.t
 def get_free_timeslots_between(db: directives.PeeweeSession, start: datetime, end: datetime):
     with db.atomic():
         now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
-        slots = TimeSlot \
-            .select(TimeSlot.start_date_time, TimeSlot.length_min,
-                    fn.count(Appointment.time_slot).alias("free_appointments")) \
-            .join(Appointment) \
-            .where(
-                (TimeSlot.start_date_time >= start) & (TimeSlot.start_date_time <= end) &
-                (Appointment.claim_token.is_null() | (Appointment.claimed_at +
-                                                      timedelta(
-                                                          minutes=config.Settings.claim_timeout_min) < now)) &
-                (Appointment.booked == False)
-            ) \
-            .group_by(TimeSlot.start_date_time, TimeSlot.length_min) \
-            .order_by(TimeSlot.start_date_time) \
-            # @formatter:on
+        slots = query_free_slots(now, start, end)
         return [{"startDateTime": str(slot.start_date_time)} for slot in slots]
 
 
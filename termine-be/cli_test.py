@@ -1,6 +1,6 @@
 import csv
 import io
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
 from typing import List, Dict, Tuple
 
 import hug
@@ -189,6 +189,21 @@ def test_create_appointments(testing_db):
         assert Appointment.select().where(Appointment.time_slot == ts).count() == NUM_APPOINTMENTS
 
 
+def test_create_appointment_calendar(testing_db, capsys):
+    # mon 2020-04-20 to sun 2020-04-26, without wednesday and sunday
+    hug.test.cli('create_appointment_calendar', module='main', start_date='2020-04-20',
+                 end_date='2020-04-26', open_from='08:00', open_until='10:15', excluded_days='sun,2020-04-22',
+                 num_appointment_per_slot=3, slot_duration_min=30, batch_size=3)
+    assert 'Created 20 timeslots and 60 appointments' in capsys.readouterr().out
+    assert TimeSlot.select().count() == 20
+    assert Appointment.select().count() == 60
+    days = {slot.start_date_time.date() for slot in TimeSlot.select()}
+    assert days == {date(2020, 4, day) for day in [20, 21, 23, 24, 25]}
+    for slot in TimeSlot.select():
+        assert time(8) <= slot.start_date_time.time() <= time(9, 30)
+        assert Appointment.select().where(Appointment.time_slot == slot).count() == 3
+
+
 @pytest.mark.dependency(depends=["cancel_booking", "create_appointments"])
 def test_delete_timeslots(testing_db):
     # this test assumes that create_apointments and cancel_booking both work. They are under test also.
@@ -6,9 +6,12 @@ import hug
 import pytest
 import jwt
 
-from access_control.access_control import UserRoles
+from access_control.access_control import UserRoles, user_cache, credential_cache
+from availability.availability import free_slot_cache
+from config import config
 from db import model
 from db.directives import PeeweeContext
+from frontend_config.frontend_config import frontend_config_cache
 
 USER = "user"
 ADMIN = "admin"
@@ -18,6 +21,9 @@ FORMAT = '%(asctime)s - %(levelname)s\t%(name)s: %(message)s'
 logging.basicConfig(format=FORMAT, stream=sys.stdout, level=logging.INFO)
 log = logging.getLogger('conftest')
 
+# every test adds its users and logs in, at the configured cost that would take a while
+config.Settings.password_hash_iterations = 1000
+
 
 def get_valid_user_auth_header(user, pw):
     return {"Authorization": jwt.encode({"user": user}, "", algorithm="HS256")}
@@ -66,6 +72,10 @@ def get_create_user(username, password):
 @pytest.yield_fixture
 def testing_db():
     PeeweeContext.set_testing()
+    free_slot_cache.clear()
+    user_cache.clear()
+    credential_cache.clear()
+    frontend_config_cache.clear()
     pwc = PeeweeContext()
     if pwc.db.database == ':memory:':
         with pwc.db.atomic():
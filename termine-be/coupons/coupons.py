@@ -0,0 +1,119 @@
+"""
+Changes coupon counts with single conditional updates, so concurrent bookings of one account can neither lose an
+update nor take more coupons than there are. Also counts the bookings made by every account.
+"""
+import logging
+
+from peewee import fn, JOIN
+
+from access_control.access_control import user_cache
+from config import config
+from db.model import User, Booking, BookingStats
+
+log = logging.getLogger('coupons')
+
+
+def take_coupon(user: User) -> bool:
+    """
+    UPDATE "user" SET coupons = coupons - 1 WHERE id = ? AND coupons > 0;
+    false if the user has no coupon left
+    """
+    taken = User.update(coupons=User.coupons - 1) \
+        .where((User.id == user.id) & (User.coupons > 0)) \
+        .execute()
+    user_cache.invalidate(user.user_name)
+    if not taken:
+        log.info("no coupon left for %s", user.user_name)
+    return taken == 1
+
+
+def return_coupon(user: User):
+    User.update(coupons=User.coupons + 1).where(User.id == user.id).execute()
+    user_cache.invalidate(user.user_name)
+
+
+def add_coupons(user_name: str, increment: int) -> bool:
+    """false if there is no such user"""
+    updated = User.update(coupons=User.coupons + increment).where(User.user_name == user_name).execute()
+    user_cache.invalidate(user_name)
+    return updated == 1
+
+
+def set_coupons(user_name: str, value: int) -> bool:
+    """false if there is no such user"""
+    updated = User.update(coupons=value).where(User.user_name == user_name).execute()
+    user_cache.invalidate(user_name)
+    return updated == 1
+
+
+def query_coupon_state():
+    """
+    SELECT u.user_name, u.role, u.coupons, COUNT(b.id) AS num_bookings
+    FROM "user" u
+    LEFT JOIN booking b ON b.booked_by = u.user_name
+    GROUP BY u.id, u.user_name, u.role, u.coupons
+
+    with config.Settings.booking_stats set, the counts are read from bookingstats instead of counting the bookings.
+    Returns the query and the expression of num_bookings, to sort by.
+    """
+    if config.Settings.booking_stats:
+        num_bookings = fn.COALESCE(BookingStats.num_bookings, 0)
+        query = User.select(User.user_name, User.role, User.coupons, num_bookings.alias('num_bookings')) \
+            .join(BookingStats, JOIN.LEFT_OUTER, on=(BookingStats.user_name == User.user_name))
+        return query, num_bookings
+    num_bookings = fn.COUNT(Booking.id)
+    query = User.select(User.user_name, User.role, User.coupons, num_bookings.alias('num_bookings')) \
+        .join(Booking, JOIN.LEFT_OUTER, on=(Booking.booked_by == User.user_name)) \
+        .group_by(User.id, User.user_name, User.role, User.coupons)
+    return query, num_bookings
+
+
+def having_num_bookings(query, condition):
+    """filters a query_coupon_state query on a condition about num_bookings, a count of the grouped query"""
+    return query.where(condition) if config.Settings.booking_stats else query.having(condition)
+
+
+def count_bookings(user_names, batch_size: int = 400) -> dict:
+    """
+    SELECT booked_by, COUNT(b.id) FROM booking b WHERE booked_by IN (...) GROUP BY booked_by
+
+    the number of bookings of each of user_names, read from bookingstats with config.Settings.booking_stats set. Meant
+    for a page of users, the names are bound batch_size at a time to stay below the parameter limit of sqlite. For
+    all users, read the counts with query_coupon_state.
+    """
+    counts = dict.fromkeys(user_names, 0)
+    user_names = list(counts)
+    for i in range(0, len(user_names), batch_size):
+        batch = user_names[i:i + batch_size]
+        if config.Settings.booking_stats:
+            query = BookingStats.select(BookingStats.user_name, BookingStats.num_bookings) \
+                .where(BookingStats.user_name.in_(batch))
+        else:
+            query = Booking.select(Booking.booked_by, fn.COUNT(Booking.id)) \
+                .where(Booking.booked_by.in_(batch)) \
+                .group_by(Booking.booked_by)
+        counts.update(query.tuples())
+    return counts
+
+
+def update_booking_stats(user_name: str, booked: int):
+    """
+    INSERT INTO bookingstats (user_name, num_bookings) VALUES (?, ?)
+    ON CONFLICT (user_name) DO UPDATE SET num_bookings = bookingstats.num_bookings + ?
+
+    has to run in the transaction of the booking or cancellation it counts
+    """
+    if not config.Settings.booking_stats:
+        return
+    BookingStats.insert(user_name=user_name, num_bookings=booked) \
+        .on_conflict(conflict_target=[BookingStats.user_name],
+                     update={BookingStats.num_bookings: BookingStats.num_bookings + booked}) \
+        .execute()
+
+
+def refresh_booking_stats() -> int:
+    """counts the bookings of every user into bookingstats from scratch, returns the number of users with bookings"""
+    BookingStats.delete().execute()
+    BookingStats.insert_from(Booking.select(Booking.booked_by, fn.COUNT(Booking.id)).group_by(Booking.booked_by),
+                             [BookingStats.user_name, BookingStats.num_bookings]).execute()
+    return BookingStats.select().count()
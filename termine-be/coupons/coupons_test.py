@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import hug
+
+import main
+from config import config
+from conftest import USER, ADMIN, get_user_login
+from coupons.coupons import take_coupon, return_coupon, add_coupons, set_coupons, query_coupon_state, \
+    refresh_booking_stats
+from db.model import User, TimeSlot, Appointment, BookingStats
+
+
+def test_take_coupon_stops_at_zero(testing_db):
+    assert set_coupons(USER, 1)
+    user = User.get(User.user_name == USER)
+    assert take_coupon(user)
+    assert not take_coupon(user)
+    assert User.get_by_id(user.id).coupons == 0
+    return_coupon(user)
+    assert User.get_by_id(user.id).coupons == 1
+
+
+def test_unknown_user(testing_db):
+    assert not add_coupons("nobody", 1)
+    assert not set_coupons("nobody", 1)
+
+
+def _num_bookings():
+    query, _ = query_coupon_state()
+    return {user.user_name: user.num_bookings for user in query}
+
+
+def test_booking_stats_follow_bookings(testing_db, monkeypatch):
+    monkeypatch.setattr(config.Settings, "booking_stats", True)
+    start = (datetime.now() + timedelta(days=1)).replace(microsecond=0)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for i in range(3):
+        Appointment.create(time_slot=slot, booked=False, claim_token=f"claim{i}", claimed_at=datetime.now())
+    bookings = [hug.test.post(main, "/api/book_appointment", headers=get_user_login(), body={
+        "claim_token": f"claim{i}", "start_date_time": start.isoformat(), "first_name": "Marianne",
+        "name": "Mustermann", "phone": "0123456789", "office": "MusterOffice"}) for i in range(3)]
+    assert all(booking.status == hug.HTTP_200 for booking in bookings)
+    booking_id = hug.test.get(main, "/api/booked", headers=get_user_login(), start_date=start.date().isoformat(),
+                              end_date=start.date().isoformat()).data[0]["booking_id"]
+    assert hug.test.delete(main, "/api/booking", headers=get_user_login(),
+                           booking_id=booking_id).status == hug.HTTP_200
+
+    assert _num_bookings() == {USER: 2, ADMIN: 0}
+    assert BookingStats.get_by_id(USER).num_bookings == 2
+    monkeypatch.setattr(config.Settings, "booking_stats", False)
+    assert _num_bookings() == {USER: 2, ADMIN: 0}
+
+    BookingStats.update(num_bookings=5).execute()
+    assert refresh_booking_stats() == 1
+    assert BookingStats.get_by_id(USER).num_bookings == 2
@@ -0,0 +1,64 @@
+"""
+Runs the peewee queries of the models and the business logic through an asyncpg pool, for the asgi app: peewee
+renders them for postgres, asyncpg sends them, and no thread waits for the database meanwhile
+"""
+import logging
+import re
+
+from peewee import PostgresqlDatabase
+
+try:
+    import asyncpg
+except ImportError:
+    # only the asgi app needs it
+    asyncpg = None
+
+log = logging.getLogger('db.async_db')
+
+# the placeholders of psycopg2, %% is a literal % in the sql peewee renders for it
+PLACEHOLDER = re.compile(r'%s|%%')
+_postgres = PostgresqlDatabase(None)
+
+
+def render(query):
+    """the sql of query for asyncpg, with $1, $2, ... as placeholders, and its parameters"""
+    sql, params = _postgres.get_sql_context().sql(query).query()
+    numbers = iter(range(1, len(params) + 1))
+    return PLACEHOLDER.sub(lambda match: '%' if match.group() == '%%' else f'${next(numbers)}', sql), params
+
+
+class AsyncDatabase:
+    def __init__(self, url: str, max_connections: int):
+        self.url = url
+        self.max_connections = max_connections
+        self.pool = None
+
+    async def connect(self):
+        if asyncpg is None:
+            raise RuntimeError("the asgi app needs asyncpg, pip install asyncpg")
+        self.pool = await asyncpg.create_pool(dsn=self.url, min_size=1, max_size=self.max_connections)
+        log.info("connected an asyncpg pool of up to %d connections", self.max_connections)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def fetch(self, query) -> list:
+        """the rows of query as asyncpg records, which are read like dicts"""
+        sql, params = render(query)
+        return await self.pool.fetch(sql, *params)
+
+    async def fetchval(self, query):
+        sql, params = render(query)
+        return await self.pool.fetchval(sql, *params)
+
+    def stats(self):
+        if self.pool is None:
+            return {"connected": False}
+        return {
+            "connected": True,
+            "max_connections": self.max_connections,
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+        }
@@ -0,0 +1,18 @@
+from datetime import datetime
+
+from peewee import SQL
+
+from availability.availability import query_free_slots
+from db.async_db import render
+from db.model import User
+
+
+def test_render_numbers_placeholders():
+    sql, params = render(query_free_slots(datetime(2021, 4, 20, 10)).limit(5))
+    assert "%s" not in sql
+    assert [f"${number}" in sql for number in range(1, len(params) + 1)] == [True] * len(params)
+    assert params[-1] == 5
+
+    sql, params = render(User.select(User.id).where(SQL("\"user_name\" LIKE 'praxis-%%'") & (User.role == 'admin')))
+    assert sql.endswith("""WHERE ("user_name" LIKE 'praxis-%' AND ("t1"."role" = $1))""")
+    assert params == ['admin']
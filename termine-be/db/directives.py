@@ -1,15 +1,21 @@
 """Defines how connections with databases via peewee will be handled"""
 import logging
+from urllib.parse import urlparse
 
 import hug
 from peewee import Database
-from playhouse.db_url import connect
+from playhouse.db_url import connect, parse
+from playhouse.pool import PooledDatabase, PooledPostgresqlExtDatabase
+from playhouse.postgres_ext import PostgresqlExtDatabase, ServerSide
 
 from config import config
 from .model import db_proxy
 
 log = logging.getLogger("db.directives")
 
+# connected with the postgres_ext classes, for server side cursors, and pooled with DB_POOL
+POSTGRES_SCHEMES = {'postgres', 'postgresql'}
+
 
 class PeeweeContext:
     _cls_db = None
@@ -23,15 +29,39 @@ class PeeweeContext:
     def get_connection(cls, testing):
         url = "sqlite:///:memory:" if testing else config.Db.url
         log.debug("connecting db, %s testing: %s", cls, testing)
-        return connect(url)
+        if testing or urlparse(url).scheme not in POSTGRES_SCHEMES:
+            # any other database playhouse.db_url knows, pooled with a '+pool' scheme
+            return connect(url)
+        if config.Db.use_pool:
+            return PooledPostgresqlExtDatabase(max_connections=config.Db.pool_max_connections,
+                                               stale_timeout=config.Db.pool_stale_timeout,
+                                               timeout=config.Db.pool_timeout,
+                                               **parse(url))
+        return PostgresqlExtDatabase(**parse(url))
 
     @classmethod
     def _static_db(cls, testing):
-        if testing:
-            cls._cls_db = cls._cls_db or cls.get_connection(testing)
-            return cls._cls_db
-        else:
-            return cls.get_connection(False)
+        cls._cls_db = cls._cls_db or cls.get_connection(testing)
+        return cls._cls_db
+
+    @classmethod
+    def pool_stats(cls):
+        db = cls._cls_db
+        if not isinstance(db, PooledDatabase):
+            return {"pooled": False}
+        return {
+            "pooled": True,
+            "max_connections": db._max_connections,
+            "in_use": len(db._in_use),
+            "idle": len(db._connections),
+        }
+
+    @classmethod
+    def release_connection(cls):
+        # the in-memory test db lives exactly as long as its connection
+        if not cls._testing and cls._cls_db is not None and not cls._cls_db.is_closed():
+            # a pooled database hands the connection back to the pool here
+            cls._cls_db.close()
 
     def __init__(self):
         log.debug("init PeeweeContext, %s", self)
@@ -43,8 +73,17 @@ class PeeweeContext:
 
     def cleanup(self, exception=None):
         log.debug("cleaning up PeeweeContext")
-        if exception:
-            log.exception("errror in PeeweeContext: ", exception)
+        # not found, bad requests and the like are answers to the client, not errors of the context
+        if exception and not isinstance(exception, (hug.HTTPError, hug.HTTPStatus)):
+            log.warning("error in PeeweeContext: %s", exception)
+        self.release_connection()
+
+
+def stream_rows(db: Database, query, array_size=1000):
+    """iterates over the rows of query without holding all of them in memory, through a server side cursor on postgres"""
+    if isinstance(db, PostgresqlExtDatabase):
+        return ServerSide(query, database=db, array_size=array_size)
+    return query.iterator()
 
 
 @hug.directive(apply_globally=True)
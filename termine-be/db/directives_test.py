@@ -0,0 +1,42 @@
+import logging
+
+import hug
+from peewee import SqliteDatabase
+from playhouse.pool import PooledPostgresqlExtDatabase
+from playhouse.postgres_ext import PostgresqlExtDatabase
+
+import main
+from config import config
+from db.directives import PeeweeContext
+
+
+def test_pooled_connection(monkeypatch):
+    monkeypatch.setattr(config.Db, "use_pool", True)
+    monkeypatch.setattr(config.Db, "pool_max_connections", 7)
+    db = PeeweeContext.get_connection(False)
+    assert isinstance(db, PooledPostgresqlExtDatabase)
+    assert db._max_connections == 7
+    assert db.is_closed()
+
+
+def test_unpooled_connection(monkeypatch):
+    monkeypatch.setattr(config.Db, "use_pool", False)
+    db = PeeweeContext.get_connection(False)
+    assert isinstance(db, PostgresqlExtDatabase)
+    assert not isinstance(db, PooledPostgresqlExtDatabase)
+
+
+def test_other_databases_connect_by_url(monkeypatch):
+    monkeypatch.setattr(config.Db, "url", "sqlite:///:memory:")
+    monkeypatch.setattr(config.Db, "use_pool", True)
+    assert isinstance(PeeweeContext.get_connection(False), SqliteDatabase)
+
+
+def test_http_errors_are_not_logged(testing_db, caplog):
+    caplog.set_level(logging.WARNING, logger="db.directives")
+    assert hug.test.get(main, "/api/missing").status == hug.HTTP_404
+    assert hug.test.get(main, "/admin_api/user", headers={"Authorization": "Basic invalid"}).status == hug.HTTP_401
+    PeeweeContext().cleanup(hug.HTTPBadRequest())
+    assert not caplog.records
+    PeeweeContext().cleanup(ValueError("broken"))
+    assert [record.getMessage() for record in caplog.records] == ["error in PeeweeContext: broken"]
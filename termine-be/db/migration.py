@@ -3,13 +3,17 @@ from datetime import datetime
 
 import hug
 import re
-from peewee import DateTimeField, IntegerField, CharField, DateField
-from playhouse.migrate import PostgresqlMigrator, ProgrammingError, migrate
+from peewee import DateTimeField, IntegerField, CharField, DateField, fn, PostgresqlDatabase
+from playhouse.migrate import SchemaMigrator, ProgrammingError, migrate
 
 from config import config
 from config.config import FrontendSettings
+from availability.availability import check_slot_counters
+from coupons.coupons import refresh_booking_stats
 from db.directives import PeeweeSession
-from db.model import Migration, db_proxy, tables, FrontendConfig
+# a level creates new tables from their models, every later change of a table is spelled out by the level making it
+from db.model import Migration, db_proxy, tables, FrontendConfig, ExportJob, TimeSlot, SlotCounter, BookingStats, \
+    SlotCodePool
 
 import logging
 log = logging.getLogger('migration')
@@ -20,15 +24,34 @@ def init_database(db: PeeweeSession):
     log.info("Initializing the Database")
     with db.atomic():
         db_proxy.create_tables(tables)
+        create_user_name_pattern_index(db)
         log.info("Tables created. Setting migration level.")
-        Migration.create(version=5)
+        Migration.create(version=13)
         log.info("Migration level set.")
 
 
+def create_index(db, name: str, table: str, columns: str, where: str = None):
+    """
+    CREATE INDEX IF NOT EXISTS, spelled out by each level as it was at that level: the models declare the indexes of
+    the latest level, and the columns of some only come with later levels
+    """
+    sql = f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({columns})'
+    db.execute_sql(sql + f' WHERE {where}' if where else sql)
+
+
+def create_user_name_pattern_index(db):
+    """
+    the unique index of user_name follows the collation of the database, LIKE 'prefix%' needs one with
+    text_pattern_ops unless the collation is C. Postgres only.
+    """
+    if isinstance(db, PostgresqlDatabase):
+        db.execute_sql('CREATE INDEX IF NOT EXISTS "user_user_name_pattern" ON "user" ("user_name" text_pattern_ops)')
+
+
 @hug.local()
 def migrate_db(db: PeeweeSession):
     with db.atomic() as txs:
-        migrator = PostgresqlMigrator(db)
+        migrator = SchemaMigrator.from_database(db)
         try:
             migration = Migration.get()
             if migration.version < 1:
@@ -43,6 +66,22 @@ def migrate_db(db: PeeweeSession):
                 level_4(db, migration, migrator)
             if migration.version < 5:
                 level_5(db, migration)
+            if migration.version < 6:
+                level_6(db, migration)
+            if migration.version < 7:
+                level_7(db, migration)
+            if migration.version < 8:
+                level_8(db, migration)
+            if migration.version < 9:
+                level_9(db, migration, migrator)
+            if migration.version < 10:
+                level_10(db, migration)
+            if migration.version < 11:
+                level_11(db, migration)
+            if migration.version < 12:
+                level_12(db, migration, migrator)
+            if migration.version < 13:
+                level_13(db, migration)
 
         except ProgrammingError:
             log.exception('Error - Migrations table not found, please run init_db first!')
@@ -132,3 +171,96 @@ def level_5(db, migration):
             migration.save()
         except IndexError:
             log.info("No frontendconfig stored. No row migration needed")
+
+
+def level_6(db, migration):
+    with db.atomic():
+        log.info("creating table ExportJob...")
+        db.create_tables([ExportJob])
+        migration.version = 6
+        migration.save()
+
+
+def level_7(db, migration):
+    """
+    creates the indexes of the hot queries, the ones that already exist are skipped. The tables are locked for
+    writes while an index is built, run it outside of opening hours on large databases.
+    """
+    with db.atomic():
+        log.info("creating indexes of timeslot, appointment and booking...")
+        create_index(db, 'timeslot_start_date_time', 'timeslot', '"start_date_time"')
+        create_index(db, 'appointment_time_slot_id_booked_claim_token', 'appointment',
+                     '"time_slot_id", "booked", "claim_token"')
+        create_index(db, 'appointment_free', 'appointment', '"time_slot_id", "claimed_at"', where='NOT "booked"')
+        create_index(db, 'booking_booked_by', 'booking', '"booked_by"')
+        create_index(db, 'booking_booked_at', 'booking', '"booked_at"')
+        migration.version = 7
+        migration.save()
+
+
+def level_8(db, migration):
+    with db.atomic():
+        log.info("creating table SlotCounter...")
+        db.create_tables([SlotCounter])
+        log.info("creating index on appointment.claimed_at...")
+        create_index(db, 'appointment_claimed_at', 'appointment', '"claimed_at"')
+        log.info("counting the appointments of every time slot...")
+        check_slot_counters(repair=True)
+        migration.version = 8
+        migration.save()
+
+
+def level_9(db, migration, migrator):
+    with db.atomic():
+        if 'slot_date' not in [column.name for column in db.get_columns('timeslot')]:
+            log.info("adding column timeslot.slot_date...")
+            migrate(
+                migrator.add_column('timeslot', 'slot_date', DateField(null=True)),
+            )
+            # date() casts a timestamp to its day in postgres and in sqlite
+            TimeSlot.update(slot_date=fn.DATE(TimeSlot.start_date_time)).execute()
+            migrate(
+                migrator.add_not_null('timeslot', 'slot_date'),
+            )
+        log.info("creating index on timeslot.slot_date...")
+        create_index(db, 'timeslot_slot_date', 'timeslot', '"slot_date"')
+        migration.version = 9
+        migration.save()
+
+
+def level_10(db, migration):
+    with db.atomic():
+        log.info("creating table BookingStats...")
+        db.create_tables([BookingStats])
+        log.info("counting the bookings of every user...")
+        refresh_booking_stats()
+        migration.version = 10
+        migration.save()
+
+
+def level_11(db, migration):
+    with db.atomic():
+        log.info("creating indexes for the user list...")
+        create_index(db, 'user_role_user_name', 'user', '"role" DESC, "user_name"')
+        create_user_name_pattern_index(db)
+        migration.version = 11
+        migration.save()
+
+
+def level_12(db, migration, migrator):
+    with db.atomic():
+        if 'version' not in [column.name for column in db.get_columns('frontendconfig')]:
+            log.info("adding column frontendconfig.version...")
+            migrate(
+                migrator.add_column('frontendconfig', 'version', IntegerField(default=1)),
+            )
+        migration.version = 12
+        migration.save()
+
+
+def level_13(db, migration):
+    with db.atomic():
+        log.info("creating table SlotCodePool...")
+        db.create_tables([SlotCodePool])
+        migration.version = 13
+        migration.save()
@@ -0,0 +1,97 @@
+from datetime import datetime, date
+
+from db.migration import migrate_db
+from db.model import Migration, TimeSlot, Appointment, SlotCounter, BookingStats, tables
+
+
+def _indexes(db, table):
+    return {index.name for index in db.get_indexes(table)}
+
+
+def test_level_7_creates_missing_indexes(testing_db):
+    assert Migration.get().version == 13
+    testing_db.execute_sql('DROP INDEX "appointment_free"')
+    testing_db.execute_sql('DROP INDEX "booking_booked_by"')
+    Migration.update(version=6).execute()
+
+    migrate_db()
+
+    assert Migration.get().version == 13
+    assert "appointment_free" in _indexes(testing_db, "appointment")
+    assert "booking_booked_by" in _indexes(testing_db, "booking")
+
+
+def test_level_8_counts_appointments(testing_db):
+    slot = TimeSlot.create(start_date_time=datetime(2020, 4, 20, 10), length_min=10)
+    Appointment.create(time_slot=slot, booked=True)
+    Appointment.create(time_slot=slot, booked=False, claim_token="claimed", claimed_at=datetime(2020, 4, 19))
+    Appointment.create(time_slot=slot, booked=False)
+    testing_db.drop_tables([SlotCounter])
+    Migration.update(version=7).execute()
+
+    migrate_db()
+
+    counter = SlotCounter.get(SlotCounter.time_slot == slot)
+    assert (counter.capacity, counter.booked, counter.claimed) == (3, 1, 1)
+
+
+def test_level_9_fills_slot_date(testing_db):
+    slot = TimeSlot.create(start_date_time=datetime(2020, 4, 20, 23, 50), length_min=10)
+    testing_db.execute_sql('DROP INDEX "timeslot_slot_date"')
+    testing_db.execute_sql('ALTER TABLE "timeslot" DROP COLUMN "slot_date"')
+    Migration.update(version=8).execute()
+
+    migrate_db()
+
+    assert Migration.get().version == 13
+    assert TimeSlot.get_by_id(slot.id).slot_date == date(2020, 4, 20)
+    assert "timeslot_slot_date" in _indexes(testing_db, "timeslot")
+
+
+# the schema init_db created at the baseline, migration level 5, as sqlite has it
+BASELINE_SCHEMA = [
+    'CREATE TABLE "timeslot" ("id" INTEGER NOT NULL PRIMARY KEY, "start_date_time" DATETIME NOT NULL, '
+    '"length_min" INTEGER NOT NULL)',
+    'CREATE TABLE "appointment" ("id" INTEGER NOT NULL PRIMARY KEY, "claim_token" VARCHAR(255), "claimed_at" DATETIME, '
+    '"booked" INTEGER NOT NULL, "time_slot_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("time_slot_id") REFERENCES "timeslot" ("id"))',
+    'CREATE INDEX "appointment_time_slot_id" ON "appointment" ("time_slot_id")',
+    'CREATE TABLE "booking" ("id" INTEGER NOT NULL PRIMARY KEY, "surname" VARCHAR(255) NOT NULL, '
+    '"first_name" VARCHAR(255) NOT NULL, "phone" VARCHAR(255) NOT NULL, "street" VARCHAR(255), '
+    '"street_number" VARCHAR(255), "post_code" VARCHAR(255), "city" VARCHAR(255), "birthday" DATE, '
+    '"reason" VARCHAR(255), "appointment_id" INTEGER NOT NULL, "office" VARCHAR(255) NOT NULL, '
+    '"secret" VARCHAR(255) NOT NULL, "booked_by" VARCHAR(255) NOT NULL, "booked_at" DATETIME, '
+    'FOREIGN KEY ("appointment_id") REFERENCES "appointment" ("id"))',
+    'CREATE INDEX "booking_appointment_id" ON "booking" ("appointment_id")',
+    'CREATE TABLE "frontendconfig" ("id" INTEGER NOT NULL PRIMARY KEY, "config" JSON NOT NULL)',
+    'CREATE TABLE "migration" ("id" INTEGER NOT NULL PRIMARY KEY, "version" INTEGER NOT NULL)',
+    'CREATE TABLE "slotcode" ("date" DATE NOT NULL, "secret" VARCHAR(255) NOT NULL, PRIMARY KEY ("date", "secret"))',
+    'CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "user_name" VARCHAR(255) NOT NULL, '
+    '"salt" VARCHAR(255) NOT NULL, "password" VARCHAR(255) NOT NULL, "role" VARCHAR(255) NOT NULL, '
+    '"coupons" INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX "user_user_name" ON "user" ("user_name")',
+]
+
+
+def test_migrates_baseline_schema(testing_db):
+    testing_db.drop_tables(tables)
+    for statement in BASELINE_SCHEMA:
+        testing_db.execute_sql(statement)
+    testing_db.execute_sql('INSERT INTO "migration" ("version") VALUES (5)')
+    testing_db.execute_sql('INSERT INTO "timeslot" ("start_date_time", "length_min") VALUES (?, 10)',
+                           (datetime(2020, 4, 20, 23, 50),))
+    testing_db.execute_sql('INSERT INTO "appointment" ("booked", "time_slot_id") VALUES (1, 1)')
+    testing_db.execute_sql('INSERT INTO "booking" ("surname", "first_name", "phone", "appointment_id", "office", '
+                           '"secret", "booked_by", "booked_at") VALUES (?, ?, ?, 1, ?, ?, ?, ?)',
+                           ('Surname', 'Firstname', '0123', 'office', 'ABC', 'user', datetime(2020, 4, 19)))
+
+    migrate_db()
+
+    assert Migration.get().version == 13
+    assert TimeSlot.get_by_id(1).slot_date == date(2020, 4, 20)
+    assert SlotCounter.get(SlotCounter.time_slot == 1).booked == 1
+    assert BookingStats.get(BookingStats.user_name == 'user').num_bookings == 1
+    for table in ['timeslot', 'appointment', 'booking', 'user']:
+        model = next(model for model in tables if model._meta.table_name == table)
+        declared = {index._name for index in model._meta.fields_to_index()}
+        assert declared <= _indexes(testing_db, table)
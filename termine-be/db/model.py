@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from peewee import Model, CharField, DatabaseProxy, ForeignKeyField, BooleanField, DateTimeField, IntegerField, \
-    CompositeKey, DateField
+    CompositeKey, DateField, SQL, Field, fn
 
 from playhouse.postgres_ext import JSONField
 
@@ -18,19 +18,79 @@ class Migration(Model):
 
 
 class TimeSlot(Model):
-    start_date_time = DateTimeField()
+    start_date_time = DateTimeField(index=True)
     length_min = IntegerField()
+    # the day of start_date_time, set along with it on insert, update and save, so the time slots of a day are found
+    # by equality
+    slot_date = DateField(index=True)
 
     class Meta:
         database = db_proxy
 
+    @classmethod
+    def insert(cls, __data=None, **insert):
+        return super().insert(_with_slot_date(cls._normalize_data(__data, insert)))
+
+    @classmethod
+    def insert_many(cls, rows, fields=None):
+        if fields is None:
+            rows = map(_with_slot_date, rows)
+        return super().insert_many(rows, fields)
+
+    @classmethod
+    def update(cls, __data=None, **update):
+        return super().update(_with_slot_date(cls._normalize_data(__data, update)))
+
+    def save(self, force_insert=False, only=None):
+        if isinstance(self.start_date_time, datetime):
+            self.slot_date = self.start_date_time.date()
+        if only is not None and TimeSlot.start_date_time in only:
+            only = list(only) + [TimeSlot.slot_date]
+        return super().save(force_insert, only)
+
+
+def _with_slot_date(row):
+    """
+    the row of a time slot to insert or the changes to update, with slot_date set to the day of start_date_time if
+    it is in there, as a value or as an expression like TimeSlot.start_date_time + timedelta(days=1)
+    """
+    if not isinstance(row, dict):
+        return row
+    for key, value in row.items():
+        if getattr(key, 'name', key) == 'start_date_time':
+            slot_date = value.date() if isinstance(value, datetime) else fn.DATE(value)
+            return {**row, TimeSlot.slot_date if isinstance(key, Field) else 'slot_date': slot_date}
+    return row
+
 
 class Appointment(Model):
     claim_token = CharField(null=True)
-    claimed_at = DateTimeField(null=True)
+    claimed_at = DateTimeField(null=True, index=True)
     booked = BooleanField()
     time_slot = ForeignKeyField(TimeSlot, backref='appointments')
 
+    class Meta:
+        database = db_proxy
+        indexes = (
+            (('time_slot', 'booked', 'claim_token'), False),
+        )
+
+
+# the appointments still to be claimed or booked, a small part of all of them once a test center runs for a while
+Appointment.add_index(Appointment.index(Appointment.time_slot, Appointment.claimed_at,
+                                        where=SQL('NOT "booked"'), name='appointment_free'))
+
+
+class SlotCounter(Model):
+    """
+    the number of appointments of a time slot, of the booked ones and of the ones claimed but not booked, including
+    expired claims. Only kept up to date with config.Settings.slot_counters set.
+    """
+    time_slot = ForeignKeyField(TimeSlot, primary_key=True, backref='counter')
+    capacity = IntegerField()
+    booked = IntegerField(default=0)
+    claimed = IntegerField(default=0)
+
     class Meta:
         database = db_proxy
 
@@ -48,8 +108,19 @@ class Booking(Model):
     appointment = ForeignKeyField(Appointment)
     office = CharField()
     secret = CharField()
-    booked_by = CharField()
-    booked_at = DateTimeField(null=True, default=lambda: datetime.now(tz=config.Settings.tz).replace(tzinfo=None))
+    booked_by = CharField(index=True)
+    booked_at = DateTimeField(index=True, null=True, default=lambda: datetime.now(tz=config.Settings.tz).replace(tzinfo=None))
+
+    class Meta:
+        database = db_proxy
+
+
+class BookingStats(Model):
+    """
+    the number of bookings of every user who booked, only kept up to date with config.Settings.booking_stats set
+    """
+    user_name = CharField(primary_key=True)
+    num_bookings = IntegerField(default=0)
 
     class Meta:
         database = db_proxy
@@ -66,6 +137,10 @@ class User(Model):
         database = db_proxy
 
 
+# the order of the user list of the admin page, and its filter by role
+User.add_index(User.index(User.role.desc(), User.user_name, name='user_role_user_name'))
+
+
 class SlotCode(Model):
     date = DateField()
     secret = CharField()
@@ -75,10 +150,43 @@ class SlotCode(Model):
         primary_key = CompositeKey('date', 'secret')
 
 
+class SlotCodePool(Model):
+    """
+    codes already reserved in SlotCode for their day and not handed out yet, see slot_codes. They are added in random
+    order and taken by id, so the codes handed out are spread over the whole code space.
+    """
+    date = DateField()
+    secret = CharField()
+
+    class Meta:
+        database = db_proxy
+        indexes = (
+            (('date', 'id'), False),
+        )
+
+
 class FrontendConfig(Model):
     config = JSONField()
+    # counted up on every change, so the workers know when to render the config script again
+    version = IntegerField(default=1)
 
     class Meta:
         database = db_proxy
 
-tables = [TimeSlot, Appointment, Booking, User, SlotCode, FrontendConfig, Migration]
+
+class ExportJob(Model):
+    job_id = CharField(unique=True)
+    kind = CharField()
+    start_date = DateField()
+    end_date = DateField()
+    requested_by = CharField()
+    status = CharField()
+    created_at = DateTimeField(default=lambda: datetime.now(tz=config.Settings.tz).replace(tzinfo=None))
+    finished_at = DateTimeField(null=True)
+
+    class Meta:
+        database = db_proxy
+
+
+tables = [TimeSlot, Appointment, Booking, User, SlotCode, FrontendConfig, Migration, ExportJob, SlotCounter,
+          BookingStats, SlotCodePool]
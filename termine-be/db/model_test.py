@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, date
+
+from peewee import fn
+
+from db.model import TimeSlot
+
+
+def slot_dates():
+    return [(slot.start_date_time.date(), slot.slot_date) for slot in TimeSlot.select().order_by(TimeSlot.id)]
+
+
+def test_slot_date_follows_start_date_time(testing_db):
+    start = datetime(2021, 3, 1, 23, 50)
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    assert slot_dates() == [(date(2021, 3, 1), date(2021, 3, 1))]
+
+    TimeSlot.update(start_date_time=start + timedelta(minutes=20)).where(TimeSlot.id == slot.id).execute()
+    assert slot_dates() == [(date(2021, 3, 2), date(2021, 3, 2))]
+
+    TimeSlot.update({TimeSlot.start_date_time: fn.DATETIME(TimeSlot.start_date_time, '+1 day')}).execute()
+    assert slot_dates() == [(date(2021, 3, 3), date(2021, 3, 3))]
+
+    slot = TimeSlot.get_by_id(slot.id)
+    slot.start_date_time = datetime(2021, 4, 1, 8)
+    slot.save()
+    assert slot_dates() == [(date(2021, 4, 1), date(2021, 4, 1))]
+
+    slot.start_date_time = datetime(2021, 4, 2, 8)
+    slot.save(only=[TimeSlot.start_date_time])
+    assert slot_dates() == [(date(2021, 4, 2), date(2021, 4, 2))]
@@ -0,0 +1,285 @@
+"""Writes booking exports, and runs the ones too large for a request as background jobs picked up later by job id"""
+import csv
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+
+import xlsxwriter
+
+from access_control.access_control import UserRoles
+from config import config
+from db.directives import PeeweeContext, PeeweeSession, stream_rows
+from db.model import ExportJob, User, Booking, Appointment, TimeSlot
+from secret_token.secret_token import get_random_string
+
+log = logging.getLogger('export')
+
+CSV_FIELDS = ['start_date_time', 'first_name', 'surname', 'phone', 'office', 'secret', 'booked_by']
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+class JobStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    EXPIRED = 'expired'
+
+
+def bookings_between(user: User, start_day_object: date, end_day_object: date):
+    query = Booking.select(Booking, TimeSlot.start_date_time) \
+        .join(Appointment) \
+        .join(TimeSlot) \
+        .where(TimeSlot.slot_date.between(start_day_object, end_day_object) &
+               (Appointment.booked == True))
+    if user.role != UserRoles.ADMIN:
+        query = query.where(Booking.booked_by == user.user_name)
+    return query
+
+
+def bookings_csv_query(user: User):
+    query = Booking.select(TimeSlot.start_date_time, Booking.first_name, Booking.surname, Booking.phone,
+                           Booking.office, Booking.secret, Booking.booked_by) \
+        .join(Appointment) \
+        .join(TimeSlot) \
+        .where(Appointment.booked == True)
+    if user.role != UserRoles.ADMIN:
+        query = query.where(Booking.booked_by == user.user_name)
+    return query.order_by(TimeSlot.start_date_time, Booking.id).dicts()
+
+
+def csv_chunks(db: PeeweeSession, query):
+    """yields the rows of query as csv in chunks of about CSV_CHUNK_SIZE bytes, the header right away"""
+    result = io.StringIO()
+    writer = csv.DictWriter(result, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    yield result.getvalue().encode('utf8')
+    result.seek(0)
+    result.truncate()
+    with db.atomic():
+        for booking in stream_rows(db, query):
+            writer.writerow(booking)
+            if result.tell() >= CSV_CHUNK_SIZE:
+                yield result.getvalue().encode('utf8')
+                result.seek(0)
+                result.truncate()
+    yield result.getvalue().encode('utf8')
+
+
+def write_booking_list_csv(db: PeeweeSession, user: User, start_day_object: date, end_day_object: date, path: str):
+    query = bookings_csv_query(user) \
+        .where(TimeSlot.slot_date.between(start_day_object, end_day_object))
+    with open(path, 'wb') as result:
+        for chunk in csv_chunks(db, query):
+            result.write(chunk)
+
+
+def write_booking_list_xlsx(db: PeeweeSession, user: User, start_day_object: date, end_day_object: date, path: str):
+    """
+    writes the bookings between the given days to an xlsx file at path. xlsxwriter's constant_memory mode flushes
+    every row to disk once the next one starts, and the rows are read through a streaming cursor, so the memory used
+    doesn't grow with the number of bookings.
+    """
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'tmpdir': os.path.dirname(path)})
+    worksheet = workbook.add_worksheet()
+    bold = workbook.add_format({'bold': 1})
+    date_format = workbook.add_format({'num_format': 'dd.mm.yyyy'})
+    time_format = workbook.add_format({'num_format': 'hh:mm'})
+    worksheet.set_column('A:A', 15)
+    worksheet.set_column('B:B', 8)
+    worksheet.set_column('C:C', 18)
+    worksheet.set_column('D:D', 15)
+    worksheet.set_column('E:E', 18)
+    worksheet.set_column('F:F', 15)
+    worksheet.set_column('G:G', 15)
+    worksheet.set_column('H:H', 15)
+    worksheet.set_column('I:I', 15)
+    worksheet.set_column('J:J', 15)
+    worksheet.set_column('K:K', 15)
+    worksheet.set_column('L:L', 15)
+    worksheet.set_column('M:M', 15)
+    worksheet.set_column('N:N', 15)
+    worksheet.set_column('O:O', 15)
+    worksheet.write('A1', 'Termin', bold)
+    worksheet.write('B1', 'Uhrzeit', bold)
+    worksheet.write('C1', 'Vorname', bold)
+    worksheet.write('D1', 'Nachname', bold)
+    worksheet.write('E1', 'Telefon', bold)
+    worksheet.write('F1', 'Straße', bold)
+    worksheet.write('G1', 'Hausnummer', bold)
+    worksheet.write('H1', 'PLZ', bold)
+    worksheet.write('I1', 'Stadt', bold)
+    worksheet.write('J1', 'Geburtdatum', bold)
+    worksheet.write('K1', 'Risikokategorie 1', bold)
+    worksheet.write('L1', 'Berechtigungscode', bold)
+    worksheet.write('M1', 'Behörde', bold)
+    worksheet.write('N1', 'Gebucht von', bold)
+    worksheet.write('O1', 'Gebucht am', bold)
+    row = 1
+    col = 0
+    query = bookings_between(user, start_day_object, end_day_object) \
+        .order_by(TimeSlot.start_date_time.desc(), Booking.id) \
+        .dicts()
+    with db.atomic():
+        for booking in stream_rows(db, query):
+            worksheet.write_datetime(
+                row, col, booking['start_date_time'], date_format)
+            worksheet.write_datetime(
+                row, col + 1, booking['start_date_time'], time_format)
+            worksheet.write_string(
+                row, col + 2, booking['first_name'])
+            worksheet.write_string(row, col + 3, booking['surname'])
+            worksheet.write_string(row, col + 4, booking['phone'])
+            worksheet.write_string(
+                row, col + 5, booking['street'] if booking['street'] is not None else "")
+            worksheet.write_string(
+                row, col + 6, booking['street_number'] if booking['street_number'] is not None else "")
+            worksheet.write_string(
+                row, col + 7, booking['post_code'] if booking['post_code'] is not None else "")
+            worksheet.write_string(
+                row, col + 8, booking['city'] if booking['city'] is not None else "")
+            if booking['birthday'] is None:
+                worksheet.write_string(row, col + 9, "")
+            else:
+                worksheet.write_datetime(
+                    row, col + 9, booking['birthday'], date_format)
+            worksheet.write_string(
+                row, col + 10, booking['reason'] if booking['reason'] is not None else "")
+            worksheet.write_string(row, col + 11, booking['secret'])
+            worksheet.write_string(row, col + 12, booking['office'])
+            worksheet.write_string(
+                row, col + 13, booking['booked_by'])
+            worksheet.write_datetime(
+                row, col + 14, booking['booked_at'], date_format)
+            row += 1
+    workbook.close()
+
+
+WRITERS = {
+    'booking_list.xlsx': write_booking_list_xlsx,
+    'booking_list.csv': write_booking_list_csv,
+}
+
+_executor = None
+
+
+def _init_worker_process():
+    # a forked worker must not share the connection of its parent
+    PeeweeContext._cls_db = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if config.Settings.export_executor == 'process':
+            _executor = ProcessPoolExecutor(max_workers=config.Settings.export_workers,
+                                            initializer=_init_worker_process)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=config.Settings.export_workers,
+                                           thread_name_prefix='export')
+    return _executor
+
+
+def artifact_path(job: ExportJob) -> str:
+    return os.path.join(config.Settings.export_dir, f"{job.job_id}.{job.kind.rsplit('.', 1)[-1]}")
+
+
+def create_job(kind: str, user: User, start_date: date, end_date: date) -> ExportJob:
+    """records the job, WRITERS[kind] writes its artifact once it is queued with queue_job"""
+    if kind not in WRITERS:
+        raise ValueError(f"unknown export kind {kind}")
+    cleanup_expired_jobs()
+    return ExportJob.create(job_id=get_random_string(32), kind=kind, start_date=start_date, end_date=end_date,
+                            requested_by=user.user_name, status=JobStatus.PENDING)
+
+
+def queue_job(job: ExportJob):
+    """
+    hands the job to a worker. Only call it once the transaction that created the job is committed, the worker reads
+    it with a connection of its own.
+    """
+    get_executor().submit(run_job, job.job_id)
+    log.info("queued export job %s (%s) for %s", job.id, job.kind, job.requested_by)
+
+
+def run_job(job_id: str):
+    context = PeeweeContext()
+    try:
+        job = ExportJob.get(ExportJob.job_id == job_id)
+        user = User.get(User.user_name == job.requested_by)
+        started = ExportJob.update(status=JobStatus.RUNNING) \
+            .where((ExportJob.id == job.id) & (ExportJob.status == JobStatus.PENDING)) \
+            .execute()
+        if not started:
+            log.warning("export job %s is %s, not running it", job_id, job.status)
+            return
+        os.makedirs(config.Settings.export_dir, exist_ok=True)
+        path = artifact_path(job)
+        WRITERS[job.kind](context.db, user, job.start_date, job.end_date, path + '.part')
+        os.replace(path + '.part', path)
+        status = JobStatus.DONE
+    except Exception:
+        log.exception("export job %s failed", job_id)
+        status = JobStatus.FAILED
+    try:
+        # a job given up on by fail_stale_jobs meanwhile stays failed
+        ExportJob.update(status=status, finished_at=datetime.now(tz=config.Settings.tz).replace(tzinfo=None)) \
+            .where((ExportJob.job_id == job_id) & (ExportJob.status == JobStatus.RUNNING)).execute()
+    finally:
+        context.cleanup()
+
+
+def fail_stale_jobs(now: datetime = None) -> int:
+    """
+    marks the jobs pending or running for more than config.Settings.export_job_timeout_min as failed, their worker
+    died or they got lost with a restart
+    """
+    now = now or datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+    stale = ExportJob.update(status=JobStatus.FAILED, finished_at=now) \
+        .where(ExportJob.status.in_([JobStatus.PENDING, JobStatus.RUNNING]) &
+               (ExportJob.created_at < now - timedelta(minutes=config.Settings.export_job_timeout_min))) \
+        .execute()
+    if stale:
+        log.warning("gave up on %d stale export jobs", stale)
+    return stale
+
+
+def cleanup_expired_jobs(now: datetime = None) -> int:
+    """
+    removes the artifacts of jobs that finished more than config.Settings.export_ttl_hours ago, and fails the stale
+    ones
+    """
+    now = now or datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+    fail_stale_jobs(now)
+    expired_before = now - timedelta(hours=config.Settings.export_ttl_hours)
+    expired = list(ExportJob.select().where(
+        ExportJob.status.in_([JobStatus.DONE, JobStatus.FAILED]) & (ExportJob.finished_at < expired_before)))
+    for job in expired:
+        path = artifact_path(job)
+        for leftover in [path, path + '.part']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    if expired:
+        ExportJob.update(status=JobStatus.EXPIRED).where(ExportJob.id.in_([job.id for job in expired])).execute()
+        log.info("removed %d expired export artifacts", len(expired))
+    return len(expired)
+
+
+def get_job(job_id: str, user: User):
+    """the job, if it exists and belongs to user"""
+    return ExportJob.get_or_none((ExportJob.job_id == job_id) & (ExportJob.requested_by == user.user_name))
+
+
+def job_status(job: ExportJob):
+    return {
+        "job_id": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "expires_at": job.finished_at + timedelta(hours=config.Settings.export_ttl_hours)
+        if job.status == JobStatus.DONE else None,
+        "download": f"/api/export_job/download?job_id={job.job_id}" if job.status == JobStatus.DONE else None
+    }
@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import hug
+import pytest
+from peewee import SqliteDatabase
+
+import main
+from access_control.access_control import UserRoles
+from config import config
+from conftest import get_user_login, get_valid_user_auth_header, ADMIN, USER
+from db.directives import PeeweeContext
+from db.model import TimeSlot, Appointment, Booking, ExportJob, User, db_proxy, tables
+from export import export
+
+
+class ImmediateExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@pytest.fixture
+def export_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.Settings, "export_dir", str(tmp_path))
+    monkeypatch.setattr(export, "_executor", ImmediateExecutor())
+    return tmp_path
+
+
+def _create_bookings(count):
+    slot = TimeSlot.create(start_date_time=datetime(2020, 4, 20, 10), length_min=10)
+    for i in range(count):
+        Booking.create(surname="Mustermann", first_name="Marianne", phone="0123456789", office="MusterOffice",
+                       secret=f"SECRET{i}", booked_by=USER, booked_at=datetime(2020, 4, 19),
+                       appointment=Appointment.create(booked=True, time_slot=slot))
+
+
+def test_booking_list_xlsx(testing_db, export_dir):
+    _create_bookings(3)
+    response = hug.test.get(main, "/api/booking_list.xlsx", headers=get_user_login(),
+                            start_date="2020-04-20", end_date="2020-04-20")
+    assert response.status == hug.HTTP_200
+    assert response.data[:2] == b"PK"
+    assert list(export_dir.iterdir()) == []
+
+
+def test_large_booking_list_becomes_export_job(testing_db, export_dir, monkeypatch):
+    monkeypatch.setattr(config.Settings, "export_sync_max_rows", 2)
+    _create_bookings(3)
+    response = hug.test.get(main, "/api/booking_list.xlsx", headers=get_user_login(),
+                            start_date="2020-04-20", end_date="2020-04-20")
+    assert response.status == hug.HTTP_202
+    job_id = response.data["job_id"]
+
+    response = hug.test.get(main, "/api/export_job", headers=get_user_login(), job_id=job_id)
+    assert response.status == hug.HTTP_200
+    assert response.data["status"] == export.JobStatus.DONE
+
+    response = hug.test.get(main, "/api/export_job/download", headers=get_user_login(), job_id=job_id)
+    assert response.status == hug.HTTP_200
+    assert response.data[:2] == b"PK"
+
+    # jobs are only visible to whoever requested them
+    response = hug.test.get(main, "/api/export_job", headers=get_valid_user_auth_header(ADMIN, ADMIN),
+                            job_id=job_id)
+    assert response.status == hug.HTTP_404
+
+
+def test_submit_csv_export_job(testing_db, export_dir):
+    _create_bookings(3)
+    response = hug.test.post(main, "/api/export_job", headers=get_user_login(), body={
+        "kind": "booking_list.csv", "start_date": "2020-04-20", "end_date": "2020-04-20"})
+    assert response.status == hug.HTTP_202
+    assert response.data["status"] == export.JobStatus.PENDING
+
+    response = hug.test.get(main, "/api/export_job/download", headers=get_user_login(),
+                            job_id=response.data["job_id"])
+    assert response.status == hug.HTTP_200
+    lines = response.data.splitlines()
+    assert lines[0] == ",".join(export.CSV_FIELDS)
+    assert len(lines) == 4
+
+    response = hug.test.post(main, "/api/export_job", headers=get_user_login(), body={
+        "kind": "booking_list.pdf", "start_date": "2020-04-20", "end_date": "2020-04-20"})
+    assert response.status == hug.HTTP_400
+
+
+def test_cleanup_expired_jobs(testing_db, export_dir):
+    _create_bookings(1)
+    response = hug.test.post(main, "/api/export_job", headers=get_user_login(), body={
+        "kind": "booking_list.xlsx", "start_date": "2020-04-20", "end_date": "2020-04-20"})
+    job = ExportJob.get(ExportJob.job_id == response.data["job_id"])
+    assert len(list(export_dir.iterdir())) == 1
+
+    assert export.cleanup_expired_jobs(job.finished_at + timedelta(hours=1)) == 0
+    assert export.cleanup_expired_jobs(
+        job.finished_at + timedelta(hours=config.Settings.export_ttl_hours, seconds=1)) == 1
+    assert list(export_dir.iterdir()) == []
+    response = hug.test.get(main, "/api/export_job", headers=get_user_login(), job_id=job.job_id)
+    assert response.data["status"] == export.JobStatus.EXPIRED
+    response = hug.test.get(main, "/api/export_job/download", headers=get_user_login(), job_id=job.job_id)
+    assert response.status == hug.HTTP_404
+
+
+def test_export_job_runs_on_a_connection_of_its_own(tmp_path, monkeypatch):
+    # a worker thread only sees the job once the request committed it, an in-memory database is one connection
+    db = SqliteDatabase(str(tmp_path / "termine.db"))
+    db_proxy.initialize(db)
+    db.create_tables(tables)
+    User.create(user_name=USER, salt="", password="", role=UserRoles.USER, coupons=10)
+    _create_bookings(3)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(PeeweeContext, "_cls_db", db)
+    monkeypatch.setattr(config.Settings, "export_dir", str(tmp_path / "exports"))
+    monkeypatch.setattr(export, "_executor", executor)
+
+    response = hug.test.post(main, "/api/export_job", headers=get_user_login(), body={
+        "kind": "booking_list.csv", "start_date": "2020-04-20", "end_date": "2020-04-20"})
+    assert response.status == hug.HTTP_202
+    executor.shutdown(wait=True)
+
+    response = hug.test.get(main, "/api/export_job", headers=get_user_login(), job_id=response.data["job_id"])
+    assert response.data["status"] == export.JobStatus.DONE
+    db.close()
+
+
+def test_stale_jobs_fail(testing_db, export_dir):
+    job = ExportJob.create(job_id="stale", kind="booking_list.csv", start_date=datetime(2020, 4, 20),
+                           end_date=datetime(2020, 4, 20), requested_by=USER, status=export.JobStatus.RUNNING,
+                           created_at=datetime(2020, 4, 20, 10))
+
+    assert export.fail_stale_jobs(datetime(2020, 4, 20, 10, config.Settings.export_job_timeout_min - 1)) == 0
+    assert export.fail_stale_jobs(datetime(2020, 4, 20, 12) + timedelta(minutes=config.Settings.export_job_timeout_min)) \
+        == 1
+    assert ExportJob.get_by_id(job.id).status == export.JobStatus.FAILED
+    # the worker finishing late doesn't revive it
+    export.run_job(job.job_id)
+    assert ExportJob.get_by_id(job.id).status == export.JobStatus.FAILED
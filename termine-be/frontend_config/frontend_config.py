@@ -0,0 +1,75 @@
+"""Serves the frontend config script from memory, rendered again only when the stored config got a new version"""
+import hashlib
+import json
+import logging
+import time
+
+from config import config
+from db.model import FrontendConfig
+
+log = logging.getLogger('frontend_config')
+
+
+def save_frontend_config(new_config: dict):
+    """stores new_config with the next version, workers render it again once they see the version changed"""
+    try:
+        frontend_config = FrontendConfig.get()
+        frontend_config.config = new_config
+        frontend_config.version = (frontend_config.version or 0) + 1
+    except FrontendConfig.DoesNotExist:
+        frontend_config = FrontendConfig(config=new_config)
+    frontend_config.save()
+    frontend_config_cache.clear()
+
+
+class FrontendConfigCache:
+    """
+    the rendered script and its etag, a hash of the script. The version of the stored config is read at most every
+    check_sec seconds, the config itself only when that version changed.
+    """
+
+    def __init__(self, check_sec: int):
+        self.check_sec = check_sec
+        # (version, script, etag, checked_at), replaced as a whole so concurrent requests see a consistent entry
+        self._entry = None
+        self.renders = 0
+
+    def get(self):
+        """the script and its etag, raises FrontendConfig.DoesNotExist without a stored config"""
+        now = time.monotonic()
+        entry = self._entry
+        if entry is not None and now - entry[3] < self.check_sec:
+            return entry[1], entry[2]
+        version = FrontendConfig.select(FrontendConfig.version).scalar()
+        if entry is None or version != entry[0]:
+            frontend_config = FrontendConfig.get()
+            script = f"window.config = {json.dumps(frontend_config.config)};"
+            etag = hashlib.sha256(script.encode('utf8')).hexdigest()[:32]
+            entry = (frontend_config.version, script, etag, now)
+            self.renders += 1
+            log.info("rendered frontend config version %s", frontend_config.version)
+        else:
+            entry = entry[:3] + (now,)
+        self._entry = entry
+        return entry[1], entry[2]
+
+    def clear(self):
+        self._entry = None
+
+
+frontend_config_cache = FrontendConfigCache(config.Settings.frontend_config_check_sec)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """whether an If-None-Match header names etag, weak comparison as RFC 7232 asks for it"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.strip('"') == etag:
+            return True
+    return False
@@ -1,13 +1,14 @@
-import json
 import logging
-import os
 import sys
 import jwt
 import hug
 
 from access_control.access_control import admin_authentication, token_key_authentication, verify_user
+from availability.availability import claim_reaper
 from db.directives import PeeweeContext, PeeweeSession
-from db.model import FrontendConfig
+from frontend_config.frontend_config import frontend_config_cache, etag_matches
+from slot_codes.slot_codes import slot_code_supply
+from static_files.static_files import StaticFiles, static_file
 from config import config
 
 FORMAT = '%(asctime)s - %(levelname)s\t%(name)s: %(message)s'
@@ -48,14 +49,22 @@ def with_admin_api():
     return [admin_api]
 
 
-@hug.static("/")
-def static_dirs():
-    return os.getenv("FE_STATICS_DIR") or "../termine-fe/build/",
+fe_statics = StaticFiles([config.Settings.fe_statics_dir])
+admin_statics = StaticFiles([config.Settings.bo_statics_dir], private=True)
+if config.Settings.static_precompress:
+    fe_statics.precompress()
+    admin_statics.precompress()
 
 
-@hug.static("/admin", requires=admin_authentication)
-def admin_static_dirs():
-    return os.getenv("BO_STATICS_DIR") or "../termine-bo/build/",
+@hug.sink("/", output=static_file)
+def static_dirs(request, response, path=""):
+    return fe_statics.serve(request, response, path)
+
+
+# hug matches sinks as a prefix, the lookahead keeps /adminfoo from the back-office
+@hug.sink("/admin(?=/|$)", requires=admin_authentication, output=static_file)
+def admin_static_dirs(request, response, path=""):
+    return admin_statics.serve(request, response, path)
 
 
 @hug.format.content_type('text/javascript')
@@ -63,16 +72,25 @@ def format_as_js(data: str, request=None, response=None):
     return data.encode('utf8')
 
 
+def config_script(request, response, cache_control: str):
+    script, etag = frontend_config_cache.get()
+    response.set_header('ETag', f'"{etag}"')
+    # the browser asks again on every page load, and gets a 304 until the config changed
+    response.set_header('Cache-Control', cache_control)
+    if etag_matches(request.get_header('If-None-Match'), etag):
+        response.status = hug.HTTP_304
+        return ''
+    return script
+
+
 @hug.get("/config.js", output=format_as_js)
-def instance_config(db: PeeweeSession):
-    with db.atomic():
-        return f"window.config = {json.dumps(FrontendConfig.get().config)};"
+def instance_config(request, response):
+    return config_script(request, response, 'public, no-cache')
 
 
 @hug.get("/admin/config.js", requires=admin_authentication, output=format_as_js)
-def instance_admin_config(db: PeeweeSession):
-    with db.atomic():
-        return f"window.config = {json.dumps(FrontendConfig.get().config)};"
+def instance_admin_config(request, response):
+    return config_script(request, response, 'private, no-cache')
 
 
 @hug.get("/healthcheck")
@@ -90,11 +108,23 @@ def logout_success():
     return 'OK'  # todo could a redirect to / also work?
 
 
+@hug.request_middleware()
+def start_background_threads(request, response):
+    # started by the first request, so every worker process runs a reaper thread of its own, cli commands don't
+    claim_reaper.ensure_started()
+    slot_code_supply.ensure_started()
+
+
 @hug.context_factory(apply_globally=True)
 def create_context(*args, **kwargs):
     return PeeweeContext()
 
 
+@hug.delete_context(apply_globally=True)
+def delete_context(context: PeeweeContext, exception=None, errors=None, lacks_requirement=None):
+    context.cleanup(exception)
+
+
 @hug.extend_api()
 def with_cli():
     import cli
@@ -2,6 +2,8 @@ import hug
 
 import main
 from conftest import get_user_login, get_invalid_login
+from db.model import FrontendConfig
+from frontend_config.frontend_config import frontend_config_cache
 
 
 def test_test():
@@ -17,3 +19,30 @@ def test_auth_no_verify(testing_db):
 def test_auth_user_verify(testing_db):
     response = hug.test.get(main, "/config.js", headers=get_user_login())
     assert response.status == hug.HTTP_200
+
+
+def test_config_js_is_cached(testing_db, monkeypatch):
+    monkeypatch.setattr(frontend_config_cache, "check_sec", 0)
+    response = hug.test.get(main, "/config.js")
+    assert response.status == hug.HTTP_200
+    assert response.data.startswith("window.config = ")
+    assert response.headers_dict["Cache-Control"] == "public, no-cache"
+    etag = response.headers_dict["ETag"]
+    renders = frontend_config_cache.renders
+    response = hug.test.get(main, "/config.js", headers={"If-None-Match": f"W/{etag}, \"other\""})
+    assert response.status == hug.HTTP_304
+    assert frontend_config_cache.renders == renders
+    response = hug.test.get(main, "/config.js", headers={"If-None-Match": "\"other\""})
+    assert response.status == hug.HTTP_200
+
+    hug.test.cli("set_frontend_config", instance_name="changed", long_instance_name="changed",
+                 contact_info_bookings="test@example.org", for_real=True, module="main")
+    assert FrontendConfig.get().version == 2
+    hug.test.get(main, "/config.js")
+    assert frontend_config_cache.renders == renders + 1
+
+    # written by another process, seen through the version
+    FrontendConfig.update(version=FrontendConfig.version + 1).execute()
+    hug.test.get(main, "/config.js")
+    hug.test.get(main, "/config.js")
+    assert frontend_config_cache.renders == renders + 2
@@ -0,0 +1,128 @@
+"""
+Password hashes as stored in User.password: '$<scheme>$<parameters>$<salt>$<hash>', e.g.
+'$pbkdf2-sha256$i=200000$Dk3cXwWq...$bWFp...' or '$scrypt$n=16384,r=8,p=1$...'. The salt is part of the hash, User.salt
+is only read for the legacy hashes without a scheme, the sha512 hex digests of secret_token.hash_pw. Those and hashes
+of another scheme or cost than configured are replaced on the next successful login.
+
+Hashing runs in a small thread pool. hashlib releases the GIL while it hashes, so the other requests of a worker go on
+and no more than PASSWORD_HASH_THREADS hashes are computed by a worker at a time.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+from secret_token.secret_token import hash_pw, token_generator
+
+log = logging.getLogger('password_hash')
+
+SALT_LENGTH = 22
+
+
+class Hasher:
+    scheme = None
+
+    def __init__(self, **parameters):
+        self.parameters = parameters
+
+    def digest(self, password: str, salt: str) -> bytes:
+        raise NotImplementedError
+
+    def encode(self, password: str, salt: str) -> str:
+        parameters = ','.join(f"{key}={value}" for key, value in sorted(self.parameters.items()))
+        digest = base64.b64encode(self.digest(password, salt)).decode('ascii')
+        return f"${self.scheme}${parameters}${salt}${digest}"
+
+
+class Pbkdf2Hasher(Hasher):
+    scheme = 'pbkdf2-sha256'
+
+    def digest(self, password: str, salt: str) -> bytes:
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf8'), salt.encode('ascii'), self.parameters['i'])
+
+
+class ScryptHasher(Hasher):
+    scheme = 'scrypt'
+
+    def digest(self, password: str, salt: str) -> bytes:
+        n, r, p = self.parameters['n'], self.parameters['r'], self.parameters['p']
+        # scrypt needs 128 * n * r bytes, the default limit of openssl is 32 MiB
+        return hashlib.scrypt(password.encode('utf8'), salt=salt.encode('ascii'), n=n, r=r, p=p,
+                              maxmem=256 * n * r, dklen=32)
+
+
+HASHERS = {hasher.scheme: hasher for hasher in [Pbkdf2Hasher, ScryptHasher]}
+
+
+def configured_hasher() -> Hasher:
+    """the hasher of PASSWORD_HASHER with its configured cost"""
+    settings = config.Settings
+    if settings.password_hasher == ScryptHasher.scheme:
+        return ScryptHasher(n=settings.password_hash_scrypt_n, r=settings.password_hash_scrypt_r,
+                            p=settings.password_hash_scrypt_p)
+    return Pbkdf2Hasher(i=settings.password_hash_iterations)
+
+
+def _parse(stored: str):
+    """'$scheme$a=1,b=2$salt$hash' -> the hasher of scheme with its parameters, salt, hash; None for legacy hashes"""
+    if not stored.startswith('$'):
+        return None
+    try:
+        _, scheme, parameters, salt, digest = stored.split('$')
+        values = dict(parameter.split('=') for parameter in parameters.split(','))
+        return HASHERS[scheme](**{key: int(value) for key, value in values.items()}), salt, digest
+    except (ValueError, KeyError):
+        log.error("unknown password hash format: %s", stored[:20])
+        return None
+
+
+def encode_password(password: str, hasher: Hasher = None) -> str:
+    """the hash to store for password, computed in the calling thread"""
+    return (hasher or configured_hasher()).encode(password, token_generator(SALT_LENGTH).generate())
+
+
+def password_matches(user_name: str, salt: str, password: str, stored: str) -> bool:
+    """whether password hashes to stored, computed in the calling thread and compared in constant time"""
+    if not stored.startswith('$'):
+        return hmac.compare_digest(hash_pw(user_name, salt, password).encode('ascii'), stored.encode('ascii'))
+    parsed = _parse(stored)
+    if parsed is None:
+        return False
+    hasher, salt, digest = parsed
+    return hmac.compare_digest(hasher.encode(password, salt).encode('ascii'), stored.encode('ascii'))
+
+
+def needs_rehash(stored: str) -> bool:
+    """whether stored is a legacy hash or one of another scheme or cost than configured"""
+    parsed = _parse(stored)
+    if parsed is None:
+        return True
+    hasher, _, _ = parsed
+    current = configured_hasher()
+    return hasher.scheme != current.scheme or hasher.parameters != current.parameters
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def hashing_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=config.Settings.password_hash_threads,
+                                       thread_name_prefix='password-hash')
+        return _pool
+
+
+def hash_password(password: str) -> str:
+    """encode_password in the hashing pool"""
+    return hashing_pool().submit(encode_password, password).result()
+
+
+def check_password(user_name: str, salt: str, password: str, stored: str) -> bool:
+    """password_matches in the hashing pool"""
+    return hashing_pool().submit(password_matches, user_name, salt, password, stored).result()
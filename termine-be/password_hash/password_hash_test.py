@@ -0,0 +1,44 @@
+from access_control.access_control import verify_user
+from config import config
+from conftest import USER
+from db.directives import PeeweeContext
+from db.model import User
+from password_hash.password_hash import encode_password, password_matches, needs_rehash
+from secret_token.secret_token import hash_pw
+
+
+def test_legacy_hash_is_upgraded_on_login(testing_db):
+    User.update(salt="ab", password=hash_pw(USER, "ab", USER)).where(User.user_name == USER).execute()
+    assert not verify_user(USER, "wrong", PeeweeContext())
+    assert User.get(User.user_name == USER).salt == "ab"
+
+    assert verify_user(USER, USER, PeeweeContext())
+
+    user = User.get(User.user_name == USER)
+    assert user.salt == ""
+    assert user.password.startswith("$pbkdf2-sha256$i=1000$")
+    assert not needs_rehash(user.password)
+    assert verify_user(USER, USER, PeeweeContext())
+    assert User.get(User.user_name == USER).password == user.password
+
+
+def test_changed_cost_is_applied_on_login(testing_db, monkeypatch):
+    monkeypatch.setattr(config.Settings, "password_hasher", "scrypt")
+    monkeypatch.setattr(config.Settings, "password_hash_scrypt_n", 1024)
+    assert verify_user(USER, USER, PeeweeContext())
+    hashed = User.get(User.user_name == USER).password
+    assert hashed.startswith("$scrypt$n=1024,p=1,r=8$")
+
+    monkeypatch.setattr(config.Settings, "password_hash_scrypt_n", 2048)
+    assert needs_rehash(hashed)
+    assert verify_user(USER, USER, PeeweeContext())
+    assert User.get(User.user_name == USER).password.startswith("$scrypt$n=2048,")
+
+
+def test_password_matches():
+    hashed = encode_password("secret")
+    assert hashed != encode_password("secret")
+    assert password_matches("name", "", "secret", hashed)
+    assert not password_matches("name", "", "secreT", hashed)
+    assert not password_matches("name", "", "secret", "$md5$i=1$salt$hash")
+    assert not password_matches("name", "", "secret", "$pbkdf2-sha256$broken")
@@ -0,0 +1,92 @@
+"""Generates time slots and their appointments for whole date ranges, written in batches"""
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List
+
+from peewee import Database
+
+from availability.availability import add_slot_counters
+from db.model import TimeSlot, Appointment
+
+log = logging.getLogger('schedule')
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# rows per INSERT, well below the 999 parameters older sqlite versions allow per statement: a time slot takes 3
+TIME_SLOTS_PER_INSERT = 300
+APPOINTMENTS_PER_INSERT = 400
+
+
+def parse_excluded_days(excluded_days: str):
+    """'sun,2021-04-05' -> ({6}, {date(2021, 4, 5)}), weekdays by their first three letters or dates in iso format"""
+    weekdays = set()
+    dates = set()
+    for day in filter(None, (part.strip().lower() for part in excluded_days.split(','))):
+        if day[:3] in WEEKDAYS:
+            weekdays.add(WEEKDAYS.index(day[:3]))
+        else:
+            dates.add(date.fromisoformat(day))
+    return weekdays, dates
+
+
+def slot_starts(start_day: date, end_day: date, open_from: time, open_until: time, slot_duration_min: int,
+                excluded_days: str = '') -> Iterable[datetime]:
+    """the start of every slot that ends within opening hours, on every day from start_day to end_day inclusive"""
+    excluded_weekdays, excluded_dates = parse_excluded_days(excluded_days)
+    day = start_day
+    while day <= end_day:
+        if day.weekday() not in excluded_weekdays and day not in excluded_dates:
+            start = datetime.combine(day, open_from)
+            closing = datetime.combine(day, open_until)
+            while start + timedelta(minutes=slot_duration_min) <= closing:
+                yield start
+                start += timedelta(minutes=slot_duration_min)
+        day += timedelta(days=1)
+
+
+def _chunks(items: Iterable, size: int) -> Iterable[List]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert_time_slots(db: Database, starts: List[datetime], slot_duration_min: int) -> List[int]:
+    rows = [{'start_date_time': start, 'length_min': slot_duration_min} for start in starts]
+    if db.returning_clause:
+        # INSERT INTO timeslot (...) VALUES (...), (...) RETURNING id
+        return [row[0] for row in TimeSlot.insert_many(rows).returning(TimeSlot.id).tuples().execute()]
+    TimeSlot.insert_many(rows).execute()
+    # without RETURNING the new ids are read back, the newest slot of each start wins
+    ids = {}
+    for slot in TimeSlot.select(TimeSlot.id, TimeSlot.start_date_time) \
+            .where(TimeSlot.start_date_time.between(starts[0], starts[-1])) \
+            .order_by(TimeSlot.id):
+        ids[slot.start_date_time] = slot.id
+    return [ids[start] for start in starts]
+
+
+def create_slots(db: Database, starts: Iterable[datetime], slot_duration_min: int, appointments_per_slot: int,
+                 batch_size: int = 500):
+    """
+    inserts the time slots starting at starts with appointments_per_slot appointments each, batch_size time slots
+    per transaction. Returns the number of time slots and of appointments created.
+    """
+    num_slots = 0
+    num_appointments = 0
+    for chunk in _chunks(starts, batch_size):
+        with db.atomic():
+            slot_ids = [slot_id for starts_chunk in _chunks(chunk, TIME_SLOTS_PER_INSERT)
+                        for slot_id in _insert_time_slots(db, starts_chunk, slot_duration_min)]
+            appointments = [{'booked': False, 'time_slot': slot_id}
+                            for slot_id in slot_ids for _ in range(appointments_per_slot)]
+            for appointment_chunk in _chunks(appointments, APPOINTMENTS_PER_INSERT):
+                Appointment.insert_many(appointment_chunk).execute()
+            add_slot_counters(slot_ids, appointments_per_slot)
+        num_slots += len(slot_ids)
+        num_appointments += len(appointments)
+        log.debug("created %d time slots up to %s", num_slots, chunk[-1])
+    return num_slots, num_appointments
@@ -0,0 +1,24 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from config import config
+from db.model import TimeSlot, Appointment, SlotCounter
+from schedule.schedule import create_slots
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "setlimit"), reason="needs python 3.11")
+def test_create_slots_within_old_sqlite_parameter_limit(testing_db, monkeypatch):
+    monkeypatch.setattr(config.Settings, "slot_counters", True)
+    connection = testing_db.connection()
+    limit = connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        start = datetime(2030, 4, 20, 8)
+        starts = [start + timedelta(minutes=10 * i) for i in range(500)]
+        assert create_slots(testing_db, starts, 10, 2) == (500, 1000)
+    finally:
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+    assert TimeSlot.select().count() == 500
+    assert Appointment.select().count() == 1000
+    assert SlotCounter.select().count() == 500
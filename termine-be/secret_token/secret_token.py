@@ -1,17 +1,75 @@
 import hashlib
-import random
+import secrets
 import string
+from functools import lru_cache
+from typing import List
 
 from config import config
 
+SECRET_TOKEN_LETTERS = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
+
+
+class TokenGenerator:
+    """
+    random strings of length characters of alphabet from secrets.token_bytes. The bytes of a whole batch are drawn at
+    once and mapped to the alphabet with a single bytes.translate, the ones beyond the largest multiple of the
+    alphabet size are dropped, so every character is equally likely.
+    """
+
+    def __init__(self, length: int, alphabet: str = string.ascii_letters):
+        assert 0 < len(alphabet) <= 256
+        self.length = length
+        self.alphabet = alphabet
+        self._accepted = 256 - 256 % len(alphabet)
+        self._table = bytes(ord(alphabet[byte % len(alphabet)]) if byte < self._accepted else 0 for byte in range(256))
+        self._rejected = bytes(range(self._accepted, 256))
+
+    def characters(self, count: int) -> str:
+        drawn = b''
+        while len(drawn) < count:
+            # a few more bytes than needed on average, another round is rarely necessary
+            missing = count - len(drawn)
+            drawn += secrets.token_bytes(missing * 256 // self._accepted + 8).translate(self._table, self._rejected)
+        return drawn[:count].decode('ascii')
+
+    def generate(self) -> str:
+        return self.characters(self.length)
+
+    def generate_many(self, n: int) -> List[str]:
+        drawn = self.characters(n * self.length)
+        return [drawn[start:start + self.length] for start in range(0, n * self.length, self.length)]
+
+
+class SecretTokenGenerator(TokenGenerator):
+    """the codes of bookings, e.g. 'K-34512': a letter, a dash and length - 1 digits"""
+
+    def __init__(self, length: int):
+        super().__init__(length - 1, string.digits)
+        self._letters = TokenGenerator(1, SECRET_TOKEN_LETTERS)
+
+    def generate(self) -> str:
+        return self._letters.characters(1) + '-' + self.characters(self.length)
+
+    def generate_many(self, n: int) -> List[str]:
+        return [letter + '-' + digits for letter, digits in zip(self._letters.characters(n), super().generate_many(n))]
+
+
+@lru_cache(maxsize=None)
+def token_generator(length: int) -> TokenGenerator:
+    return TokenGenerator(length)
+
+
+@lru_cache(maxsize=None)
+def secret_token_generator(length: int) -> SecretTokenGenerator:
+    return SecretTokenGenerator(length)
+
 
 def get_secret_token(length: int) -> str:
-    letters = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
-    return random.choice(letters) + '-' + ''.join([random.choice(string.digits) for _ in range(length - 1)])
+    return secret_token_generator(length).generate()
 
 
 def get_random_string(length: int) -> str:
-    return ''.join([random.choice(string.ascii_letters) for _ in range(length)])
+    return token_generator(length).generate()
 
 
 def hash_secret(secret: str) -> str:
@@ -0,0 +1,25 @@
+import re
+import string
+from collections import Counter
+
+from secret_token.secret_token import TokenGenerator, SecretTokenGenerator, get_secret_token, get_random_string
+
+
+def test_generate_many():
+    tokens = TokenGenerator(32).generate_many(100)
+    assert len(tokens) == 100 == len(set(tokens))
+    assert all(len(token) == 32 and set(token) <= set(string.ascii_letters) for token in tokens)
+    assert TokenGenerator(5).generate_many(0) == []
+    assert re.fullmatch(r'[A-Za-z]{12}', get_random_string(12))
+
+
+def test_secret_tokens():
+    assert all(re.fullmatch(r'[A-HJ-NP-Z]-[0-9]{5}', secret) for secret in SecretTokenGenerator(6).generate_many(50))
+    assert re.fullmatch(r'[A-HJ-NP-Z]-[0-9]{5}', get_secret_token(6))
+
+
+def test_characters_are_uniform():
+    # 52 letters don't divide 256, without dropping the bytes beyond 208 the first 48 letters would come up more often
+    counts = Counter(TokenGenerator(1).characters(52 * 2000))
+    assert set(counts) == set(string.ascii_letters)
+    assert max(counts.values()) < 2400 and min(counts.values()) > 1600
@@ -0,0 +1,213 @@
+"""
+Hands out the booking codes of a day from a pool filled ahead of time, so a booking takes its code with a single
+statement instead of trying random codes until one is new for the day
+"""
+import logging
+import random
+import threading
+import time
+from datetime import date, datetime
+
+from peewee import fn, IntegrityError
+
+from config import config
+from db.directives import PeeweeContext
+from db.model import SlotCode, SlotCodePool, TimeSlot, Appointment
+from secret_token.secret_token import get_secret_token, secret_token_generator
+
+log = logging.getLogger('slot_codes')
+
+SECRET_LENGTH = 6
+# well below the 999 parameters older sqlite versions allow per statement
+FILL_BATCH_SIZE = 400
+
+
+def pool_enabled() -> bool:
+    return config.Settings.slot_code_pool_size > 0
+
+
+def new_slot_code(db, day: date) -> str:
+    """
+    a random code that is new for day, reserved in SlotCode. Each collision costs a failed insert, and they get
+    frequent once a day has many codes.
+    """
+    while True:
+        secret = get_secret_token(SECRET_LENGTH)
+        try:
+            # a savepoint per try, a failed insert would abort the whole transaction on postgres
+            with db.atomic():
+                SlotCode.create(date=day, secret=secret)
+            return secret
+        except IntegrityError:
+            log.debug("slot code %s of %s is taken, trying another one", secret, day)
+
+
+def pop_slot_code(db, day: date):
+    """
+    DELETE FROM slotcodepool
+    WHERE id = (SELECT id FROM slotcodepool WHERE date = :day ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING secret
+
+    a code from the pool of day, None if it is empty. Concurrent bookings skip the codes the others are taking.
+    """
+    first = SlotCodePool.select(SlotCodePool.id).where(SlotCodePool.date == day).order_by(SlotCodePool.id).limit(1)
+    if db.for_update:
+        popped = SlotCodePool.delete() \
+            .where(SlotCodePool.id == first.for_update('FOR UPDATE SKIP LOCKED')) \
+            .returning(SlotCodePool.secret) \
+            .tuples() \
+            .execute()
+        for secret, in popped:
+            return secret
+        return None
+    # sqlite has a single writer, the code read can't be taken by anyone else before it is deleted
+    for pooled in first.select(SlotCodePool.id, SlotCodePool.secret):
+        SlotCodePool.delete().where(SlotCodePool.id == pooled.id).execute()
+        return pooled.secret
+    return None
+
+
+def pool_targets(today: date) -> dict:
+    """
+    SELECT t.slot_date, COUNT(*) FROM timeslot t JOIN appointment a ON a.time_slot_id = t.id
+    WHERE t.slot_date >= :today AND NOT a.booked
+    GROUP BY t.slot_date
+
+    the number of codes to keep for each upcoming day: one per appointment still to be booked, at most
+    SLOT_CODE_POOL_SIZE
+    """
+    unbooked = TimeSlot.select(TimeSlot.slot_date, fn.COUNT(Appointment.id)) \
+        .join(Appointment) \
+        .where((TimeSlot.slot_date >= today) & (Appointment.booked == False)) \
+        .group_by(TimeSlot.slot_date) \
+        .tuples()
+    return {day: min(count, config.Settings.slot_code_pool_size) for day, count in unbooked}
+
+
+def pool_levels(today: date) -> dict:
+    """SELECT date, COUNT(*) FROM slotcodepool WHERE date >= :today GROUP BY date"""
+    return dict(SlotCodePool.select(SlotCodePool.date, fn.COUNT(SlotCodePool.id))
+                .where(SlotCodePool.date >= today)
+                .group_by(SlotCodePool.date)
+                .tuples())
+
+
+def _reserve_codes(db, day: date, count: int) -> list:
+    """
+    INSERT INTO slotcode (date, secret) VALUES ... ON CONFLICT DO NOTHING RETURNING secret
+
+    up to count new random codes of day, reserved in SlotCode. The ones a booking or another filler already has are
+    left out.
+    """
+    candidates = list(set(secret_token_generator(SECRET_LENGTH).generate_many(count)))
+    rows = [{'date': day, 'secret': secret} for secret in candidates]
+    if db.returning_clause:
+        inserted = SlotCode.insert_many(rows).on_conflict_ignore().returning(SlotCode.secret).tuples().execute()
+        return [secret for secret, in inserted]
+    taken = {secret for secret, in SlotCode.select(SlotCode.secret)
+             .where((SlotCode.date == day) & SlotCode.secret.in_(candidates)).tuples()}
+    new = [secret for secret in candidates if secret not in taken]
+    if new:
+        # a code reserved since it was checked fails the batch, which is rolled back and tried again on the next fill
+        SlotCode.insert_many([{'date': day, 'secret': secret} for secret in new]).execute()
+    return new
+
+
+def fill_slot_code_pool(db, today: date) -> int:
+    """
+    tops the pool of every upcoming day up to its target, FILL_BATCH_SIZE codes per transaction, and drops the codes
+    of past days. Safe to run next to bookings and other fillers. Returns the number of codes added.
+    """
+    SlotCodePool.delete().where(SlotCodePool.date < today).execute()
+    levels = pool_levels(today)
+    added = 0
+    for day, target in sorted(pool_targets(today).items()):
+        missing = target - levels.get(day, 0)
+        while missing > 0:
+            with db.atomic():
+                reserved = _reserve_codes(db, day, min(missing, FILL_BATCH_SIZE))
+                random.shuffle(reserved)
+                if reserved:
+                    SlotCodePool.insert_many([{'date': day, 'secret': secret} for secret in reserved]).execute()
+            if not reserved:
+                log.warning("no new slot codes left for %s", day)
+                break
+            missing -= len(reserved)
+            added += len(reserved)
+    return added
+
+
+class SlotCodeSupply:
+    """
+    takes the codes for bookings from the pool, or makes one up while the pool is disabled or empty, and tops the pool
+    up every config.Settings.slot_code_pool_interval_sec in a daemon thread of this process
+    """
+
+    def __init__(self):
+        self.popped = 0
+        self.generated = 0
+        self.runs = 0
+        self.added = 0
+        self.last_added = None
+        self.last_run_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def take(self, db, day: date) -> str:
+        secret = pop_slot_code(db, day) if pool_enabled() else None
+        with self._lock:
+            if secret is not None:
+                self.popped += 1
+                return secret
+            self.generated += 1
+        if pool_enabled():
+            log.warning("the slot code pool of %s is empty", day)
+        return new_slot_code(db, day)
+
+    def ensure_started(self):
+        if self._thread is not None or not pool_enabled() or config.Settings.slot_code_pool_interval_sec <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slot-code-pool', daemon=True)
+                self._thread.start()
+
+    def run_once(self, db) -> int:
+        now = datetime.now(tz=config.Settings.tz).replace(tzinfo=None)
+        added = fill_slot_code_pool(db, now.date())
+        self.runs += 1
+        self.added += added
+        self.last_added = added
+        self.last_run_at = now
+        log.info("added %d codes to the slot code pool", added)
+        return added
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once(PeeweeContext().db)
+            except Exception:
+                log.exception("filling the slot code pool failed")
+            finally:
+                PeeweeContext.release_connection()
+            time.sleep(config.Settings.slot_code_pool_interval_sec)
+
+    def stats(self):
+        today = datetime.now(tz=config.Settings.tz).date()
+        levels = pool_levels(today) if pool_enabled() else {}
+        targets = pool_targets(today) if pool_enabled() else {}
+        return {
+            "enabled": pool_enabled(),
+            "thread": self._thread is not None,
+            "popped": self.popped,
+            "generated": self.generated,
+            "runs": self.runs,
+            "added": self.added,
+            "last_added": self.last_added,
+            "last_run_at": self.last_run_at,
+            "levels": [{"date": day, "codes": levels.get(day, 0), "target": target}
+                       for day, target in sorted(targets.items())],
+        }
+
+
+slot_code_supply = SlotCodeSupply()
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+import hug
+
+from api import api
+from config import config
+from conftest import USER
+from db.model import TimeSlot, Appointment, User, SlotCode, SlotCodePool
+from slot_codes.slot_codes import pool_levels, slot_code_supply
+
+
+def _slot(start, num_appointments):
+    slot = TimeSlot.create(start_date_time=start, length_min=10)
+    for i in range(num_appointments):
+        Appointment.create(booked=False, time_slot=slot, claim_token=f"{start.date()}-{i}", claimed_at=datetime.now())
+    return slot
+
+
+def _book(db, start, i):
+    body = {"claim_token": f"{start.date()}-{i}", "start_date_time": start.isoformat(), "first_name": "Marianne",
+            "name": "Mustermann", "phone": "0123456789", "office": "MusterOffice"}
+    return api.book_appointment(db, body, User.get(User.user_name == USER))["secret"]
+
+
+def test_bookings_take_codes_from_the_pool(testing_db, monkeypatch):
+    monkeypatch.setattr(config.Settings, "slot_code_pool_size", 3)
+    start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    _slot(start, 5)
+    yesterday = start.date() - timedelta(days=2)
+    SlotCodePool.create(date=yesterday, secret="A-00000")
+
+    hug.test.cli("fill_slot_code_pool", module="main")
+
+    assert pool_levels(yesterday) == {start.date(): 3}
+    pooled = {code.secret for code in SlotCodePool.select()}
+    popped = slot_code_supply.popped
+    secrets = [_book(testing_db, start, i) for i in range(2)]
+    assert set(secrets) <= pooled
+    assert slot_code_supply.popped == popped + 2
+    assert pool_levels(start.date()) == {start.date(): 1}
+    assert SlotCode.select().where(SlotCode.date == start.date()).count() == 3
+
+    assert slot_code_supply.run_once(testing_db) == 2
+    levels = slot_code_supply.stats()["levels"]
+    assert levels == [{"date": start.date(), "codes": 3, "target": 3}]
+
+
+def test_empty_pool_makes_up_a_code(testing_db, monkeypatch):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    _slot(start, 2)
+    generated = slot_code_supply.generated
+    assert _book(testing_db, start, 0)
+    monkeypatch.setattr(config.Settings, "slot_code_pool_size", 3)
+    assert _book(testing_db, start, 1)
+    assert slot_code_supply.generated == generated + 2
+    assert SlotCode.select().where(SlotCode.date == start.date()).count() == 2
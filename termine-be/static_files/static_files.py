@@ -0,0 +1,154 @@
+"""
+Serves the builds of the frontends: precompressed siblings of a file when the client accepts them, hashed file names
+cached for good, conditional requests answered with 304, and the file itself handed to the server as a stream, which
+gunicorn sends through wsgi.file_wrapper and sendfile
+"""
+import gzip
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from email.utils import formatdate, parsedate_to_datetime
+
+import hug
+
+from frontend_config.frontend_config import etag_matches
+
+try:
+    import brotli
+except ImportError:
+    # .br siblings are only written with brotli installed, the ones there are served anyway
+    brotli = None
+
+log = logging.getLogger('static_files')
+
+# the build puts a content hash in the names of everything but index.html, e.g. main.5ecd60a1.chunk.js
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+IMMUTABLE = 'max-age=31536000, immutable'
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico', '.xml', '.webmanifest')
+# in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+MIN_COMPRESS_SIZE = 1024
+
+
+@hug.format.content_type('file/dynamic')
+def static_file(data, request=None, response=None):
+    """the file StaticFiles.serve opened, hug streams it with its size. The content type is set by serve."""
+    return data
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """'gzip, br;q=0.5, deflate;q=0' -> {'gzip', 'br'}"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _newer_than(path: str, source: str) -> bool:
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+class StaticFiles:
+    def __init__(self, directories, private: bool = False):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        # a build behind a login is kept out of shared caches
+        self.scope = 'private' if private else 'public'
+
+    def find(self, path: str):
+        """the file at path in the first directory that has it, index.html for directories, None if there is none"""
+        for directory in self.directories:
+            found = os.path.abspath(os.path.join(directory, path.lstrip('/')))
+            if found != directory and not found.startswith(directory + os.sep):
+                return None
+            if os.path.isdir(found):
+                found = os.path.join(found, 'index.html')
+            if os.path.isfile(found):
+                return found
+        return None
+
+    def serve(self, request, response, path: str):
+        found = self.find(path)
+        if found is None:
+            raise hug.HTTPNotFound()
+        served, encoding = found, None
+        if found.endswith(COMPRESSIBLE):
+            response.set_header('Vary', 'Accept-Encoding')
+            accepted = accepted_encodings(request.get_header('Accept-Encoding'))
+            for coding, suffix in ENCODINGS:
+                if coding in accepted and _newer_than(found + suffix, found):
+                    served, encoding = found + suffix, coding
+                    break
+        stat = os.stat(found)
+        # a strong etag for each encoding of the file, from the file it was made of
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}" + (f"-{encoding}" if encoding else '')
+        response.set_header('ETag', f'"{etag}"')
+        response.set_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+        if HASHED_NAME.search(os.path.basename(found)):
+            response.set_header('Cache-Control', f'{self.scope}, {IMMUTABLE}')
+        else:
+            response.set_header('Cache-Control', f'{self.scope}, no-cache')
+        if self.not_modified(request, etag, stat.st_mtime):
+            response.status = hug.HTTP_304
+            return b''
+        response.content_type = mimetypes.guess_type(found)[0] or 'application/octet-stream'
+        if encoding:
+            response.set_header('Content-Encoding', encoding)
+        return open(served, 'rb')
+
+    @staticmethod
+    def not_modified(request, etag: str, mtime: float) -> bool:
+        """If-None-Match wins over If-Modified-Since, as RFC 7232 asks for it"""
+        if_none_match = request.get_header('If-None-Match')
+        if if_none_match:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = request.get_header('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def precompress(self, min_size: int = MIN_COMPRESS_SIZE) -> int:
+        """
+        writes a .gz sibling, and with brotli installed a .br sibling, of every compressible file of at least min_size
+        bytes that has none or an older one. Returns the number of files written.
+        """
+        written = 0
+        for directory in self.directories:
+            for root, _, names in os.walk(directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < min_size:
+                        continue
+                    with open(path, 'rb') as f:
+                        content = None
+                        for suffix, compress in [('.gz', lambda data: gzip.compress(data, 9)),
+                                                 ('.br', brotli and brotli.compress)]:
+                            if compress and not _newer_than(path + suffix, path):
+                                content = content if content is not None else f.read()
+                                _write_atomically(path + suffix, compress(content))
+                                written += 1
+        if written:
+            log.info("precompressed %d static files in %s", written, self.directories)
+        return written
+
+
+def _write_atomically(path: str, data: bytes):
+    # several workers may precompress at the same time, each of them replaces the file as a whole
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.precompress-')
+    with os.fdopen(handle, 'wb') as f:
+        f.write(data)
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, path)
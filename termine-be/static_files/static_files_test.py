@@ -0,0 +1,73 @@
+import gzip
+from email.utils import formatdate
+
+import hug
+import pytest
+
+import main
+from conftest import get_admin_login
+from static_files.static_files import accepted_encodings
+
+SCRIPT = "console.log('termine');\n" * 100
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_text("<html></html>")
+    (tmp_path / "static" / "js" / "main.5ecd60a1.chunk.js").write_text(SCRIPT)
+    monkeypatch.setattr(main.fe_statics, "directories", [str(tmp_path)])
+    return tmp_path
+
+
+def test_precompressed_and_immutable(testing_db, build):
+    assert main.fe_statics.precompress() >= 1
+    assert main.fe_statics.precompress() == 0
+    response = hug.test.get(main, "/static/js/main.5ecd60a1.chunk.js", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.status == hug.HTTP_200
+    assert response.headers_dict["Content-Encoding"] == "gzip"
+    assert response.headers_dict["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert response.headers_dict["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.data).decode("utf8") == SCRIPT
+
+    response = hug.test.get(main, "/static/js/main.5ecd60a1.chunk.js")
+    assert "Content-Encoding" not in response.headers_dict
+    assert response.data == SCRIPT
+
+
+def test_conditional_requests(testing_db, build):
+    response = hug.test.get(main, "/")
+    assert response.status == hug.HTTP_200
+    assert response.data == "<html></html>"
+    assert response.headers_dict["Cache-Control"] == "public, no-cache"
+    etag = response.headers_dict["ETag"]
+    assert hug.test.get(main, "/index.html", headers={"If-None-Match": etag}).status == hug.HTTP_304
+    assert hug.test.get(main, "/", headers={"If-None-Match": '"other"'}).status == hug.HTTP_200
+    last_modified = response.headers_dict["Last-Modified"]
+    assert hug.test.get(main, "/", headers={"If-Modified-Since": last_modified}).status == hug.HTTP_304
+    assert hug.test.get(main, "/", headers={"If-Modified-Since": formatdate(0, usegmt=True)}).status == \
+        hug.HTTP_200
+
+
+def test_outside_of_build(testing_db, build):
+    (build.parent / "secret.txt").write_text("secret")
+    assert hug.test.get(main, "/../secret.txt").status == hug.HTTP_404
+    assert hug.test.get(main, "/missing.js").status == hug.HTTP_404
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, br;q=0.5, deflate;q=0") == {"gzip", "br"}
+    assert accepted_encodings(None) == set()
+
+
+def test_admin_prefix_only(testing_db, build, tmp_path_factory, monkeypatch):
+    admin_build = tmp_path_factory.mktemp("admin")
+    (admin_build / "index.html").write_text("<html>admin</html>")
+    monkeypatch.setattr(main.admin_statics, "directories", [str(admin_build)])
+    (build / "adminfoo").write_text("frontend")
+    assert hug.test.get(main, "/admin/index.html").status == hug.HTTP_401
+    assert hug.test.get(main, "/admin").status == hug.HTTP_401
+    response = hug.test.get(main, "/admin/index.html", headers=get_admin_login())
+    assert (response.status, response.data) == (hug.HTTP_200, "<html>admin</html>")
+    response = hug.test.get(main, "/adminfoo")
+    assert (response.status, response.data) == (hug.HTTP_200, "frontend")
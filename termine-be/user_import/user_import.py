@@ -0,0 +1,135 @@
+"""Imports many users at once from a file, with their passwords hashed in worker processes, safe to run again"""
+import csv
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, List
+
+from peewee import Database
+
+from access_control.access_control import UserRoles, user_cache, credential_cache
+from db.model import User
+from password_hash.password_hash import encode_password
+from secret_token.secret_token import token_generator
+
+log = logging.getLogger('user_import')
+
+CREDENTIAL_FIELDS = ['name', 'role', 'coupons', 'password']
+
+
+def read_rows(path: str) -> Iterable[dict]:
+    """
+    the users in path, by extension: .csv with a header of name, role, coupons and password, .jsonl with one object of
+    those keys per line, anything else one user name per line. Only name is required.
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+        elif path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for line in f:
+                yield {'name': line}
+
+
+def parse_rows(rows: Iterable[dict], default_role: str, default_coupons: int) -> Iterable[dict]:
+    """the normalized rows, the ones with an empty name, an unknown role or bad coupons are logged and skipped"""
+    seen = set()
+    for line, row in enumerate(rows, start=1):
+        name = (row.get('name') or row.get('user_name') or '').strip().lower()
+        role = (row.get('role') or default_role).strip()
+        try:
+            coupons = int(row.get('coupons') or default_coupons)
+        except ValueError:
+            coupons = None
+        if not name or role not in UserRoles.user_roles() or coupons is None:
+            log.warning("line %d: skipping invalid user %s", line, row)
+            continue
+        if name in seen:
+            log.warning("line %d: skipping duplicate user %s", line, name)
+            continue
+        seen.add(name)
+        yield {'name': name, 'role': role, 'coupons': coupons, 'password': row.get('password') or None}
+
+
+def _hash_all(pool, rows: List[dict]) -> List[str]:
+    passwords = [row['password'] for row in rows]
+    if pool is None:
+        return [encode_password(password) for password in passwords]
+    return list(pool.map(encode_password, passwords, chunksize=max(1, len(passwords) // (4 * (os.cpu_count() or 1)))))
+
+
+def _import_batch(pool, batch: List[dict], counts: dict) -> List[dict]:
+    """
+    inserts the new users of batch and sets the passwords given for existing ones, returns their credentials.
+    Existing users without a password in the file are left alone.
+    """
+    existing = {user.user_name for user in User.select(User.user_name)
+                .where(User.user_name.in_([row['name'] for row in batch]))}
+    rows = []
+    for row in batch:
+        if row['name'] in existing and not row['password']:
+            counts['unchanged'] += 1
+            continue
+        rows.append(row)
+    # the passwords for the whole batch at once, made in the parent
+    rows = [{**row, 'password': row['password'] or password}
+            for row, password in zip(rows, token_generator(12).generate_many(len(rows)))]
+    for row, hashed in zip(rows, _hash_all(pool, rows)):
+        row['hashed'] = hashed
+    if rows:
+        # INSERT ... ON CONFLICT (user_name) DO UPDATE SET salt = EXCLUDED.salt, password = EXCLUDED.password
+        # role and coupons of an existing user stay as they are
+        User.insert_many([{'user_name': row['name'], 'role': row['role'], 'coupons': row['coupons'],
+                           'salt': '', 'password': row['hashed']} for row in rows]) \
+            .on_conflict(conflict_target=[User.user_name], preserve=[User.salt, User.password]) \
+            .execute()
+    for row in rows:
+        if row['name'] in existing:
+            # run by the cli, the web workers see the new passwords once their caches expire
+            user_cache.invalidate(row['name'])
+            credential_cache.invalidate(row['name'])
+            counts['password_set'] += 1
+        else:
+            counts['created'] += 1
+    return [{field: row[field] for field in CREDENTIAL_FIELDS} for row in rows]
+
+
+def import_users(db: Database, path: str, output: str = None, default_role: str = UserRoles.USER,
+                 default_coupons: int = 10, batch_size: int = 500, workers: int = None):
+    """
+    imports the users in path, batch_size users per statement, all of them in a single transaction. The generated
+    credentials are written to output as csv once the transaction committed, or returned if output is None.
+    Running it again with the same file only resets the passwords given in the file.
+    """
+    counts = {'created': 0, 'password_set': 0, 'unchanged': 0}
+    credentials = []
+    result = open(output + '.part', 'w', newline='') if output else None
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        writer = csv.DictWriter(result, fieldnames=CREDENTIAL_FIELDS) if result else None
+        if writer:
+            writer.writeheader()
+        with db.atomic():
+            rows = parse_rows(read_rows(path), default_role, default_coupons)
+            for batch in iter(lambda: list(islice(rows, batch_size)), []):
+                imported = _import_batch(pool, batch, counts)
+                if writer:
+                    writer.writerows(imported)
+                else:
+                    credentials.extend(imported)
+        if result:
+            result.close()
+            os.replace(output + '.part', output)
+    finally:
+        if pool:
+            pool.shutdown()
+        if result and not result.closed:
+            result.close()
+            os.remove(output + '.part')
+    log.info("imported users from %s: %s", path, counts)
+    return counts if output else credentials
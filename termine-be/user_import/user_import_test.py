@@ -0,0 +1,64 @@
+import csv
+import json
+
+import hug
+
+from access_control.access_control import UserRoles, verify_user
+from conftest import USER
+from db.directives import PeeweeContext
+from db.model import User
+from user_import.user_import import import_users
+
+
+def _read_credentials(path):
+    with open(path, newline='') as f:
+        return {row["name"]: row for row in csv.DictReader(f)}
+
+
+def test_import_csv(testing_db, tmp_path):
+    users = tmp_path / "users.csv"
+    users.write_text("name,role,coupons,password\n"
+                     "Praxis-1,,,\n"
+                     "praxis-2,admin,3,secret\n"
+                     "praxis-1,,,\n"
+                     ",,,\n"
+                     "praxis-3,nobody,,\n"
+                     f"{USER},,,\n")
+    output = tmp_path / "credentials.csv"
+
+    counts = import_users(testing_db, str(users), str(output), workers=2, batch_size=1)
+
+    assert counts == {"created": 2, "password_set": 0, "unchanged": 1}
+    credentials = _read_credentials(output)
+    assert set(credentials) == {"praxis-1", "praxis-2"}
+    assert credentials["praxis-2"]["password"] == "secret"
+    praxis_2 = User.get(User.user_name == "praxis-2")
+    assert (praxis_2.role, praxis_2.coupons) == (UserRoles.ADMIN, 3)
+    for name, row in credentials.items():
+        assert verify_user(name, row["password"], PeeweeContext())
+
+
+def test_import_again_keeps_passwords(testing_db, tmp_path):
+    users = tmp_path / "users.jsonl"
+    users.write_text(json.dumps({"name": "praxis-1", "coupons": 5}) + "\n" +
+                     json.dumps({"name": "praxis-2", "password": "secret"}) + "\n")
+    first = import_users(testing_db, str(users), workers=1)
+    User.update(coupons=1).where(User.user_name == "praxis-1").execute()
+
+    counts = import_users(testing_db, str(users), str(tmp_path / "again.csv"), workers=1)
+
+    assert counts == {"created": 0, "password_set": 1, "unchanged": 1}
+    assert list(_read_credentials(tmp_path / "again.csv")) == ["praxis-2"]
+    praxis_1 = User.get(User.user_name == "praxis-1")
+    assert praxis_1.coupons == 1
+    assert verify_user("praxis-1", first[0]["password"], PeeweeContext())
+    assert verify_user("praxis-2", "secret", PeeweeContext())
+
+
+def test_add_users_one_name_per_line(testing_db, tmp_path):
+    users = tmp_path / "users.txt"
+    users.write_text("Praxis-1\npraxis-2\n")
+    output = hug.test.cli("add_users", str(users), role=UserRoles.ANON, coupons=2, workers="1", module="main")
+    assert [line.split("\t")[0] for line in output.splitlines()] == ["name", "praxis-1", "praxis-2"]
+    assert all(user.role == UserRoles.ANON and user.coupons == 2
+               for user in User.select().where(User.user_name.startswith("praxis")))